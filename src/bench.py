@@ -0,0 +1,377 @@
+"""
+Offline benchmarks of the bot's hot paths
+Copyright (C) 2023 Jiggy AI
+
+Runs without network access: OpenAI completions, Telegram and the HF inference
+endpoint are replaced by local fakes (the endpoint by hf_standin serving hash
+embeddings), and all databases go to a temporary directory.  Benchmarks whose
+dependencies are unavailable (e.g. a sentence transformer model that is not in
+the local cache) are reported as skipped.
+
+Results are written as JSON so runs from different commits can be compared.
+
+usage:
+    python bench.py [--out bench.json] [--only name,...] [--repeat N]
+    python bench.py compare BASE.json NEW.json [--threshold 0.10]
+
+compare prints the change in median time per benchmark and exits with status 1
+if any benchmark is slower than BASE by more than threshold.
+"""
+from loguru import logger
+import os
+import sys
+import json
+import socket
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from time import perf_counter, time
+from types import SimpleNamespace
+from typing import Callable, Dict, Tuple
+import numpy as np
+
+
+BENCH_MODEL = 'multi-qa-mpnet-base-cos-v1'
+BENCH_DIM = 768
+
+WORDS = ("the of and to in is was for on that with as by at from his her which an were are this be had it not "
+         "they have one their first new after city year two also who but has other its time world been people "
+         "state river music film war team series national school may during history known only under some").split()
+
+
+def words(n : int, rng=random) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def configure_env(tmp : str, unthrottled : bool = True) -> int:
+    """
+    point the bot's configuration at local fakes and temporary databases before any bot module is imported,
+    optionally lifting the telegram edit rate limits.  return the port of the local stand-in HF endpoint.
+    """
+    port = free_port()
+    os.environ.update({'OPENAI_API_KEY':             'sk-bench',
+                       'JINGBOT_TELEGRAM_API_TOKEN': '123456:bench',
+                       'HF_API_TOKEN':               'bench',
+                       'HF_INFERENCE_ENDPOINT':      f'http://127.0.0.1:{port}/',
+                       'HF_HUB_OFFLINE':             '1',
+                       'TRANSFORMERS_OFFLINE':       '1',
+                       'JINGBOT_SQLITE_PATH':        os.path.join(tmp, 'jingbot.db'),
+                       'JINGBOT_SESSION_DB':         os.path.join(tmp, 'sessions.db'),
+                       'JINGBOT_EMBCACHE_DB':        os.path.join(tmp, 'embeddings.db'),
+                       'JINGBOT_ROLE_CACHE_DIR':     tmp})
+    if unthrottled:    # measure our code, not telegram flood pacing
+        os.environ.update({'JINGBOT_CHAT_EDIT_RATE':   '100000',
+                           'JINGBOT_CHAT_EDIT_BURST':  '100000',
+                           'JINGBOT_GLOBAL_EDIT_RATE': '100000'})
+    return port
+
+
+def start_hf_standin(port : int) -> None:
+    """
+    serve hash embeddings on port from a background thread
+    """
+    from aiohttp import web
+    import hf_standin
+    app = hf_standin.make_app(SimpleNamespace(dim=BENCH_DIM, model=None, latency=0.0, input_latency=0.0))
+    started = threading.Event()
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', port).start())
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    started.wait()
+
+
+class HashEmbedder:
+    """
+    stand-in embedding model returning hash embeddings, for benchmarking the code around the model
+    """
+
+    def __init__(self) -> None:
+        from hf_standin import hash_embedding
+        self._embed = hash_embedding
+
+    def embed(self, text : str):
+        from embedding_model import ModelEmbedding
+        return ModelEmbedding(text=text, tokens=len(text.split()), gpt2_tokens=len(text.split()),
+                              vector=self._embed(text, BENCH_DIM), model=BENCH_MODEL)
+
+    def embed_batch(self, texts : list):
+        return [self.embed(text) for text in texts]
+
+    def dim(self) -> int:
+        return BENCH_DIM
+
+
+def fake_completion_stream(n_deltas : int = 200):
+    """
+    return a replacement for openai.ChatCompletion.acreate streaming n_deltas chunks
+    """
+    async def acreate(**kwargs):
+        async def gen():
+            for i in range(n_deltas):
+                await asyncio.sleep(0)
+                yield SimpleNamespace(choices=[SimpleNamespace(delta={'content': f'{random.choice(WORDS)} '})])
+        return gen()
+    return acreate
+
+
+class FakeChat:
+    type = 'private'
+
+    async def send_action(self, action=None, **kwargs):
+        pass
+
+
+class FakeMessage:
+
+    def __init__(self, bot, chat_id : int, message_id : int, text : str) -> None:
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.chat = FakeChat()
+
+    async def reply_text(self, text, **kwargs):
+        return await self.bot.send_message(self.chat_id, text)
+
+
+class FakeBot:
+    """
+    records telegram calls instead of making them
+    """
+
+    def __init__(self) -> None:
+        self.sent = 0
+        self.edits = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+        return FakeMessage(self, chat_id, self.sent, text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.edits += 1
+
+
+BENCHMARKS = {}    # name -> setup function returning (run function, extra results)
+
+def benchmark(name : str):
+    def deco(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return deco
+
+
+@benchmark('compose_completion_msg')
+def bench_compose(repeat : int) -> Tuple[Callable, dict]:
+    from chatstack import ChatContext, UserMessage, AssistantMessage
+    context = ChatContext()
+    rng = random.Random(0)
+    for i in range(5000):
+        context.messages.append(UserMessage(text=words(rng.randint(5, 60), rng)))
+        context.messages.append(AssistantMessage(text=words(rng.randint(20, 200), rng)))
+    return context._compose_completion_msg, {'history': len(context.messages)}
+
+
+def large_page(paragraphs : int = 3000) -> str:
+    rng = random.Random(0)
+    body = []
+    for i in range(paragraphs):
+        if i % 50 == 0:
+            body.append(f"<h2>Section {i // 50}</h2><script>var x{i} = {i};</script><nav><a href='/{i}'>link</a></nav>")
+        if i % 20 == 0:
+            body.append("<table>" + "".join(f"<tr><td>{words(3, rng)}</td><td>{i}</td></tr>" for _ in range(5)) + "</table>")
+        body.append(f"<p>{words(rng.randint(30, 120), rng)} <b>{words(3, rng)}</b> {words(10, rng)}</p>")
+    return (f"<html><head><title>bench</title><style>p {{ margin: 0 }}</style><meta charset='utf-8'></head>"
+            f"<body><header>{words(20, rng)}</header><article>{''.join(body)}</article><noscript>enable js</noscript></body></html>")
+
+
+@benchmark('extract_text_from_html')
+def bench_extract(repeat : int) -> Tuple[Callable, dict]:
+    import webpage
+    page = large_page()
+    return lambda: webpage.extract_text_from_html(page), {'bytes': len(page)}
+
+
+@benchmark('html_to_text')
+def bench_html_to_text(repeat : int) -> Tuple[Callable, dict]:
+    import webpage
+    page = large_page()
+    return lambda: webpage.html_to_text(page), {'bytes': len(page)}
+
+
+@benchmark('dynamic_prompt_k20')
+def bench_dynamic_prompt(repeat : int) -> Tuple[Callable, dict]:
+    import tokens
+    from dynamic_prompt import dynamic_prompt
+
+    class FakeLLM:
+        model_name = 'text-davinci-003'
+
+        def max_tokens_for_prompt(self, prompt : str) -> int:
+            return 4097 - len(tokens.encode(prompt, tokens.encoding_for_model(self.model_name)))
+
+    @dynamic_prompt(llm=FakeLLM(), response_tokens=256)
+    def qa_prompt(context, question):
+        return "Context:\n" + "\n".join(context) + f"\nQuestion: {question}\nResponse: "
+
+    # fresh passages for every call, as every question retrieves different passages
+    rng = random.Random(0)
+    contexts = [[words(rng.randint(100, 300), rng) for _ in range(20)] for _ in range(repeat + 2)]
+    calls = iter(contexts * 2)
+    return lambda: qa_prompt(context=next(calls), question="what happened?"), {'k': 20}
+
+
+@benchmark('search_role')
+def bench_search_role(repeat : int) -> Tuple[Callable, dict]:
+    import prompts
+    from lazy import Lazy
+    prompts.role_model = Lazy('bench_role_model', HashEmbedder)
+    prompts.role_matrix()
+    return lambda: prompts.search_role("a linux terminal"), {'roles': len(prompts.role_names), 'embedder': 'hash'}
+
+
+@benchmark('embed_batch')
+def bench_embed_batch(repeat : int) -> Tuple[Callable, dict]:
+    from st import get_model
+    model = get_model(BENCH_MODEL)
+    rng = random.Random(0)
+    batch = 256
+    calls = iter(range(10**9))
+    # distinct texts on every call so the embedding cache does not answer them
+    return lambda: model.embed_batch([f"{next(calls)} {words(rng.randint(10, 100), rng)}" for _ in range(batch)]), {'items': batch}
+
+
+@benchmark('chatbot_message')
+def bench_chatbot_message(repeat : int) -> Tuple[Callable, dict]:
+    import openai
+    import chatbot
+    openai.ChatCompletion.acreate = fake_completion_stream(200)
+    bot = FakeBot()
+    context = SimpleNamespace(bot=bot)
+    loop = asyncio.new_event_loop()
+    chat_ids = iter(range(10**9))
+
+    def run():
+        message = FakeMessage(bot, next(chat_ids) % 100, 0, words(20))
+        loop.run_until_complete(chatbot.message(SimpleNamespace(message=message), context))
+
+    return run, {'deltas': 200}
+
+
+def measure(fn : Callable, repeat : int, warmup : int = 2) -> dict:
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        fn()
+        times.append(perf_counter() - t0)
+    return {'repeat': repeat,
+            'mean':   float(np.mean(times)),
+            'p50':    float(np.percentile(times, 50)),
+            'p95':    float(np.percentile(times, 95)),
+            'min':    float(np.min(times)),
+            'max':    float(np.max(times))}
+
+
+def run(names, repeat : int) -> Dict[str, dict]:
+    results = {}
+    for name in names:
+        logger.info(f"benchmark {name}")
+        try:
+            fn, extra = BENCHMARKS[name](repeat)
+            result = measure(fn, repeat)
+        except Exception as e:
+            logger.warning(f"{name} skipped: {e!r}")
+            results[name] = {'skipped': repr(e)}
+            continue
+        result.update(extra)
+        if 'items' in extra:
+            result['items_per_second'] = extra['items'] / result['mean']
+        results[name] = result
+        print(f"{name:<24} p50 {result['p50']*1000:10.3f} ms  p95 {result['p95']*1000:10.3f} ms", file=sys.stderr)
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(base_path : str, new_path : str, threshold : float) -> int:
+    """
+    print the change in median time between two result files; return the number of regressions
+    """
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"base {base.get('commit')}  new {new.get('commit')}")
+    regressions = 0
+    for name in sorted(set(base['results']) | set(new['results'])):
+        b = base['results'].get(name, {})
+        n = new['results'].get(name, {})
+        if 'p50' not in b or 'p50' not in n:
+            print(f"{name:<24} {'-':>10}  (not run in both)")
+            continue
+        ratio = n['p50'] / b['p50']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif ratio < 1 - threshold:
+            flag = 'improved'
+        print(f"{name:<24} {b['p50']*1000:10.3f} ms -> {n['p50']*1000:10.3f} ms  {ratio:6.2f}x  {flag}")
+    return regressions
+
+
+def main(argv) -> None:
+    if argv[:1] == ['compare']:
+        parser = argparse.ArgumentParser(description="compare two benchmark result files")
+        parser.add_argument('base')
+        parser.add_argument('new')
+        parser.add_argument('--threshold', type=float, default=0.10, help="relative slowdown reported as a regression")
+        args = parser.parse_args(argv[1:])
+        sys.exit(1 if compare(args.base, args.new, args.threshold) else 0)
+
+    parser = argparse.ArgumentParser(description="run the offline benchmarks")
+    parser.add_argument('--out', default='bench.json')
+    parser.add_argument('--only', default=None, help="comma separated benchmark names")
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix='jingbot-bench-')
+    start_hf_standin(configure_env(tmp))
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    results = {'commit':     git_commit(),
+               'created_at': time(),
+               'python':     platform.python_version(),
+               'platform':   platform.platform(),
+               'results':    run(names, args.repeat)}
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"wrote {args.out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -4,103 +4,29 @@ GPT URL summarizer & search Telegram Bot
 This is an older version of the  bot based on text-davinci-003
 
 """
+import lazy    # first, to time startup
 from loguru import logger
 import os
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3 import Retry
 from telegram import Update
 from telegram.ext import ApplicationBuilder, MessageHandler, CommandHandler, ContextTypes, filters
-from bs4 import BeautifulSoup, NavigableString, Tag
-import tiktoken
 import openai
-import re
-from readability import Document
-import whisper
 import rtr
+import voice
+import metrics
+from delivery import stream_reply
+from webpage import find_url, url_summary_stream
 
 openai.api_key = os.environ["OPENAI_API_KEY"]
 
-OPENAI_ENGINE = "text-davinci-003"
 
-tokenizer = tiktoken.get_encoding("gpt2")
+async def post_init(application) -> None:
+    # load models in the background once polling starts, so text messages are served right away
+    voice.voice_queue.start()
+    lazy.warm()
+    metrics.start()
 
-whisper_model = whisper.load_model("large")
+bot = ApplicationBuilder().token(os.environ['JINGBOT_TELEGRAM_API_TOKEN']).concurrent_updates(True).post_init(post_init).build()
 
-session = requests.session()
-session.mount('https://', HTTPAdapter(max_retries=Retry(connect=5,
-                                                        read=5,
-                                                        status=5,
-                                                        redirect=2,
-                                                        backoff_factor=.001,
-                                                        status_forcelist=(500, 502, 503, 504))))
-
-
-bot = ApplicationBuilder().token(os.environ['JINGBOT_TELEGRAM_API_TOKEN']).build()
-
-
-def extract_text_from_html(content):
-    soup = BeautifulSoup(content, 'html.parser')
-    text = soup.find_all(text=True)
-
-    output = ''
-    blacklist = ['[document]','noscript','header','html','meta','head','input','script', "style"]
-    # there may be more elements you don't want
-
-    for t in text:
-        if t.parent.name not in blacklist:
-            output += '{} '.format(t)
-    return output
-
-
-MAX_INPUT_TOKENS=3200
-
-
-def url_to_response(url):
-    """
-    query the url and return the text content
-    raises exception if unable to adequately parse content
-    """
-    resp = session.get(url)
-
-    if resp.status_code != 200:
-        return f"Unable to GET contents of {url}"
-
-    PREPROMPT = "Provide a detailed summary of the following web page. If there is anything controversial please highlight the controversy. If there is something surprising, unique or clever, please highlight that as well:\n"
-    
-    doc = Document(resp.text)
-    text = extract_text_from_html(doc.summary())
-    
-    if not len(text) or text.isspace():
-        return "Unable to extract text data from url"
-    
-    token_count = len(tokenizer.encode(text)['input_ids'])
-
-    if token_count > MAX_INPUT_TOKENS:
-        # crudely truncate longer texts to get it back down to approximately the target MAX_INPUT_TOKENS
-        split_point = int((MAX_INPUT_TOKENS/token_count)*len(text))
-        percent = int(100*split_point/len(text))
-        text = text[:split_point]  + "<TRUNCATED>\n\n"
-        response = f"Only first {percent}% of url content processed due to length."
-    else:
-        response = ""
-    prompt = PREPROMPT + text
-    completion = openai.Completion.create(engine=OPENAI_ENGINE,
-                                          prompt=prompt,
-                                          temperature=.2,
-                                          max_tokens=880)
-    response += completion.choices[0].text
-    logger.info(response)
-    return response
-
-def is_url(msg : str) -> bool:
-    try:
-        re.search("(?P<url>https?://[^\s]+)", msg).group("url")
-        logger.info(f'url: {url}')
-        return True
-    except AttributeError:        
-        return False
-    
     
 async def message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
@@ -111,18 +37,35 @@ async def message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.message.chat_id
     logger.info(f"receive message {chat_id}: {text}")
 
-    def process():
-        if is_url(text):
-            return url_to_response(text)
+    with metrics.span('message'):
+        url = find_url(text)
+        if url:
+            logger.info(f'url: {url}')
+            await reply(update, context, url_summary_stream(url), 'Unable to parse the url')
         else:
-            return rtr.askchat(text)
+            await answer(update, context, text)
 
-    try:
-        response = process()
-    except Exception as e:
-        logger.exception(f"error handling message {text}")
-        response = f'Unable to parse the url due to exception: {e}'
-    await update.message.reply_text(response)
+
+async def answer(update: Update, context: ContextTypes.DEFAULT_TYPE, question : str) -> None:
+    """
+    stream the answer to the question into a placeholder reply
+    """
+    await reply(update, context, rtr.askchat_stream(question), 'Unable to answer')
+
+
+async def reply(update: Update, context: ContextTypes.DEFAULT_TYPE, stream, error_text : str) -> None:
+    """
+    stream the ("not_finished" | "finished", text) items of stream into a placeholder reply
+    """
+    placeholder_message = await update.message.reply_text("...")
+    async def gen():
+        try:
+            async for item in stream:
+                yield item
+        except Exception as e:
+            logger.exception(f"error handling message {update.message.text}")
+            yield "finished", f'{error_text} due to exception: {e}'
+    await stream_reply(context.bot, placeholder_message, gen(), parse_mode=None)
 
 
 async def voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -138,39 +81,40 @@ async def voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
     """
     logger.info(update)
-    voice = update.message.voice
-    f = await voice.get_file()    
-    try:
-        os.unlink("voice.ogg")
-    except:
-        pass
-    await f.download_to_drive('voice.ogg')
-    import hashlib
-    logger.info(hashlib.md5(open('voice.ogg', 'rb').read()).hexdigest())
-    logger.info(whisper_model.device)
-    result = whisper_model.transcribe("voice.ogg", verbose=True, task='transcribe')
-    logger.info(result)
-    response = result['text']
-    logger.info(response)
-    #await update.message.reply_text(response)
-
-    if result['language'] == 'en':
-        # lanugage was english, simply return now
-        response = rtr.askchat(result['text'])
-        await update.message.reply_text(response)
+    busy_text = "Too many voice messages right now, please try again in a minute."
+    if voice.voice_queue.is_full():
+        await update.message.reply_text(busy_text)
         return
-
-    # now translate the result as well
-    result = whisper_model.transcribe("voice.ogg", verbose=True, task='translate')
-    logger.info(result)
-    response = result['text']
-    logger.info(response)
-    #await update.message.reply_text(response)
-    await update.message.reply_text(rtr.askchat(response))
+    if voice.voice_queue.is_failed():
+        await update.message.reply_text("Voice recognition is unavailable right now, please try again later.")
+        return
+    if not voice.voice_queue.is_ready():
+        await update.message.reply_text("Voice recognition is still starting up, your message will be processed shortly...")
+    elif voice.voice_queue.is_busy():
+        await update.message.reply_text(f"Queued behind {voice.voice_queue.pending()} other voice messages...")
+    with metrics.span('voice'):
+        with metrics.span('audio_download'):
+            f = await update.message.voice.get_file()
+            data = await f.download_as_bytearray()
+        try:
+            # the whisper passes are traced separately, per batch
+            with metrics.span('voice_queue'):
+                result = await voice.voice_queue.submit(bytes(data))
+        except voice.VoiceQueueFull as e:
+            logger.warning(e)
+            await update.message.reply_text(busy_text)
+            return
+        except voice.VoiceUnavailable as e:
+            logger.warning(e)
+            await update.message.reply_text("Voice recognition is unavailable right now, please try again later.")
+            return
+        logger.info(result)
+        await answer(update, context, result.english)
 
     
 bot.add_handler(MessageHandler(filters.VOICE & ~filters.COMMAND, voice_handler))
 bot.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message))
 
-logger.info("run_polling")
-bot.run_polling()
+if __name__ == "__main__":
+    logger.info(f"run_polling after {lazy.uptime():.2f} s")
+    bot.run_polling()
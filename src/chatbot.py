@@ -2,6 +2,7 @@
 Chatbot based on OpenAI GPT-3.5-turbo
 Copyright (C) 2023 Jiggy AI LLC
 """
+import lazy    # first, to time startup
 from loguru import logger
 import os
 import telegram
@@ -9,20 +10,45 @@ from telegram import Update
 from telegram.constants import ChatType, ParseMode
 from telegram.ext import ApplicationBuilder, MessageHandler, CommandHandler, ContextTypes, filters
 from bs4 import BeautifulSoup, NavigableString, Tag
-import tiktoken
 import openai
 import re
 from readability import Document
 from random import choice
 import asyncio
+import weakref
 from time import time
 import re
 
-bot = ApplicationBuilder().token(os.environ['JINGBOT_TELEGRAM_API_TOKEN']).build()
+# chats allowed to use /stats, comma separated; the command is disabled if unset
+ADMIN_CHAT_IDS = {int(i) for i in os.environ.get('JINGBOT_ADMIN_CHAT_IDS', '').split(',') if i.strip()}
+
+async def post_init(application) -> None:
+    # load models in the background once polling starts, so chats are served right away
+    lazy.warm()
+    metrics.start()
+    chat_id_to_context.start()
+
+async def post_shutdown(application) -> None:
+    # save all chat contexts to the session spill database
+    chat_id_to_context.flush()
+
+bot = ApplicationBuilder().token(os.environ['JINGBOT_TELEGRAM_API_TOKEN']).concurrent_updates(True).post_init(post_init).post_shutdown(post_shutdown).build()
 
 from chatstack import ChatContext
+from sessions import SessionStore
+from webpage import find_url, url_summary_stream
+from delivery import stream_reply
+import metrics
 
-chat_id_to_context = {}
+chat_id_to_context = SessionStore()
+
+chat_locks = weakref.WeakValueDictionary()    # chat_id -> asyncio.Lock, kept alive while a handler holds or awaits it
+
+def chat_lock(chat_id : int) -> asyncio.Lock:
+    lock = chat_locks.get(chat_id)
+    if lock is None:
+        lock = chat_locks[chat_id] = asyncio.Lock()
+    return lock
 
 async def set_random_role(update):
     await update.message.reply_text("Use /act to select a specific role for the chatbot or /random to select another random role.", parse_mode=ParseMode.MARKDOWN)
@@ -56,58 +82,33 @@ async def message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not text or text.isspace():
         return    
 
-    # send placeholder message to user
-    placeholder_message = await update.message.reply_text("...")
-
-    # send typing action
-    await update.message.chat.send_action(action="typing")
-     
-    text = update.message.text
     chat_id = update.message.chat_id
-    logger.info(f"receive message {chat_id}: {text}")
-
-    if chat_id not in chat_id_to_context:
-         chat_id_to_context[update.message.chat_id] = ChatContext(base_system_msg_text=prompts.prompts['Assistant'],
-                                                                  min_response_tokens=400,           # minimum number of tokens to reserve for model completion response;  max input context will be (4096 - min_response_tokens)
-                                                                  max_response_tokens=800,
-                                                                  temperature=0.5)        
-    chat_context = chat_id_to_context[chat_id]
-    gen = chat_context.user_message_stream(text)
-    last_time = time()
-    prev_reply_text = ""
-    target_dt = .1
-    async for status, reply_text in gen:
-
-        if len(reply_text) > 4096:
-            await update.message.reply_text("response length exceeded")
-            # consider starting a new placeholder message
-            return
-                
-        target_dt = min(1, target_dt*1.05)
-        if time() - last_time < target_dt and status != "finished":
-            continue
-        last_time = time()
-
-        async def send_response():
-            try:
-                await context.bot.edit_message_text(reply_text, chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id, parse_mode=ParseMode.MARKDOWN)
-            except telegram.error.RetryAfter as e:
-                # 'telegram.error.RetryAfter: Flood control exceeded. Retry in 267 seconds'
-                logger.error(e)
-                pattern = r'\d+'
-                number = int(re.search(pattern, text).group())
-                logger.info(f'sleep {number}')
-                sleep(number)
-                await update.message.reply_text("<telegram rate limit exceeded>")
-            except telegram.error.BadRequest as e:
-                logger.error(e)
-                if str(e).startswith("Message is not modified"):
-                    return
+    # handle one message at a time per chat, and keep its session in memory until the reply is appended
+    async with chat_lock(chat_id):
+        with chat_id_to_context.pinned(chat_id):
+            # send placeholder message to user
+            placeholder_message = await update.message.reply_text("...")
+
+            # send typing action
+            await update.message.chat.send_action(action="typing")
+
+            logger.info(f"receive message {chat_id}: {text}")
+
+            chat_context = chat_id_to_context.get(chat_id)
+            if chat_context is None:
+                 chat_context = chat_id_to_context[chat_id] = ChatContext(base_system_msg_text=prompts.prompts['Assistant'],
+                                                                          min_response_tokens=400,           # minimum number of tokens to reserve for model completion response;  max input context will be (4096 - min_response_tokens)
+                                                                          max_response_tokens=800,
+                                                                          temperature=0.5)        
+            with metrics.span('message'):
+                # a message that is only a url is summarized; a url in a sentence is part of the conversation
+                url = find_url(text)
+                if url and url == text.strip():
+                    gen = url_summary_stream(url)
                 else:
-                    await context.bot.edit_message_text(reply_text, chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id)
-        await send_response()
-                
-    logger.info(f"send message {chat_id}: {reply_text}")
+                    gen = chat_context.user_message_stream(text)
+                reply_text = await stream_reply(context.bot, placeholder_message, gen)
+            logger.info(f"send message {chat_id}: {reply_text}")
 
 
 
@@ -122,7 +123,15 @@ async def command(update: Update, tgram_context: ContextTypes.DEFAULT_TYPE) -> N
     role - Set the role by name or semantic search
     random - select a random role
     prompt - output the base system prompt for the current role
+    stats - output chat session store statistics and the startup report, in ADMIN_CHAT_IDS chats only
     """
+    # commands replace the chat context, so they wait for a message being answered in the same chat
+    async with chat_lock(update.message.chat_id):
+        with chat_id_to_context.pinned(update.message.chat_id):
+            await _command(update, tgram_context)
+
+
+async def _command(update: Update, tgram_context: ContextTypes.DEFAULT_TYPE) -> None:
     text = update.message.text
     chat_id = update.message.chat_id
     logger.info(f"receive command {chat_id}: {text}")    
@@ -131,8 +140,20 @@ async def command(update: Update, tgram_context: ContextTypes.DEFAULT_TYPE) -> N
         if not role:
              await update.message.reply_text(f"I know how to act as the following:\n{', '.join(prompts.prompts.keys())}")
              return                               
-        role = prompts.search_role(role)
-        await update.message.reply_text(f"Using role '{role}'")
+        exact = [r for r in prompts.prompts if r.lower() == role.lower()]
+        if exact:
+            matches = [(exact[0], 1.0)]
+        elif not prompts.role_matrix.ready:
+            prompts.role_matrix.start()
+            await update.message.reply_text("Role search is still starting up; use an exact role name or try again in a minute.")
+            return
+        else:
+            matches = await asyncio.to_thread(prompts.search_roles, role)
+        if role.lower() != matches[0][0].lower() and len(matches) > 1:
+            await update.message.reply_text(f"Using role '{matches[0][0]}'.  Did you mean: {', '.join(m for m, _ in matches[1:])}?")
+        else:
+            await update.message.reply_text(f"Using role '{matches[0][0]}'")
+        role = matches[0][0]
         prompt = prompts.prompts[role]
 
         chat_id_to_context[chat_id] = ChatContext(base_system_msg_text=prompts.prompts[role],
@@ -142,9 +163,14 @@ async def command(update: Update, tgram_context: ContextTypes.DEFAULT_TYPE) -> N
     elif text.startswith('/random'):
         await set_random_role(update)
     elif text.startswith('/prompt'):
-        await update.message.reply_text(chat_id_to_context[chat_id].base_system_msg.text)
+        chat_context = chat_id_to_context.get(chat_id)
+        if chat_context:
+            await update.message.reply_text(chat_context.base_system_msg.text)
+    elif text.startswith('/stats') and chat_id in ADMIN_CHAT_IDS:
+        await update.message.reply_text(f"{chat_id_to_context.stats()}\n{lazy.report()}")
     
 bot.add_handler(MessageHandler(filters.COMMAND, command))
 
-logger.info("run_polling")
-bot.run_polling()
+if __name__ == "__main__":
+    logger.info(f"run_polling after {lazy.uptime():.2f} s")
+    bot.run_polling()
@@ -1,12 +1,12 @@
 from loguru import logger
 from pydantic import BaseModel, root_validator
-from typing import Optional, List
+from typing import Optional, List, Dict
+from bisect import bisect_left
 from retry import retry
 import openai
-import tiktoken
 from time import time
-
-encoder = tiktoken.get_encoding('cl100k_base')
+import tokens
+import metrics
 
 class ChatRoleMessage(BaseModel):
     role: str
@@ -16,7 +16,7 @@ class ChatRoleMessage(BaseModel):
     @root_validator
     def compute_tokens(cls, values) -> int:
         _text = f'{values["role"]}\n{values["text"]}' 
-        values["tokens"] = len(encoder.encode(_text))
+        values["tokens"] = tokens.count(_text)
         values["tokens"] += 2    # XXX validate/model unknown overhead
         return values
 
@@ -38,6 +38,135 @@ class UserMessage(ChatRoleMessage):
     text: str
 
 
+@retry(tries=10, delay=.05, ExceptionToRaise=openai.error.InvalidRequestError, breaker='openai')
+def completion(msgs : List[ChatRoleMessage], model="gpt-3.5-turbo", temperature=0.5, max_tokens=None) -> str:
+    """
+    return the completion for the messages, outside of any ChatContext
+    """
+    messages = [{"role": msg.role, "content": msg.text} for msg in msgs]
+    kwargs = {'max_tokens': max_tokens} if max_tokens else {}
+    t0 = time()
+    with metrics.span('completion'):
+        response = openai.ChatCompletion.create(model = model,
+                                                messages = messages,
+                                                temperature = temperature,
+                                                **kwargs)
+    logger.info(f'completion time: {time() - t0:.3f} s')
+    metrics.completion_tokens(model, response['usage']['prompt_tokens'], response['usage']['completion_tokens'])
+    return response['choices'][0]['message']['content']
+
+
+@retry(tries=10, delay=.05, ExceptionToRaise=openai.error.InvalidRequestError, breaker='openai')
+async def completion_stream(msgs : List[ChatRoleMessage], model="gpt-3.5-turbo", temperature=0.5, max_tokens=None):
+    """
+    yield ("not_finished", partial response) as the completion for the messages streams in,
+    then ("finished", response)
+    """
+    messages = [{"role": msg.role, "content": msg.text} for msg in msgs]
+    kwargs = {'max_tokens': max_tokens} if max_tokens else {}
+    t0 = time()
+    r_gen = await openai.ChatCompletion.acreate(model = model,
+                                                messages = messages,
+                                                temperature = temperature,
+                                                stream = True,
+                                                **kwargs)
+    response = ""
+    async for r_item in r_gen:
+        delta = r_item.choices[0].delta.get('content', '')
+        if delta:
+            if not response:
+                logger.info(f'completion first token time: {time() - t0:.3f} s')
+                metrics.first_token(model, time() - t0)
+            response += delta
+            yield "not_finished", response
+    logger.info(f'completion time: {time() - t0:.3f} s')
+    # timed here rather than in a span since the consumer runs between our yields
+    metrics.observe('completion', time() - t0)
+    metrics.completion_tokens(model, sum(msg.tokens for msg in msgs), tokens.count(response))
+    yield "finished", response.strip()
+
+
+class ChatHistory:
+    """
+    chat messages in chronological order with O(1) append and per-role running token sums,
+    so the newest messages fitting a token budget can be found without scanning the history
+    """
+
+    def __init__(self) -> None:
+        self._messages = []     # chronological order, oldest messages first
+        self._positions = {}    # role -> positions in _messages of the messages with that role
+        self._prefix = {}       # role -> running token sums; _prefix[role][k] is the tokens in the first k messages of role
+        self.nbytes = 0         # total length of the message texts
+
+    def append(self, msg : ChatRoleMessage) -> None:
+        self._positions.setdefault(msg.role, []).append(len(self._messages))
+        prefix = self._prefix.setdefault(msg.role, [0])
+        prefix.append(prefix[-1] + msg.tokens)
+        self._messages.append(msg)
+        self.nbytes += len(msg.text)
+
+    def trim(self, role_limits : Dict[str, int]) -> None:
+        """
+        drop the messages that can no longer be returned by newest() with these role_limits
+        """
+        keep = min((self._positions[role][max(0, len(self._positions[role]) - limit)]
+                    for role, limit in role_limits.items() if limit and role in self._positions),
+                   default=len(self._messages))
+        messages = self._messages[keep:]
+        self.__init__()
+        for msg in messages:
+            self.append(msg)
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __iter__(self):
+        return iter(self._messages)
+
+    def __getitem__(self, i):
+        return self._messages[i]
+
+    def _first(self, role : str, limit : int, position : int) -> int:
+        # index of the oldest message of role that is at or after position and among the newest limit messages of role
+        positions = self._positions[role]
+        return max(len(positions) - limit, bisect_left(positions, position))
+
+    def _tokens_from(self, position : int, role_limits : Dict[str, int]) -> int:
+        # total tokens of the eligible messages at or after position
+        return sum(self._prefix[role][-1] - self._prefix[role][self._first(role, limit, position)]
+                   for role, limit in role_limits.items())
+
+    def newest(self, max_tokens : int, role_limits : Dict[str, int]) -> List[ChatRoleMessage]:
+        """
+        return in chronological order the newest messages totaling at most max_tokens,
+        with at most role_limits[role] messages of each role.  Messages with roles not in role_limits are excluded.
+        as when walking the history from the newest message, the messages returned are those after the
+        newest message, of any role, that does not fit on top of the messages after it.
+        """
+        role_limits = {role: limit for role, limit in role_limits.items() if role in self._positions}
+        # binary search for the oldest position from which the eligible messages fit in max_tokens
+        lo, hi = 0, len(self._messages)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._tokens_from(mid, role_limits) <= max_tokens:
+                hi = mid
+            else:
+                lo = mid + 1
+        # an excluded message (other role, or over its role's limit) after lo stops the walk if it does not fit;
+        # they are checked newest first per role, so only the newest such message of each role is found
+        for role, positions in self._positions.items():
+            excluded = max(0, len(positions) - role_limits.get(role, 0))    # positions[:excluded] are excluded
+            for i in range(excluded - 1, bisect_left(positions, lo) - 1, -1):
+                p = positions[i]
+                if self._messages[p].tokens + self._tokens_from(p + 1, role_limits) > max_tokens:
+                    lo = p + 1
+                    break
+        positions = []
+        for role, limit in role_limits.items():
+            positions += self._positions[role][self._first(role, limit, lo):]
+        return [self._messages[p] for p in sorted(positions)]
+
+
 class ChatContext:
 
     def __init__(self,
@@ -59,38 +188,61 @@ class ChatContext:
         self.max_response_tokens = max_response_tokens
         self.max_context_assistant_messages = max_context_assistant_messages
         self.max_context_user_messages = max_context_user_messages
-        self.messages = []    # reverse chronological order, newest messages first
+        self.messages = ChatHistory()
+
+    def _role_limits(self) -> Dict[str, int]:
+        return {'assistant': self.max_context_assistant_messages,
+                'user':      self.max_context_user_messages}
+
+    def _append(self, msg : ChatRoleMessage) -> None:
+        self.messages.append(msg)
+        # periodically drop messages that can never be in context again
+        role_limits = self._role_limits()
+        if len(self.messages) > 2 * sum(role_limits.values()):
+            self.messages.trim(role_limits)
+
+    def nbytes(self) -> int:
+        """
+        return the approximate memory used by the context text
+        """
+        return self.messages.nbytes + len(self.base_system_msg.text)
+
+    def to_dict(self) -> dict:
+        """
+        return the context state as a json serializable dict
+        """
+        return {'model':                          self.model,
+                'temperature':                    self.temperature,
+                'base_system_msg_text':           self.base_system_msg.text,
+                'min_response_tokens':            self.min_response_tokens,
+                'max_response_tokens':            self.max_response_tokens,
+                'max_context_assistant_messages': self.max_context_assistant_messages,
+                'max_context_user_messages':      self.max_context_user_messages,
+                'messages':                       [(msg.role, msg.text) for msg in self.messages]}
+
+    @classmethod
+    def from_dict(cls, state : dict) -> "ChatContext":
+        """
+        return a ChatContext restored from the output of to_dict()
+        """
+        state = dict(state)
+        messages = state.pop('messages')
+        context = cls(**state)
+        for role, text in messages:
+            context.messages.append(ChatRoleMessage(role=role, text=text))
+        return context
 
     def _compose_completion_msg(self) -> List[ChatRoleMessage]:
         # assemble the input messages subject to the following constraints:
         # must leave room for min_response_tokens in the context
         # maximum of max_context_assistant_messages assistant messages
         # maximum of max_context_user_messages user messages
-        max_input_context = self.max_model_context - self.min_response_tokens
-        messages = []
-        current_input_tokens = self.base_system_msg.tokens
-        current_user_messages = 0
-        current_assistant_messages = 0
-        for msg in self.messages:
-            tokens = msg.tokens
-            if current_input_tokens + tokens > max_input_context:
-                break
-            if msg.role == 'assistant':
-                if current_assistant_messages < self.max_context_assistant_messages:
-                    messages.append(msg)
-                    current_assistant_messages += 1
-                    current_input_tokens += msg.tokens
-            elif msg.role == 'user':
-                if current_user_messages < self.max_context_user_messages:
-                    messages.append(msg)
-                    current_user_messages += 1
-                    current_input_tokens += msg.tokens
-        messages.append(self.base_system_msg)
-        messages.reverse()
-        return messages
-
-
-    @retry(tries=10, delay=.05)
+        max_input_context = self.max_model_context - self.min_response_tokens - self.base_system_msg.tokens
+        messages = self.messages.newest(max_input_context, self._role_limits())
+        return [self.base_system_msg] + messages
+
+
+    @retry(tries=10, delay=.05, ExceptionToRaise=openai.error.InvalidRequestError, breaker='openai')
     def _completion(self, msgs :ChatRoleMessage) -> str:
         for msg in msgs:
             logger.info(f"completion message: role {msg.role}: '{msg.text}'")
@@ -99,26 +251,29 @@ class ChatContext:
         
         try:
             t0 = time()
-            response =  openai.ChatCompletion.create(model = self.model,
-                                                    messages = messages,
-                                                    max_tokens = self.max_response_tokens,
-                                                    temperature = self.temperature)
+            with metrics.span('completion'):
+                response =  openai.ChatCompletion.create(model = self.model,
+                                                        messages = messages,
+                                                        max_tokens = self.max_response_tokens,
+                                                        temperature = self.temperature)
             dt = time() - t0
             logger.info(f'completion time: {dt:.3f} s')
         except Exception as e:
             logger.exception(e)
             raise
+        metrics.completion_tokens(self.model, response['usage']['prompt_tokens'], response['usage']['completion_tokens'])
         
         logger.debug(f'completion response: {response}')        
         response_text = response['choices'][0]['message']['content']
         logger.info(f'completion response: {response_text}')
-        self.messages.insert(0, AssistantMessage(text=response_text))
+        self._append(AssistantMessage(text=response_text))
         return response_text
 
-    @retry(tries=10, delay=.05, ExceptionToRaise=openai.error.InvalidRequestError)
+    @retry(tries=10, delay=.05, ExceptionToRaise=openai.error.InvalidRequestError, breaker='openai')
     async def _completion_stream(self, msgs :ChatRoleMessage) -> str:
         oai_messages = [{"role": msg.role, "content": msg.text} for msg in msgs]
         try:
+            t0 = time()
             r_gen = await openai.ChatCompletion.acreate(model=self.model,
                                                         messages=oai_messages,
                                                         stream=True,
@@ -127,6 +282,8 @@ class ChatContext:
             async for r_item in r_gen:
                 delta = r_item.choices[0].delta.get('content', '')
                 if delta:
+                    if not response:
+                        metrics.first_token(self.model, time() - t0)
                     response += delta
                     yield "not_finished", response
             
@@ -139,15 +296,16 @@ class ChatContext:
         except Exception as e:
             logger.exception(e)
             raise
+        metrics.observe('completion', time() - t0)
+        metrics.completion_tokens(self.model, sum(msg.tokens for msg in msgs), tokens.count(response))
         response = response.strip()
-        self.messages.insert(0, AssistantMessage(text=response))
+        self._append(AssistantMessage(text=response))
         yield "finished", response
 
 
     async def user_message_stream(self, msg_text) -> str:
         msg = UserMessage(text=msg_text)
-        # put message at beginning of list
-        self.messages.insert(0, msg)
+        self._append(msg)
         msgs = self._compose_completion_msg()
         for msg in msgs:
             logger.info(f"completion message: role {msg.role}: '{msg.text}'")
@@ -159,8 +317,7 @@ class ChatContext:
     
     def user_message(self, msg_text) -> str:
         msg = UserMessage(text=msg_text)
-        # put message at beginning of list
-        self.messages.insert(0, msg)
+        self._append(msg)
         response_text = self._completion(self._compose_completion_msg())
         return response_text
     
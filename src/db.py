@@ -1,4 +1,3 @@
-
 # database engine
 import os
 from sqlmodel import create_engine, SQLModel
@@ -6,16 +5,23 @@ from sqlmodel import create_engine, SQLModel
 
 
 # DB Config
-db_host = os.environ['JIGGY_POSTGRES_HOST']
-user = os.environ['JIGGY_POSTGRES_USER']
-passwd = os.environ['JIGGY_POSTGRES_PASS']
+# use postgres if configured, otherwise fall back to a local sqlite database
+if 'JIGGY_POSTGRES_HOST' in os.environ:
+    db_host = os.environ['JIGGY_POSTGRES_HOST']
+    user = os.environ['JIGGY_POSTGRES_USER']
+    passwd = os.environ['JIGGY_POSTGRES_PASS']
+
+    DBURI = 'postgresql+psycopg2://%s:%s@%s:5432/memobot' % (user, passwd, db_host)
 
-DBURI = 'postgresql+psycopg2://%s:%s@%s:5432/memobot' % (user, passwd, db_host)
+    engine = create_engine(DBURI, pool_pre_ping=True, echo=False)
+else:
+    DBURI = 'sqlite:///%s' % os.environ.get('JINGBOT_SQLITE_PATH', 'jingbot.db')
 
-engine = create_engine(DBURI, pool_pre_ping=True, echo=False)
+    engine = create_engine(DBURI, echo=False, connect_args={'check_same_thread': False})
 
 if __name__ == "__main__":
     from models import *
     SQLModel.metadata.create_all(engine)
     print("create_all complete")
 
+
@@ -0,0 +1,289 @@
+"""
+Streaming reply delivery for Telegram
+Copyright (C) 2023 Jiggy AI
+
+A streamed reply is delivered by editing a placeholder message in place.
+Edits are paced by a per-chat and a global token bucket sized to stay under
+Telegram's flood limits; text that arrives while waiting for a token is
+coalesced into the next edit. RetryAfter responses pause the chat's bucket
+(and the global bucket when several chats are flood controlled at once)
+without blocking the event loop, and replies longer than one Telegram message
+roll over into continuation messages.
+
+Configuration:
+JINGBOT_CHAT_EDIT_RATE    edits per second per chat
+JINGBOT_CHAT_EDIT_BURST   edits a chat may burst before being paced
+JINGBOT_GLOBAL_EDIT_RATE  edits per second across all chats
+"""
+from loguru import logger
+import os
+import asyncio
+from datetime import timedelta
+from time import monotonic
+from typing import AsyncIterator, List, Tuple
+import telegram
+from telegram.constants import ParseMode
+
+from lru import LRUCache
+import metrics
+
+
+MAX_MESSAGE_LENGTH = telegram.constants.MessageLimit.MAX_TEXT_LENGTH   # 4096
+
+CHAT_EDIT_RATE   = float(os.environ.get('JINGBOT_CHAT_EDIT_RATE', 1))
+CHAT_EDIT_BURST  = float(os.environ.get('JINGBOT_CHAT_EDIT_BURST', 3))
+GLOBAL_EDIT_RATE = float(os.environ.get('JINGBOT_GLOBAL_EDIT_RATE', 25))
+
+MAX_FAILURES = 3    # give up on an edit after this many network errors
+
+GLOBAL_FLOOD_CHATS = 2     # flood control errors in this many chats within FLOOD_WINDOW seconds pause all chats
+FLOOD_WINDOW       = 1.0
+
+# outcomes of delivering a page
+SENT      = 'sent'        # the page is shown
+RETRY     = 'retry'       # try the page again
+ABANDONED = 'abandoned'   # gave up on the page; it is not shown
+
+
+class TokenBucket:
+    """
+    token bucket refilled at rate tokens per second up to capacity tokens
+    """
+
+    def __init__(self, rate : float, capacity : float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = monotonic()
+        self.paused_until = 0
+
+    def _refill(self, now : float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self) -> float:
+        """
+        return the number of seconds until a token is available
+        """
+        now = monotonic()
+        self._refill(now)
+        return max(self.paused_until - now, (1 - self.tokens) / self.rate, 0)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def pause(self, seconds : float) -> None:
+        """
+        make no tokens available for seconds, e.g. after a flood control error
+        """
+        self.paused_until = max(self.paused_until, monotonic() + seconds)
+        self.tokens = 0
+
+
+global_bucket = TokenBucket(GLOBAL_EDIT_RATE, GLOBAL_EDIT_RATE)
+
+chat_buckets = LRUCache(100000)
+
+recent_floods = {}    # chat_id -> time of the chat's latest flood control error within FLOOD_WINDOW
+
+
+def chat_bucket(chat_id : int) -> TokenBucket:
+    """
+    return the token bucket for the chat
+    """
+    bucket = chat_buckets.get(chat_id)
+    if bucket is None:
+        bucket = TokenBucket(CHAT_EDIT_RATE, CHAT_EDIT_BURST)
+        chat_buckets.put(chat_id, bucket)
+    return bucket
+
+
+async def acquire(bucket : TokenBucket) -> None:
+    """
+    wait until both the chat bucket and the global bucket have a token and take them
+    """
+    while True:
+        delay = max(bucket.delay(), global_bucket.delay())
+        if delay <= 0:
+            bucket.take()
+            global_bucket.take()
+            return
+        await asyncio.sleep(delay)
+
+
+def flood_control(chat_id : int, bucket : TokenBucket, seconds : float) -> None:
+    """
+    pause the chat's bucket after telegram asked to wait seconds before editing the chat again.
+    flood control errors in GLOBAL_FLOOD_CHATS chats within FLOOD_WINDOW seconds are taken to be
+    the bot's global limit and pause every chat.
+    """
+    bucket.pause(seconds)
+    now = monotonic()
+    recent_floods[chat_id] = now
+    for c in [c for c, t in recent_floods.items() if t < now - FLOOD_WINDOW]:
+        del recent_floods[c]
+    if len(recent_floods) >= GLOBAL_FLOOD_CHATS:
+        logger.warning(f"flood control in {len(recent_floods)} chats, pausing all chats for {seconds} s")
+        global_bucket.pause(seconds)
+
+
+def split_pages(text : str, limit : int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    split text into pages of at most limit characters, preferring to break at a newline or space.
+    pages of a growing text are stable: a page depends only on the text up to its end.
+    """
+    pages = []
+    while len(text) > limit:
+        cut = text.rfind('\n', limit // 2, limit)
+        if cut < 0:
+            cut = text.rfind(' ', limit // 2, limit)
+        if cut < 0:
+            cut = limit
+        pages.append(text[:cut])
+        text = text[cut:].lstrip()
+    pages.append(text)
+    return pages
+
+
+class ReplyStream:
+    """
+    deliver a growing reply text to the chat by editing placeholder_message,
+    rolling over into new messages when the text exceeds MAX_MESSAGE_LENGTH
+    """
+
+    def __init__(self, bot, placeholder_message, parse_mode=ParseMode.MARKDOWN) -> None:
+        self.bot = bot
+        self.chat_id = placeholder_message.chat_id
+        self.messages = [placeholder_message]
+        self.sent = [placeholder_message.text]    # text currently shown in each message
+        self.parse_mode = parse_mode
+        self.bucket = chat_bucket(self.chat_id)
+        self.text = ""
+        self.finished = False
+        self.edits = 0
+        self.failures = 0
+        self.abandoned = 0
+        self.stopped = False     # set when the chat can not be written to at all
+        self._changed = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def update(self, text : str) -> None:
+        """
+        set the latest reply text; it will be shown with the next edit
+        """
+        self.text = text
+        self._changed.set()
+
+    async def finish(self, text : str) -> None:
+        """
+        set the final reply text and wait until it has been delivered
+        """
+        self.finished = True
+        self.update(text)
+        await self._task
+
+    def _page(self, i : int):
+        # the i'th page of the latest text, or None if the text has fewer pages
+        pages = split_pages(self.text or "...")
+        return pages[i] if i < len(pages) else None
+
+    async def _run(self) -> None:
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            i = 0
+            while self._page(i) is not None:
+                outcome = await self._deliver(i)
+                if outcome == SENT:
+                    i += 1
+                elif outcome == ABANDONED:
+                    break    # later pages belong after this one; try again with the next text
+            if self.stopped:
+                return
+            if self.finished and not self._changed.is_set():
+                return
+
+    async def _send(self, i : int, page : str, parse_mode) -> None:
+        # show page in the i'th message, sending the message if there is no i'th message yet
+        if i < len(self.messages):
+            await self.bot.edit_message_text(page, chat_id=self.chat_id, message_id=self.messages[i].message_id, parse_mode=parse_mode)
+        else:
+            self.messages.append(await self.bot.send_message(self.chat_id, page, parse_mode=parse_mode))
+
+    async def _deliver(self, i : int) -> str:
+        # show the latest i'th page in the i'th message; return SENT, RETRY or ABANDONED
+        if i < len(self.sent) and self.sent[i] == self._page(i):
+            return SENT
+        await acquire(self.bucket)
+        page = self._page(i)   # coalesce any text that arrived while waiting for the bucket
+        try:
+            try:
+                await self._send(i, page, self.parse_mode)
+            except telegram.error.BadRequest as e:
+                if not _not_modified(e):
+                    # most likely partial markdown; send as plain text, paced like any other edit
+                    logger.warning(e)
+                    await acquire(self.bucket)
+                    try:
+                        await self._send(i, page, None)
+                    except telegram.error.BadRequest as e:
+                        if not _not_modified(e):
+                            logger.error(f"giving up on edit of message {i} in chat {self.chat_id}: {e}")
+                            return self._abandon()
+        except telegram.error.RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            logger.warning(f"flood control, retry chat {self.chat_id} in {retry_after} s")
+            flood_control(self.chat_id, self.bucket, retry_after)
+            metrics.EDITS.labels('flood').inc()
+            return RETRY
+        except telegram.error.NetworkError as e:
+            self.failures += 1
+            metrics.EDITS.labels('error').inc()
+            logger.warning(f"edit failed ({self.failures}): {e}")
+            if self.failures < MAX_FAILURES:
+                return RETRY
+            logger.error(f"giving up on edit of message {i} in chat {self.chat_id}")
+            return self._abandon()
+        except telegram.error.TelegramError as e:
+            # e.g. the bot was blocked or removed from the chat; no later edit will succeed either
+            logger.error(f"giving up on reply in chat {self.chat_id}: {e}")
+            self.stopped = True
+            return self._abandon()
+        self.failures = 0
+        self.edits += 1
+        metrics.EDITS.labels('ok').inc()
+        if i < len(self.sent):
+            self.sent[i] = page
+        else:
+            self.sent.append(page)
+        return SENT
+
+    def _abandon(self) -> str:
+        self.failures = 0
+        self.abandoned += 1
+        metrics.EDITS.labels('abandoned').inc()
+        return ABANDONED
+
+
+def _not_modified(e : telegram.error.BadRequest) -> bool:
+    # the message already shows the text
+    return str(e).startswith("Message is not modified")
+
+
+async def stream_reply(bot, placeholder_message, gen : AsyncIterator[Tuple[str, str]], parse_mode=ParseMode.MARKDOWN) -> str:
+    """
+    deliver the ("not_finished", text) ... ("finished", text) stream gen by editing placeholder_message.
+    return the final text.
+    """
+    with metrics.span('stream_reply') as span:
+        reply = ReplyStream(bot, placeholder_message, parse_mode)
+        reply_text = ""
+        try:
+            async for status, reply_text in gen:
+                reply.update(reply_text)
+        finally:
+            await reply.finish(reply_text)
+            span.attrs['edits'] = reply.edits
+            if reply.abandoned:
+                span.attrs['abandoned'] = reply.abandoned
+    return reply_text
@@ -6,6 +6,13 @@ Dynamically adjust dynamic prompt elements to constrain the size of list element
 such that the total prompt length in tokens is below the model maximum,
 leaving room for the specified number of response_tokens.
 
+List elements are kept in order (or in descending priority(element) order if a
+priority function is given) until the next element does not fit.  With
+truncate_last the first element that does not fit is truncated to fill the
+remaining budget.  Each element is tokenized once and the template overhead is
+measured once by rendering the prompt with empty lists, so packing is linear in
+the number of elements rather than one full prompt render per dropped element.
+
 davinci3 = OpenAI(model_name="text-davinci-003", max_tokens=-1, temperature=.1)
 
 @dynamic_prompt(llm=davinci3, response_tokens=200)
@@ -25,21 +32,78 @@ def qa_prompt(context : List[str],  question : str):
 
 from langchain.llms.base import BaseLLM
 from functools import wraps
+from typing import Callable, Optional
+import tokens
+
+SEPARATOR_TOKENS = 1   # allowance for the separator the prompt function puts between list elements
+
 
-def dynamic_prompt(llm : BaseLLM, response_tokens : int):
+def _encoding(llm : BaseLLM) -> str:
+    # name of the tiktoken encoding of the llm; an approximation for non-openai llms is fine
+    # since the packed prompt is checked against the llm before it is returned
+    try:
+        return tokens.encoding_for_model(llm.model_name)
+    except (AttributeError, KeyError):
+        return tokens.DEFAULT_ENCODING
+
+
+def dynamic_prompt(llm : BaseLLM, response_tokens : int, priority : Optional[Callable] = None, truncate_last : bool = False):
     def deco_prompt(f):
         @wraps(f)
         def f_prompt(*args, **kwargs):
-            # while the prompt is too long, remove elements the end of the list args
-            # until everything fits
-            def reduce_prompt(listitem):
-                if isinstance(listitem, list):
-                    return listitem[:-1]
-                return listitem
-            while llm.max_tokens_for_prompt(f(*args, **kwargs)) < response_tokens:                
-                args = tuple([reduce_prompt(a) for a in list(args)])
-                kwargs = {k: reduce_prompt(v) for k, v in kwargs.items()}                
-            return f(*args, **kwargs)
+            args = list(args)
+            # (container, key) of each list argument
+            slots  = [(args, i) for i, a in enumerate(args) if isinstance(a, list)]
+            slots += [(kwargs, k) for k, v in kwargs.items() if isinstance(v, list)]
+            lists = [c[k] for c, k in slots]
+
+            def render(keep):
+                for j, (c, k) in enumerate(slots):
+                    c[k] = [keep[(j, i)] for i in range(len(lists[j])) if (j, i) in keep]
+                return f(*args, **kwargs)
+
+            # template overhead with all lists empty
+            budget = llm.max_tokens_for_prompt(render({})) - response_tokens
+            encoding = _encoding(llm)
+
+            # candidate elements (list index, element index) in the order they are to be kept;
+            # without a priority the lists are shortened from the end in lockstep, so an element
+            # is kept for as long as there are elements after it in its list
+            candidates = [(j, i) for j, items in enumerate(lists) for i in range(len(items))]
+            if priority:
+                candidates.sort(key=lambda c: -priority(lists[c[0]][c[1]]))
+            else:
+                candidates.sort(key=lambda c: (c[1] - len(lists[c[0]]), c[0]))
+            counts = tokens.count_batch([str(lists[j][i]) for j, i in candidates], encoding)
+
+            keep = {}   # (list index, element index) -> element, in the order kept
+            used = 0
+            stop = len(candidates)
+            for k, ((j, i), n) in enumerate(zip(candidates, counts)):
+                if used + n + SEPARATOR_TOKENS <= budget:
+                    keep[(j, i)] = lists[j][i]
+                    used += n + SEPARATOR_TOKENS
+                    continue
+                stop = k
+                room = budget - used - SEPARATOR_TOKENS
+                if truncate_last and room > 0 and isinstance(lists[j][i], str):
+                    keep[(j, i)] = tokens.decode(tokens.encode(lists[j][i], encoding)[:room], encoding)
+                break
+
+            # token counts are not exactly additive across element boundaries; check the result,
+            # adding elements the estimate left out while they still fit, or dropping elements until it fits
+            prompt = render(keep)
+            if len(keep) == stop:
+                for c in candidates[stop:]:
+                    keep[c] = lists[c[0]][c[1]]
+                    grown = render(keep)
+                    if llm.max_tokens_for_prompt(grown) < response_tokens:
+                        keep.popitem()
+                        break
+                    prompt = grown
+            while keep and llm.max_tokens_for_prompt(prompt) < response_tokens:
+                keep.popitem()
+                prompt = render(keep)
+            return prompt
         return f_prompt  # true decorator
     return deco_prompt
-
@@ -0,0 +1,138 @@
+"""
+Persistent embedding cache
+Copyright (C) 2023 Jiggy AI
+
+Embeddings are cached in a local sqlite database keyed by a hash of the model
+name and the text as it is embedded, so role names, repeated questions and
+re-ingested memos are only embedded once across restarts.  Vectors are stored
+as raw float32 blobs.  The database runs in WAL mode with a busy timeout so
+several bot processes can share it.  When the live data exceeds max_bytes the
+least recently used tenth of the entries is deleted.  The last use of an entry
+is only written back when it is older than a refresh interval, so lookups of
+hot entries are plain reads.
+
+Configuration:
+JINGBOT_EMBCACHE_DB            path of the sqlite database
+JINGBOT_EMBCACHE_MAX_BYTES     approximate maximum size of the cached embeddings
+JINGBOT_EMBCACHE_TOUCH_SECONDS refresh the last use of an entry when it is older than this
+"""
+from loguru import logger
+import os
+import sqlite3
+from hashlib import blake2b
+from threading import Lock
+from time import time
+from typing import List, Optional, Tuple
+import numpy as np
+
+import metrics
+
+
+EMBCACHE_DB        = os.environ.get('JINGBOT_EMBCACHE_DB', 'embeddings.db')
+EMBCACHE_MAX_BYTES = int(os.environ.get('JINGBOT_EMBCACHE_MAX_BYTES', 1024*1024*1024))
+EMBCACHE_TOUCH_SECONDS = float(os.environ.get('JINGBOT_EMBCACHE_TOUCH_SECONDS', 3600))
+
+EVICT_FRACTION = 0.1     # fraction of the entries deleted when the cache is over size
+CHECK_INTERVAL = 1000    # check the cache size after this many stored entries
+
+
+def cache_key(model : str, text : str) -> bytes:
+    return blake2b(f'{model}\0{text}'.encode('utf-8', errors='surrogatepass'), digest_size=16).digest()
+
+
+class EmbeddingCache:
+    """
+    (model, text) -> (float32 vector, token count) cache in sqlite
+    """
+
+    def __init__(self, path : str = EMBCACHE_DB, max_bytes : int = EMBCACHE_MAX_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._stored = 0
+        self._lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS embedding (key BLOB PRIMARY KEY, vector BLOB NOT NULL, tokens INTEGER NOT NULL, used_at REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS embedding_used_at ON embedding (used_at)")
+
+    def get_batch(self, model : str, texts : List[str]) -> List[Optional[Tuple[np.ndarray, int]]]:
+        """
+        return the cached (vector, tokens) of each of the texts embedded by model, or None for a miss
+        """
+        keys = [cache_key(model, text) for text in texts]
+        found = {}
+        now = time()
+        stale = []     # found keys whose last use is to be refreshed
+        with self._lock:
+            for i in range(0, len(keys), 500):   # stay under sqlite's limit on query parameters
+                chunk = list(set(keys[i:i+500]))
+                rows = self.db.execute(f"SELECT key, vector, tokens, used_at FROM embedding WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                for key, vector, tokens, used_at in rows:
+                    found[key] = (np.frombuffer(vector, dtype=np.float32), tokens)
+                    if now - used_at > EMBCACHE_TOUCH_SECONDS:
+                        stale.append((now, key))
+            if stale:
+                self.db.executemany("UPDATE embedding SET used_at = ? WHERE key = ?", stale)
+            hits = sum(key in found for key in keys)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        metrics.cache_lookup('embedding', hits, len(keys) - hits)
+        return [found.get(key) for key in keys]
+
+    def put_batch(self, model : str, texts : List[str], vectors : List[np.ndarray], tokens : List[int]) -> None:
+        """
+        cache the vectors and token counts of the texts embedded by model.
+        a failed write is rolled back and logged; the texts are then not cached
+        """
+        now = time()
+        rows = [(cache_key(model, text), np.asarray(v, dtype=np.float32).tobytes(), n, now) for text, v, n in zip(texts, vectors, tokens)]
+        with self._lock:
+            try:
+                self.db.execute("BEGIN")
+                self.db.executemany("INSERT OR REPLACE INTO embedding (key, vector, tokens, used_at) VALUES (?, ?, ?, ?)", rows)
+                self.db.execute("COMMIT")
+            except sqlite3.Error as e:
+                # the embeddings are still returned to the caller; they are just not cached this time
+                if self.db.in_transaction:
+                    self.db.execute("ROLLBACK")
+                logger.warning(f"embedding cache failed to store {len(rows)} entries: {e}")
+                return
+            self._stored += len(rows)
+            if self._stored >= CHECK_INTERVAL:
+                self._stored = 0
+                self._evict()
+
+    def nbytes(self) -> int:
+        """
+        return the bytes used by live data in the database
+        """
+        page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+        page_count = self.db.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = self.db.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    def _evict(self) -> None:
+        # delete the least recently used entries while over size; freed pages are reused by later inserts
+        while self.nbytes() > self.max_bytes:
+            count = self.db.execute("SELECT count(*) FROM embedding").fetchone()[0]
+            n = max(1, int(count * EVICT_FRACTION))
+            self.db.execute("DELETE FROM embedding WHERE key IN (SELECT key FROM embedding ORDER BY used_at LIMIT ?)", (n,))
+            self.evictions += n
+            logger.info(f"embedding cache evicted {n} entries: {self.stats()}")
+            if n == count:
+                break
+
+    def stats(self) -> dict:
+        """
+        return entry count, size and hit rate
+        """
+        lookups = self.hits + self.misses
+        return {'entries':   self.db.execute("SELECT count(*) FROM embedding").fetchone()[0],
+                'bytes':     self.nbytes(),
+                'hits':      self.hits,
+                'misses':    self.misses,
+                'hit_rate':  self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions}
@@ -2,10 +2,44 @@
 Base class for an embedding model (e.g. ada002)
 """
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, validator
+import numpy as np
 import enum
 
 
+VECTOR_DTYPES = ('float32', 'float16', 'int8')
+
+
+def encode_vector(vector : np.ndarray, dtype : str = 'float32') -> bytes:
+    """
+    return the vector as bytes in the storage dtype: float32, float16 (half the size)
+    or int8 (a quarter of the size plus a float32 scale, symmetric per-vector quantization)
+    """
+    vector = np.asarray(vector, dtype=np.float32)
+    if dtype == 'float32':
+        return vector.tobytes()
+    if dtype == 'float16':
+        return vector.astype(np.float16).tobytes()
+    if dtype == 'int8':
+        scale = np.float32(np.abs(vector).max() / 127 or 1)
+        return scale.tobytes() + np.round(vector / scale).astype(np.int8).tobytes()
+    raise ValueError(f"unsupported vector dtype {dtype}")
+
+
+def decode_vector(data : bytes, dtype : str = 'float32') -> np.ndarray:
+    """
+    return the float32 vector encoded by encode_vector.  float32 data is a zero-copy read-only view of data.
+    """
+    if dtype == 'float32':
+        return np.frombuffer(data, dtype=np.float32)
+    if dtype == 'float16':
+        return np.frombuffer(data, dtype=np.float16).astype(np.float32)
+    if dtype == 'int8':
+        scale = np.frombuffer(data, dtype=np.float32, count=1)[0]
+        return np.frombuffer(data, dtype=np.int8, offset=4).astype(np.float32) * scale
+    raise ValueError(f"unsupported vector dtype {dtype}")
+
+
 class EmbeddingModelName(str, enum.Enum):
     """
     List of supported embedding models
@@ -21,9 +55,31 @@ class ModelEmbedding(BaseModel):
     text:         str
     tokens:       int
     gpt2_tokens:  int
-    vector:       list[float]
+    vector:       np.ndarray     # contiguous float32
     model:        EmbeddingModelName
 
+    class Config:
+        arbitrary_types_allowed = True
+        json_encoders = {np.ndarray: lambda v: v.tolist()}
+
+    @validator('vector', pre=True)
+    def float32_vector(cls, v) -> np.ndarray:
+        # no copy if v is already a contiguous float32 array
+        return np.ascontiguousarray(v, dtype=np.float32)
+
+    def to_bytes(self, dtype : str = 'float32') -> bytes:
+        """
+        return the vector as bytes in the storage dtype (see encode_vector)
+        """
+        return encode_vector(self.vector, dtype)
+
+    @staticmethod
+    def vector_from_bytes(data : bytes, dtype : str = 'float32') -> np.ndarray:
+        """
+        return the float32 vector from bytes returned by to_bytes
+        """
+        return decode_vector(data, dtype)
+
 
 class MaxTokenExceededException(Exception):
     """
@@ -0,0 +1,76 @@
+"""
+Local stand-in for the HF inference endpoint
+Copyright (C) 2023 Jiggy AI
+
+Serves the same API as the sentence transformer inference endpoint used by
+st.py: POST {"inputs": text or [texts]} returns {"embeddings": vector or
+[vectors]}.  Embeddings come from a local SentenceTransformer, or with --dim
+from a deterministic hash of the text so no model download is needed.  A fixed
+per-request and per-input latency can be added to mimic the real endpoint when
+testing batch sizing.
+
+usage:
+    python hf_standin.py [--port 8080] [--model M | --dim 768] [--latency 0.05] [--input-latency 0.002]
+    HF_INFERENCE_ENDPOINT=http://localhost:8080 HF_API_TOKEN=x python ...
+"""
+from loguru import logger
+import sys
+import asyncio
+import argparse
+from hashlib import blake2b
+import numpy as np
+from aiohttp import web
+
+
+def hash_embedding(text : str, dim : int) -> list[float]:
+    """
+    return a deterministic normalized pseudo-embedding of text
+    """
+    seed = int.from_bytes(blake2b(text.encode(), digest_size=8).digest(), 'little')
+    v = np.random.default_rng(seed).standard_normal(dim)
+    return (v / np.linalg.norm(v)).tolist()
+
+
+def make_app(args) -> web.Application:
+    if args.dim:
+        encode = lambda texts: [hash_embedding(t, args.dim) for t in texts]
+    else:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(args.model)
+        encode = lambda texts: model.encode(texts).tolist()
+
+    stats = {'requests': 0, 'inputs': 0}
+
+    async def embed(request):
+        body = await request.json()
+        inputs = body['inputs']
+        texts = inputs if isinstance(inputs, list) else [inputs]
+        stats['requests'] += 1
+        stats['inputs'] += len(texts)
+        await asyncio.sleep(args.latency + args.input_latency * len(texts))
+        vectors = await asyncio.to_thread(encode, texts)
+        return web.json_response({'embeddings': vectors if isinstance(inputs, list) else vectors[0]})
+
+    async def get_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application(client_max_size=64*1024*1024)
+    app.router.add_post('/', embed)
+    app.router.add_get('/stats', get_stats)
+    return app
+
+
+def main(argv) -> None:
+    parser = argparse.ArgumentParser(description="local stand-in for the HF inference endpoint")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--model', default='multi-qa-mpnet-base-cos-v1')
+    parser.add_argument('--dim', type=int, default=0, help="serve hash embeddings of this dimension instead of a model")
+    parser.add_argument('--latency', type=float, default=0.0, help="added seconds per request")
+    parser.add_argument('--input-latency', type=float, default=0.0, help="added seconds per input text")
+    args = parser.parse_args(argv)
+    logger.info(f"hf stand-in on port {args.port}")
+    web.run_app(make_app(args), port=args.port)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,160 @@
+"""
+Lazy heavy resources
+Copyright (C) 2023 Jiggy AI
+
+Models, embedding matrices and indexes are wrapped in Lazy so importing a
+module is cheap and the bot can start polling within seconds.  A resource is
+loaded on first use, or in the background by warm() once the bot is running.
+Code that can do without a resource (e.g. a cache) checks .ready or calls
+.start() instead of blocking on the load.
+
+Every resource records how long it took to load, so report() gives a per
+component startup profile.
+
+Configuration:
+JINGBOT_WARM_WORKERS   number of resources loaded in parallel by warm()
+"""
+from loguru import logger
+import os
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock, Event
+from time import monotonic
+from typing import Callable, Dict, Generic, List, Optional, TypeVar
+
+
+WARM_WORKERS = int(os.environ.get('JINGBOT_WARM_WORKERS', 2))
+
+STARTED_AT = monotonic()    # approximately process start; the bot entry points import lazy first
+
+T = TypeVar('T')
+
+resources = {}    # name -> Lazy, in registration order
+
+warm_pool = ThreadPoolExecutor(max_workers=WARM_WORKERS, thread_name_prefix='warm')
+
+
+class Lazy(Generic[T]):
+    """
+    a named resource created by factory on first call
+    """
+
+    def __init__(self, name : str, factory : Callable[[], T]) -> None:
+        self.name = name
+        self.factory = factory
+        self.error = None
+        self.started_at = None     # seconds since process start when loading started
+        self.seconds = None        # load time in seconds
+        self._value = None
+        self._future = None
+        self._lock = Lock()          # held while loading
+        self._start_lock = Lock()
+        self._ready = Event()
+        resources[name] = self
+
+    def __call__(self) -> T:
+        """
+        return the resource, loading it in this thread if it is not loaded yet
+        """
+        if self._ready.is_set():
+            return self._value
+        with self._lock:
+            if not self._ready.is_set():
+                self.error = None
+                self.started_at = monotonic() - STARTED_AT
+                t0 = monotonic()
+                try:
+                    self._value = self.factory()
+                except Exception as e:
+                    self.error = e
+                    logger.exception(f"{self.name} failed to load")
+                    raise
+                self.seconds = monotonic() - t0
+                self._ready.set()
+                logger.info(f"{self.name} ready in {self.seconds:.2f} s")
+        return self._value
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    @property
+    def state(self) -> str:
+        if self.ready:
+            return 'ready'
+        if self.error is not None:
+            return 'failed'
+        if self.started_at is not None or (self._future and not self._future.done()):
+            return 'loading'
+        return 'pending'
+
+    def wait(self, timeout : Optional[float] = None) -> bool:
+        """
+        wait until the resource is loaded; return False on timeout
+        """
+        return self._ready.wait(timeout)
+
+    def start(self) -> Future:
+        """
+        start loading the resource in the background if it is not loaded or loading
+        """
+        with self._start_lock:
+            if self._future is None or (self._future.done() and not self.ready):
+                self._future = warm_pool.submit(self._warm)
+            return self._future
+
+    def _warm(self) -> None:
+        try:
+            self()
+        except Exception:
+            pass    # logged and recorded in self.error
+
+
+def warm(names : Optional[List[str]] = None) -> List[Future]:
+    """
+    start loading the named resources (default all) in the background, logging the report when all are done
+    """
+    futures = [resources[name].start() for name in (names or list(resources))]
+    remaining = [len(futures)]
+    lock = Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                log_report()
+
+    for future in futures:
+        future.add_done_callback(done)
+    return futures
+
+
+def ready(names : Optional[List[str]] = None) -> bool:
+    """
+    return True if the named resources (default all) are loaded
+    """
+    return all(resources[name].ready for name in (names or list(resources)))
+
+
+def report() -> Dict[str, dict]:
+    """
+    return the state, load start (seconds since process start) and load time of every resource
+    """
+    return {name: {'state':   r.state,
+                   'started': None if r.started_at is None else round(r.started_at, 3),
+                   'seconds': None if r.seconds is None else round(r.seconds, 3),
+                   'error':   None if r.error is None else str(r.error)} for name, r in resources.items()}
+
+
+def uptime() -> float:
+    """
+    return the seconds since process start
+    """
+    return monotonic() - STARTED_AT
+
+
+def log_report() -> None:
+    logger.info(f"startup profile after {uptime():.2f} s:")
+    for name, r in report().items():
+        started = '-' if r['started'] is None else f"{r['started']:.2f}"
+        seconds = '-' if r['seconds'] is None else f"{r['seconds']:.2f}"
+        logger.info(f"  {name:<20} {r['state']:<8} started {started:>7} s  load {seconds:>7} s")
@@ -0,0 +1,192 @@
+"""
+Concurrent chat load test of chatbot.py
+Copyright (C) 2023 Jiggy AI
+
+Simulates N Telegram users chatting with chatbot.message in one process, with
+completions streamed by openai_standin.py (started as a subprocess) and the
+HF endpoint served by hf_standin.  Telegram is a recording fake bot, but the
+bot's own edit rate limits stay in force, so the measured edit rate is what
+Telegram would see.
+
+Reports:
+  time to first token  placeholder message sent -> first edit with reply text
+  edit rate            message edits per second, overall and per chat
+  event loop lag       overshoot of a 10 ms sleep in the bot's event loop
+  memory per session   process RSS growth and session store bytes per chat session
+
+usage:
+    python loadtest.py [--users 100] [--messages 5] [--think 2.0] [--ramp 5.0] [--out loadtest.json]
+                       [--streams streams.jsonl] [--speed 1.0] [--error-rate 0.02] [--ttft 0.5] [--token-interval 0.03]
+"""
+from loguru import logger
+import os
+import sys
+import json
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+from time import perf_counter, sleep
+from types import SimpleNamespace
+import numpy as np
+
+import bench
+
+
+def rss() -> int:
+    """
+    return the resident set size of this process in bytes
+    """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def percentiles(values) -> dict:
+    if not values:
+        return {}
+    return {'n':    len(values),
+            'mean': float(np.mean(values)),
+            'p50':  float(np.percentile(values, 50)),
+            'p95':  float(np.percentile(values, 95)),
+            'p99':  float(np.percentile(values, 99)),
+            'max':  float(np.max(values))}
+
+
+class RecordingBot(bench.FakeBot):
+    """
+    fake telegram bot recording the time of every edit of every placeholder message
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.placeholder_at = {}    # message_id -> time the placeholder was sent
+        self.first_edit = {}        # message_id -> time of its first edit
+        self.edit_times = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        message = await super().send_message(chat_id, text, **kwargs)
+        if text == "...":
+            self.placeholder_at[message.message_id] = perf_counter()
+        return message
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await super().edit_message_text(text, chat_id=chat_id, message_id=message_id, **kwargs)
+        now = perf_counter()
+        self.edit_times.append(now)
+        self.first_edit.setdefault(message_id, now)
+
+
+async def monitor_loop_lag(lags : list, interval : float = 0.01) -> None:
+    while True:
+        t0 = perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(perf_counter() - t0 - interval)
+
+
+async def user(chatbot, bot, chat_id : int, args, errors : list) -> None:
+    await asyncio.sleep(random.uniform(0, args.ramp))
+    for _ in range(args.messages):
+        message = bench.FakeMessage(bot, chat_id, 0, bench.words(random.randint(5, 40)))
+        try:
+            await chatbot.message(SimpleNamespace(message=message), SimpleNamespace(bot=bot))
+        except Exception as e:
+            errors.append(repr(e))
+        await asyncio.sleep(random.expovariate(1 / args.think) if args.think else 0)
+
+
+async def run(args) -> dict:
+    import chatbot
+    bot = RecordingBot()
+    lags, errors = [], []
+    monitor = asyncio.create_task(monitor_loop_lag(lags))
+    rss0 = rss()
+    t0 = perf_counter()
+    await asyncio.gather(*[user(chatbot, bot, 1000 + i, args, errors) for i in range(args.users)])
+    duration = perf_counter() - t0
+    monitor.cancel()
+
+    sessions = chatbot.chat_id_to_context.stats()
+    ttft = [bot.first_edit[i] - t for i, t in bot.placeholder_at.items() if i in bot.first_edit]
+    return {'users':               args.users,
+            'messages':            args.users * args.messages,
+            'errors':              len(errors),
+            'error_samples':       errors[:5],
+            'seconds':             duration,
+            'ttft':                percentiles(ttft),
+            'unanswered':          len(bot.placeholder_at) - len(ttft),
+            'edits':               bot.edits,
+            'edits_per_second':    bot.edits / duration,
+            'edits_per_chat_per_second': bot.edits / duration / args.users,
+            'loop_lag':            percentiles(lags),
+            'rss_growth':          rss() - rss0,
+            'rss_per_session':     (rss() - rss0) / max(1, sessions['sessions']),
+            'session_bytes_per_session': sessions['bytes'] / max(1, sessions['sessions']),
+            'sessions':            sessions}
+
+
+def start_openai_standin(args) -> subprocess.Popen:
+    """
+    start openai_standin.py in its own process so it does not compete with the bot for the GIL
+    """
+    port = bench.free_port()
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'openai_standin.py'), 'serve',
+           '--port', str(port), '--speed', str(args.speed), '--error-rate', str(args.error_rate),
+           '--ttft', str(args.ttft), '--token-interval', str(args.token_interval), '--tokens', str(args.tokens)]
+    if args.streams:
+        cmd += ['--streams', args.streams]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f'{url}/stats').close()
+            break
+        except OSError:
+            sleep(0.1)
+    else:
+        proc.kill()
+        raise RuntimeError("openai stand-in did not start")
+    os.environ['OPENAI_API_BASE'] = f'{url}/v1'
+    return proc
+
+
+def main(argv) -> None:
+    parser = argparse.ArgumentParser(description="concurrent chat load test of chatbot.py")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=5, help="messages sent by each user")
+    parser.add_argument('--think', type=float, default=2.0, help="mean seconds between a reply and the user's next message")
+    parser.add_argument('--ramp', type=float, default=5.0, help="users start uniformly over this many seconds")
+    parser.add_argument('--out', default='loadtest.json')
+    parser.add_argument('--streams', default=None, help="recorded streams for the openai stand-in")
+    parser.add_argument('--speed', type=float, default=1.0)
+    parser.add_argument('--error-rate', type=float, default=0.02)
+    parser.add_argument('--ttft', type=float, default=0.5)
+    parser.add_argument('--token-interval', type=float, default=0.03)
+    parser.add_argument('--tokens', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix='jingbot-loadtest-')
+    bench.start_hf_standin(bench.configure_env(tmp, unthrottled=False))
+    standin = start_openai_standin(args)
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+    try:
+        results = asyncio.run(run(args))
+        with urllib.request.urlopen(os.environ['OPENAI_API_BASE'][:-len('/v1')] + '/stats') as r:
+            results['openai_standin'] = json.load(r)
+    finally:
+        standin.terminate()
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    ttft, lag = results['ttft'], results['loop_lag']
+    print(f"{results['users']} users, {results['messages']} messages in {results['seconds']:.1f} s, {results['errors']} errors\n"
+          f"ttft            p50 {ttft.get('p50', 0):.3f} s  p95 {ttft.get('p95', 0):.3f} s  p99 {ttft.get('p99', 0):.3f} s\n"
+          f"edits           {results['edits_per_second']:.1f}/s  ({results['edits_per_chat_per_second']:.3f}/s per chat)\n"
+          f"loop lag        p50 {lag.get('p50', 0)*1000:.1f} ms  p99 {lag.get('p99', 0)*1000:.1f} ms  max {lag.get('max', 0)*1000:.1f} ms\n"
+          f"memory          {results['rss_per_session']/1024:.1f} KiB rss, {results['session_bytes_per_session']/1024:.1f} KiB text per session",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
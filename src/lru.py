@@ -0,0 +1,53 @@
+"""
+Simple in-memory LRU cache
+Copyright (C) 2023 Jiggy AI
+"""
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    """
+    thread safe least recently used cache holding up to maxsize items
+    """
+
+    def __init__(self, maxsize : int = 1024) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """
+        return the value for key, marking it most recently used
+        """
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value) -> None:
+        """
+        insert or replace the value for key, evicting the least recently used item if full
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def __contains__(self, key) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -0,0 +1,176 @@
+"""
+Map-reduce summarization of long texts
+Copyright (C) 2023 Jiggy AI
+
+The text is tokenized once and split into chunks of at most chunk_tokens tokens,
+preferring paragraph, then line, then sentence boundaries. The chunks are
+summarized concurrently (map) and the section summaries are then combined into
+the final summary (reduce); sections whose summary failed are left out and the
+summary notes how many.  The summary is streamed back in the same
+("not_finished", text) / ("finished", text) form as ChatContext.user_message_stream
+so it can be delivered through the same edit-in-place path.
+
+Configuration:
+JINGBOT_SUMMARY_MODEL  chat model used for the map and reduce completions
+"""
+from loguru import logger
+import os
+import re
+import asyncio
+from bisect import bisect_right
+from itertools import accumulate
+from typing import List, AsyncIterator, Tuple
+import openai
+import tokens
+from retry import retry
+
+
+SUMMARY_MODEL      = os.environ.get('JINGBOT_SUMMARY_MODEL', "gpt-3.5-turbo")
+CHUNK_TOKENS       = int(os.environ.get('JINGBOT_SUMMARY_CHUNK_TOKENS', 2800))     # max input tokens per map or reduce call
+MAP_RESPONSE_TOKENS = 400                                                          # max tokens for each section summary
+REDUCE_RESPONSE_TOKENS = 880                                                       # max tokens for the final summary
+MAP_CONCURRENCY    = int(os.environ.get('JINGBOT_SUMMARY_CONCURRENCY', 8))         # max concurrent map completions
+MAX_CHUNKS         = int(os.environ.get('JINGBOT_SUMMARY_MAX_CHUNKS', 24))         # bound the cost of summarizing huge pages
+
+MAP_PROMPT = "Provide a detailed summary of the following section of a web page. Keep any facts, names, numbers and anything controversial, surprising, unique or clever:\n"
+
+REDUCE_PROMPT = "The following are summaries of consecutive sections of a single web page. "
+
+SECTIONS_FAILED = "sections could not be summarized"    # in the note of a summary that left out failed sections
+
+map_semaphore = asyncio.Semaphore(MAP_CONCURRENCY)
+
+
+# preferred split points in decreasing order of preference
+BOUNDARY_PATTERNS = [re.compile(rb'\n\s*\n'),                 # paragraph
+                     re.compile(rb'\n'),                      # line
+                     re.compile(rb'[.!?]["\')\]]?\s')]        # sentence
+
+
+def _boundary_tokens(text : str, offsets : List[int]) -> List[List[int]]:
+    """
+    return for each BOUNDARY_PATTERN the sorted token indices at which the text may be split.
+    offsets[k] is the byte offset of the end of token k-1 (offsets[0] == 0)
+    """
+    data = text.encode('utf-8')
+    boundaries = []
+    for pattern in BOUNDARY_PATTERNS:
+        indices = set()
+        for match in pattern.finditer(data):
+            # split at the last token boundary at or before the end of the match
+            indices.add(bisect_right(offsets, match.end()) - 1)
+        boundaries.append(sorted(indices))
+    return boundaries
+
+
+def split_tokens(text : str, chunk_tokens : int = CHUNK_TOKENS) -> List[List[int]]:
+    """
+    tokenize text once and return a list of token lists of at most chunk_tokens tokens each,
+    split on paragraph, line or sentence boundaries where possible
+    """
+    toks = tokens.encode(text)
+    if len(toks) <= chunk_tokens:
+        return [toks]
+    offsets = [0] + list(accumulate(len(b) for b in tokens.get_encoding().decode_tokens_bytes(toks)))
+    boundaries = _boundary_tokens(text, offsets)
+    chunks = []
+    start = 0
+    while start < len(toks):
+        limit = start + chunk_tokens
+        if limit >= len(toks):
+            chunks.append(toks[start:])
+            break
+        end = limit
+        # prefer the last boundary in the back half of the chunk
+        for indices in boundaries:
+            i = bisect_right(indices, limit) - 1
+            if i >= 0 and indices[i] > start + chunk_tokens // 2:
+                end = indices[i]
+                break
+        chunks.append(toks[start:end])
+        start = end
+    return chunks
+
+
+def split_text(text : str, chunk_tokens : int = CHUNK_TOKENS) -> List[str]:
+    """
+    split text into chunks of at most chunk_tokens tokens, split on paragraph, line or sentence boundaries where possible
+    """
+    return [tokens.decode(chunk) for chunk in split_tokens(text, chunk_tokens)]
+
+
+@retry(tries=5, delay=.5, ExceptionToRaise=openai.error.InvalidRequestError, breaker='openai')
+async def _complete(prompt : str, text : str, max_tokens : int) -> str:
+    async with map_semaphore:
+        response = await openai.ChatCompletion.acreate(model=SUMMARY_MODEL,
+                                                       messages=[{"role": "user", "content": prompt + text}],
+                                                       max_tokens=max_tokens,
+                                                       temperature=.2)
+    return response['choices'][0]['message']['content'].strip()
+
+
+@retry(tries=5, delay=.5, ExceptionToRaise=openai.error.InvalidRequestError, breaker='openai')
+async def _complete_stream(prompt : str, text : str, max_tokens : int) -> AsyncIterator[str]:
+    r_gen = await openai.ChatCompletion.acreate(model=SUMMARY_MODEL,
+                                                messages=[{"role": "user", "content": prompt + text}],
+                                                max_tokens=max_tokens,
+                                                temperature=.2,
+                                                stream=True)
+    response = ""
+    async for r_item in r_gen:
+        delta = r_item.choices[0].delta.get('content', '')
+        if delta:
+            response += delta
+            yield response
+
+
+async def map_summaries(chunks : List[str]) -> Tuple[List[str], int]:
+    """
+    summarize the chunks concurrently, returning the section summaries in order and the number of
+    chunks that could not be summarized.  raises the first error if no chunk could be summarized
+    """
+    results = await asyncio.gather(*[_complete(MAP_PROMPT, chunk, MAP_RESPONSE_TOKENS) for chunk in chunks],
+                                   return_exceptions=True)
+    errors = [r for r in results if isinstance(r, BaseException)]
+    for e in errors:
+        logger.warning(f"section summary failed: {e!r}")
+    if len(errors) == len(results):
+        raise errors[0]
+    return [r for r in results if not isinstance(r, BaseException)], len(errors)
+
+
+async def summarize_stream(text : str,
+                           prompt : str,
+                           response_tokens : int = REDUCE_RESPONSE_TOKENS,
+                           truncated : bool = False) -> AsyncIterator[Tuple[str, str]]:
+    """
+    summarize text using prompt for the final summary, yielding ("not_finished", partial_summary)
+    as the final summary streams back and ("finished", summary) at the end.
+    truncated is True if text was cut from a longer text.
+    """
+    chunks = split_text(text)
+    note = ""
+    if len(chunks) > MAX_CHUNKS or truncated:
+        chunks = chunks[:MAX_CHUNKS]
+        if truncated:
+            # the length of the whole text is not known, so the part summarized is not either
+            note = "Only the beginning of the url content processed due to length.\n"
+        else:
+            percent = max(1, int(100*sum(len(chunk) for chunk in chunks)/len(text)))
+            note = f"Only first {percent}% of url content processed due to length.\n"
+    logger.info(f"summarizing {len(chunks)} chunks")
+
+    # map, then keep reducing until the section summaries fit in a single call
+    final_prompt = prompt
+    while len(chunks) > 1:
+        yield "not_finished", note + f"Summarizing {len(chunks)} sections..."
+        summaries, failed = await map_summaries(chunks)
+        if failed:
+            note += f"{failed} of {len(chunks)} {SECTIONS_FAILED}.\n"
+        chunks = split_text("\n\n".join(summaries))
+        final_prompt = REDUCE_PROMPT + prompt
+
+    response = ""
+    async for response in _complete_stream(final_prompt, chunks[0], response_tokens):
+        yield "not_finished", note + response
+    yield "finished", (note + response).strip()
@@ -0,0 +1,212 @@
+"""
+Memo ingestion and per-user similarity search
+Copyright (C) 2023 Jiggy AI
+
+Memos are embedded in batches with embed_batch and written to the Memo and
+Embedding tables one chunk per transaction: memo rows are flushed together to
+get their ids and the embedding rows are then written with a single executemany.
+Works on the sqlite fallback and on postgres through db.engine.
+
+nearest_memos searches an in-process index of each user's memo embeddings: a
+normalized float32 matrix per user, loaded from the Embedding table on the
+user's first search (or by warm()) and extended as memos are ingested.  The
+indexes of the least recently searched users are dropped when more than
+JINGBOT_MEMO_INDEX_USERS are loaded.  A user's index is loaded under that
+user's lock, so loading one user's index does not hold up other users.
+
+init() creates the tables; it is called on first use.
+"""
+from loguru import logger
+import os
+from threading import Lock
+from typing import List, Optional
+import numpy as np
+from pydantic import BaseModel
+from sqlmodel import Session, SQLModel, select
+from sqlalchemy import insert, func
+
+from db import engine
+from lru import LRUCache
+from models import Memo, Embedding
+from embedding_model import decode_vector
+from st import get_model
+from lazy import Lazy
+
+
+MEMO_MODEL       = os.environ.get('JINGBOT_MEMO_MODEL', 'multi-qa-mpnet-base-cos-v1')
+MEMO_INDEX_USERS = int(os.environ.get('JINGBOT_MEMO_INDEX_USERS', 1000))
+MEMO_DTYPE       = os.environ.get('JINGBOT_MEMO_DTYPE', 'float32')    # storage dtype of memo embeddings
+
+INGEST_CHUNK = 256     # memos embedded and written per transaction
+
+
+class MemoMatch(BaseModel):
+    memo_id:  int
+    text:     str
+    score:    float
+
+
+class UserIndex:
+    """
+    normalized float32 embeddings of one user's memos.
+    add only writes rows past n or into new arrays, so a search works on a snapshot of (ids, vectors, n)
+    taken under the index lock and does not block adds while it computes
+    """
+
+    def __init__(self, dim : int) -> None:
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.n = 0
+        self._lock = Lock()
+
+    def add(self, ids : List[int], vectors : np.ndarray) -> None:
+        with self._lock:
+            # skip memos already loaded from the table, e.g. when the index was loaded during an ingest
+            new = ~np.isin(ids, self.ids[:self.n])
+            ids = np.asarray(ids)[new]
+            vectors = vectors[new] / np.maximum(np.linalg.norm(vectors[new], axis=1, keepdims=True), 1e-12)
+            # grow capacity geometrically so repeated adds are amortized O(1) per memo
+            if self.n + len(ids) > len(self.ids):
+                capacity = max(16, 2 * (self.n + len(ids)))
+                self.ids = np.resize(self.ids, capacity)
+                self.vectors = np.resize(self.vectors, (capacity, self.vectors.shape[1]))
+            self.ids[self.n:self.n + len(ids)] = ids
+            self.vectors[self.n:self.n + len(ids)] = vectors
+            self.n += len(ids)
+
+    def search(self, q : np.ndarray, k : int):
+        with self._lock:
+            ids, vectors, n = self.ids, self.vectors, self.n
+        sims = vectors[:n] @ (q / np.linalg.norm(q))
+        k = min(k, n)
+        if not k:
+            return [], []
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top])]
+        return ids[top].tolist(), sims[top].tolist()
+
+
+embedder = Lazy('memo_model', lambda: get_model(MEMO_MODEL))
+
+indexes = LRUCache(MEMO_INDEX_USERS)    # user_id -> UserIndex
+user_locks = {}                         # user_id -> Lock held while the user's index is loaded or extended
+indexes_lock = Lock()                   # guards indexes and user_locks only
+
+_initialized = False
+_init_lock = Lock()
+
+
+def init() -> None:
+    """
+    create the memo tables if they do not exist
+    """
+    global _initialized
+    with _init_lock:
+        if not _initialized:
+            SQLModel.metadata.create_all(engine)
+            _initialized = True
+
+
+def user_lock(user_id : int) -> Lock:
+    """
+    return the lock of the user's memo index
+    """
+    with indexes_lock:
+        return user_locks.setdefault(user_id, Lock())
+
+
+def _load_index(user_id : int) -> UserIndex:
+    # build the user's index from the Embedding table
+    index = UserIndex(embedder().dim())
+    with Session(engine) as session:
+        rows = session.exec(select(Embedding.memo_id, Embedding.dtype, Embedding.vector)
+                            .where(Embedding.user_id == user_id)
+                            .where(Embedding.model == MEMO_MODEL)
+                            .where(Embedding.memo_id != None)
+                            .order_by(Embedding.id)).all()
+    if rows:
+        index.add([r[0] for r in rows], np.stack([decode_vector(r[2], r[1]) for r in rows]))
+    logger.info(f"loaded memo index for user {user_id}: {index.n} memos")
+    return index
+
+
+def user_index(user_id : int) -> UserIndex:
+    """
+    return the user's memo index, loading it from the database if needed
+    """
+    with indexes_lock:
+        index = indexes.get(user_id)
+    if index is not None:
+        return index
+    init()
+    with user_lock(user_id):
+        with indexes_lock:
+            index = indexes.get(user_id)
+        if index is None:
+            index = _load_index(user_id)
+            with indexes_lock:
+                indexes.put(user_id, index)
+    return index
+
+
+def warm(user_ids : Optional[List[int]] = None) -> None:
+    """
+    load the memo indexes of the users (by default the users with the most memos) before they are searched
+    """
+    init()
+    if user_ids is None:
+        with Session(engine) as session:
+            user_ids = session.exec(select(Embedding.user_id)
+                                    .where(Embedding.model == MEMO_MODEL)
+                                    .where(Embedding.memo_id != None)
+                                    .group_by(Embedding.user_id)
+                                    .order_by(func.count().desc())
+                                    .limit(MEMO_INDEX_USERS)).all()
+    for user_id in user_ids:
+        user_index(user_id)
+
+
+def ingest_memos(user_id : int, texts : List[str]) -> List[int]:
+    """
+    embed and store the user's memos, returning their memo ids
+    """
+    init()
+    texts = [text for text in texts if text and not text.isspace()]
+    memo_ids = []
+    for i in range(0, len(texts), INGEST_CHUNK):
+        chunk = texts[i:i+INGEST_CHUNK]
+        embeddings = embedder().embed_batch(chunk)
+        with Session(engine) as session:
+            memos = [Memo(user_id=user_id, text=text) for text in chunk]
+            session.add_all(memos)
+            session.flush()    # assigns the memo ids
+            ids = [memo.id for memo in memos]
+            session.execute(insert(Embedding.__table__),
+                            [{'user_id': user_id,
+                              'memo_id': memo_id,
+                              'model':   MEMO_MODEL,
+                              'dtype':   MEMO_DTYPE,
+                              'vector':  e.to_bytes(MEMO_DTYPE)} for memo_id, e in zip(ids, embeddings)])
+            session.commit()
+        # an index being loaded is extended once loaded; one loaded after the commit already has the memos
+        with user_lock(user_id):
+            with indexes_lock:
+                index = indexes.get(user_id)
+            if index is not None:
+                index.add(ids, np.stack([e.vector for e in embeddings]))
+        memo_ids += ids
+    logger.info(f"ingested {len(memo_ids)} memos for user {user_id}")
+    return memo_ids
+
+
+def nearest_memos(user_id : int, query : str, k : int = 5) -> List[MemoMatch]:
+    """
+    return the user's k memos most similar to the query, best first
+    """
+    q = embedder().embed(query).vector
+    ids, scores = user_index(user_id).search(q, k)
+    if not ids:
+        return []
+    with Session(engine) as session:
+        texts = dict(session.exec(select(Memo.id, Memo.text).where(Memo.id.in_(ids))).all())
+    return [MemoMatch(memo_id=i, text=texts[i], score=s) for i, s in zip(ids, scores) if i in texts]
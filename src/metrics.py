@@ -0,0 +1,154 @@
+"""
+Metrics and tracing
+Copyright (C) 2023 Jiggy AI
+
+Prometheus metrics for every stage of a request, served on /metrics by
+start().  A stage is timed with the span() context manager; spans opened while
+another span is active (in the same task, or in a thread started with
+asyncio.to_thread) become its children, and when the outermost span of a
+request ends the whole tree is logged on one line, e.g.
+
+    trace 3f2a9c0e1b7d4a65 message 4.210 s [stream_reply 4.180 s edits=9 [search 0.612 s, completion 3.402 s]]
+
+Stages that cannot be wrapped in a span, such as a completion streamed from an
+async generator, are timed by the caller and recorded with observe().
+
+Configuration:
+JINGBOT_METRICS_PORT   port of the Prometheus /metrics endpoint; 0 disables it.  Give each bot
+                       process its own port: a process that finds the port taken runs without it.
+"""
+from loguru import logger
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Callable, List, Optional, TypeVar
+from uuid import uuid4
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+
+F = TypeVar('F')
+
+METRICS_PORT = int(os.environ.get('JINGBOT_METRICS_PORT', 9464))
+
+SECONDS_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+STAGE_SECONDS = Histogram('jingbot_stage_seconds', "time spent in a request stage", ['stage'], buckets=SECONDS_BUCKETS)
+STAGE_ERRORS  = Counter('jingbot_stage_errors', "request stages that raised an exception", ['stage'])
+TOKENS        = Counter('jingbot_completion_tokens', "tokens sent to and received from completion models", ['model', 'direction'])
+TTFT          = Histogram('jingbot_time_to_first_token_seconds', "seconds from completion request to first streamed token", ['model'], buckets=SECONDS_BUCKETS)
+CACHE_LOOKUPS = Counter('jingbot_cache_lookups', "cache lookups by result (hit or miss)", ['cache', 'result'])
+EDITS         = Counter('jingbot_message_edits', "telegram message edits of streamed replies by result", ['result'])
+QUEUE_DEPTH   = Gauge('jingbot_queue_depth', "work submitted to a queue or pool and not finished", ['queue'])
+
+
+class Span:
+    """
+    a timed stage of a request
+    """
+
+    def __init__(self, name : str, parent : Optional['Span'] = None) -> None:
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent else uuid4().hex[:16]
+        self.children : List[Span] = []
+        self.attrs = {}
+        self.seconds = None
+        self.start = perf_counter()
+
+    def end(self) -> None:
+        self.seconds = perf_counter() - self.start
+        STAGE_SECONDS.labels(self.name).observe(self.seconds)
+        if self.parent:
+            self.parent.children.append(self)
+        else:
+            logger.info(f"trace {self.trace_id} {self}")
+
+    def __str__(self) -> str:
+        s = f"{self.name} {self.seconds:.3f} s"
+        s += ''.join(f" {k}={v}" for k, v in self.attrs.items())
+        if self.children:
+            s += f" [{', '.join(str(child) for child in self.children)}]"
+        return s
+
+
+current_span : ContextVar[Optional[Span]] = ContextVar('current_span', default=None)
+
+
+@contextmanager
+def span(stage : str):
+    """
+    time the stage as a child of the current span, or as the root of a new trace
+    """
+    s = Span(stage, current_span.get())
+    token = current_span.set(s)
+    try:
+        yield s
+    except BaseException:
+        STAGE_ERRORS.labels(stage).inc()
+        s.attrs['error'] = True
+        raise
+    finally:
+        current_span.reset(token)
+        s.end()
+
+
+def observe(stage : str, seconds : float, **attrs) -> None:
+    """
+    record a stage timed by the caller as a child of the current span
+    """
+    s = Span(stage, current_span.get())
+    s.attrs.update(attrs)
+    s.start -= seconds
+    s.end()
+
+
+def completion_tokens(model : str, tokens_in : int, tokens_out : int) -> None:
+    TOKENS.labels(model, 'in').inc(tokens_in)
+    TOKENS.labels(model, 'out').inc(tokens_out)
+
+
+def first_token(model : str, seconds : float) -> None:
+    TTFT.labels(model).observe(seconds)
+
+
+def cache_lookup(cache : str, hits : int, misses : int = 0) -> None:
+    """
+    count cache hits and misses
+    """
+    if hits:
+        CACHE_LOOKUPS.labels(cache, 'hit').inc(hits)
+    if misses:
+        CACHE_LOOKUPS.labels(cache, 'miss').inc(misses)
+
+
+def queue_depth(queue : str, depth : Callable[[], float]) -> None:
+    """
+    export depth() as the depth of the queue when metrics are collected
+    """
+    QUEUE_DEPTH.labels(queue).set_function(depth)
+
+
+def track(queue : str, future : F) -> F:
+    """
+    count the submitted (concurrent or asyncio) future in the depth of the queue until it is done; return the future
+    """
+    gauge = QUEUE_DEPTH.labels(queue)
+    gauge.inc()
+    future.add_done_callback(lambda _: gauge.dec())
+    return future
+
+
+def start(port : int = METRICS_PORT) -> None:
+    """
+    serve the metrics on http://0.0.0.0:port/metrics
+    """
+    if not port:
+        return
+    try:
+        start_http_server(port)
+    except OSError as e:
+        # e.g. another bot in the same container already serves metrics on the port; not a reason to stop the bot
+        logger.warning(f"metrics not served on port {port}: {e}; set JINGBOT_METRICS_PORT per process")
+        return
+    logger.info(f"metrics on port {port}")
@@ -5,18 +5,21 @@
 
 from typing import Optional, List
 from array import array
-from sqlmodel import Field, SQLModel, Column, ARRAY, Float, Enum
+from sqlmodel import Field, SQLModel, Column, Enum, Text, LargeBinary
 from pydantic import  BaseModel, ValidationError, validator
 from pydantic import condecimal
 from time import time
 import enum
+import numpy as np
+
+from embedding_model import decode_vector
 
 
 timestamp = condecimal(max_digits=14, decimal_places=3)  # unix epoch timestamp decimal to millisecond precision
 
 
 
-class TelegramUser(SQLmodel, table=True):
+class TelegramUser(SQLModel, table=True):
     id:             int       = Field(primary_key=True, description='Telegram User ID')
     username:       str       = Field(index=True, description="Telegram username")
     first_name:     str       = Field(description="User's first name")
@@ -27,42 +30,49 @@ class TelegramUser(SQLmodel, table=True):
     created_at:     timestamp = Field(default_factory=time, description='The epoch timestamp when the Evaluation was created.')
 
 
-class TelegramChat(SQLmodel, table=True):
+class TelegramChat(SQLModel, table=True):
     id:             int       = Field(primary_key=True, description='Telegram Chat ID')
     title:          str       = Field(description="Chat title from telegram")
     type:           str       = Field(description="Chat type from telegram")
     created_at:     timestamp = Field(default_factory=time, description='The epoch timestamp when the Evaluation was created.')
 
     
-class URL(SQLmodel, table=True):
-    id:             int       = Field(primary_key=True, description='Unique ID')
-    url:            str       = Field(max_length=2048, description='The actual supplied URL')
-    user_id         int       = Field(index=True, foreign_key='telegramuser.id', description='The user who sent the URL')
-    created_at:     timestamp = Field(default_factory=time, description='The epoch timestamp when this was created.')
+class URL(SQLModel, table=True):
+    id:             Optional[int] = Field(default=None, primary_key=True, description='Unique ID')
+    url:            str           = Field(max_length=2048, description='The actual supplied URL')
+    normalized_url: str           = Field(max_length=2048, index=True, description='The normalized URL used as the cache key')
+    user_id:        Optional[int] = Field(default=None, index=True, foreign_key='telegramuser.id', description='The user who sent the URL')
+    etag:           Optional[str] = Field(default=None, max_length=1024, description='ETag header from the last fetch')
+    last_modified:  Optional[str] = Field(default=None, max_length=256, description='Last-Modified header from the last fetch')
+    content_hash:   Optional[str] = Field(default=None, max_length=64, description='sha256 of the content from the last fetch')
+    created_at:     timestamp     = Field(default_factory=time, description='The epoch timestamp when this was created.')
+    fetched_at:     timestamp     = Field(default_factory=time, description='The epoch timestamp when the url was last fetched or revalidated.')
                                       
                             
 class UrlText(SQLModel, table=True):
-    id:          int           = Field(primary_key=True, description="The text unique id.")
-    url_id:      int           = Field(index=True, foreign_key="url.id", description="The usr this text was extracted from.")
-    mechanism:   str           = Field(description="identifies which software mechanism exracted the text from the url")
-    created_at:  timestamp     = Field(default_factory=time, description='The epoch timestamp when the url was crawled.')
-    text:        str           = Field(max_length=65535, description="The readable text we managed to extract from the Url.")
-    content      Optional[str] = Field(max_length=65535, description="original html content")
-    content_type Optional[str] = Field(description="content type from http")
+    id:           Optional[int] = Field(default=None, primary_key=True, description="The text unique id.")
+    url_id:       int           = Field(index=True, foreign_key="url.id", description="The usr this text was extracted from.")
+    mechanism:    str           = Field(description="identifies which software mechanism exracted the text from the url")
+    created_at:   timestamp     = Field(default_factory=time, description='The epoch timestamp when the url was crawled.')
+    content_hash: str           = Field(max_length=64, index=True, description="sha256 of the content the text was extracted from.")
+    text:         str           = Field(sa_column=Column(Text), description="The readable text we managed to extract from the Url.")
+    content:      Optional[str] = Field(default=None, sa_column=Column(Text), description="original html content")
+    content_type: Optional[str] = Field(default=None, description="content type from http")
 
             
 class UrlSummary(SQLModel, table=True):
-    id:       int = Field(primary_key=True, description="The summary unique id.")
-    text_id:  int = Field(index=True, foreight_key="urltext.id", description="The UrlText used to create the summary.")
-    model:    str = Field(description="The model used to produce this summary.")                                      
-    prefix:   str = Field(max_length=8192, description="The prompt prefix used to create the summary.")
-    summary:  str = Field(max_length=8192, description="The summary we got back from the model.")
+    id:         Optional[int] = Field(default=None, primary_key=True, description="The summary unique id.")
+    text_id:    int           = Field(index=True, foreign_key="urltext.id", description="The UrlText used to create the summary.")
+    model:      str           = Field(description="The model used to produce this summary.")                                      
+    prefix:     str           = Field(max_length=8192, description="The prompt prefix used to create the summary.")
+    summary:    str           = Field(max_length=8192, description="The summary we got back from the model.")
+    created_at: timestamp     = Field(default_factory=time, description='The epoch timestamp when the summary was created.')
                                       
 
 class Memo(SQLModel, table=True):
-    id:       int  = Field(primary_key=True, description='Unique ID')
-    user_id:  int  = Field(index=True, foreign_key='telegramuser.id', description='The user who sent the memo.')
-    text:     str  = Field(max_length=8192, description="The transcribed or translated memo text in english.")
+    id:       Optional[int] = Field(default=None, primary_key=True, description='Unique ID')
+    user_id:  int           = Field(index=True, foreign_key='telegramuser.id', description='The user who sent the memo.')
+    text:     str           = Field(max_length=8192, description="The transcribed or translated memo text in english.")
     
                                       
 class Embedding(SQLModel, table=True):
@@ -74,12 +84,20 @@ class Embedding(SQLModel, table=True):
                                       description='The user ID that generated the embedding')
     memo_id:    Optional[int] = Field(index=True,
                                       foreign_key='memo.id',
-                                      decsription='The memo that produced this embedding.')
+                                      description='The memo that produced this embedding.')
     summary_id: Optional[int] = Field(index=True,
                                       foreign_key='urlsummary.id',
-                                      decsription='The summary that produced this embedding.')
+                                      description='The summary that produced this embedding.')
     model:      str           = Field(description="The model used to produce this embedding.")    
-    vector:     List[float]   = Field(sa_column=Column(ARRAY(Float(24))),
-                                      description='The user-supplied vector element.')
+    dtype:      str           = Field(default='float32',
+                                      description="The storage dtype of the vector: float32, float16 or int8.")
+    vector:     bytes         = Field(sa_column=Column(LargeBinary),
+                                      description='The embedding vector encoded as bytes of dtype.')
+
+    def array(self) -> np.ndarray:
+        """
+        return the embedding vector as a float32 array
+        """
+        return decode_vector(self.vector, self.dtype)
 
     
@@ -0,0 +1,163 @@
+"""
+Local stand-in for the OpenAI chat completion API
+Copyright (C) 2023 Jiggy AI
+
+Serves POST /v1/chat/completions, streaming or not, so the bots can be load
+tested without calling OpenAI.  Completions are replayed from streams recorded
+from the real API with their inter-token timing (record subcommand), or
+synthesized with a fixed first-token latency and token interval when no
+recording is given.  A fraction of the requests can be answered with 429 rate
+limit errors carrying a Retry-After header, as OpenAI does under load.
+
+usage:
+    python openai_standin.py record --out streams.jsonl [--n 20] [--model gpt-3.5-turbo] < questions.txt
+    python openai_standin.py serve [--port 8081] [--streams streams.jsonl] [--speed 1.0]
+                                   [--ttft 0.5] [--token-interval 0.03] [--tokens 200] [--error-rate 0.02]
+    OPENAI_API_BASE=http://localhost:8081/v1 python chatbot.py
+
+A recorded stream is one json line: {"model": ..., "chunks": [[seconds after request, content delta], ...]}
+"""
+from loguru import logger
+import sys
+import json
+import random
+import asyncio
+import argparse
+from time import time, monotonic
+from typing import List, Tuple
+from aiohttp import web
+
+
+WORDS = ("the of and to in is was for on that with as by at from his her which an were are this be had it not "
+         "they have one their first new after city year two also who but has other its time world been people").split()
+
+
+def synthetic_stream(n_tokens : int, ttft : float, token_interval : float) -> List[Tuple[float, str]]:
+    """
+    return n_tokens (seconds after request, delta) chunks with jittered timing
+    """
+    chunks = []
+    t = ttft * random.uniform(0.5, 1.5)
+    for i in range(n_tokens):
+        chunks.append((t, ('' if i == 0 else ' ') + random.choice(WORDS)))
+        t += random.expovariate(1 / token_interval) if token_interval else 0
+    return chunks
+
+
+def load_streams(path : str) -> List[List[Tuple[float, str]]]:
+    with open(path) as f:
+        return [[tuple(c) for c in json.loads(line)['chunks']] for line in f if line.strip()]
+
+
+def chunk(model : str, delta : dict, finish_reason=None) -> bytes:
+    data = {'id':      'chatcmpl-standin',
+            'object':  'chat.completion.chunk',
+            'created': int(time()),
+            'model':   model,
+            'choices': [{'delta': delta, 'index': 0, 'finish_reason': finish_reason}]}
+    return f"data: {json.dumps(data)}\n\n".encode()
+
+
+def make_app(args) -> web.Application:
+    streams = load_streams(args.streams) if args.streams else []
+    stats = {'requests': 0, 'rate_limited': 0, 'streams': 0, 'active': 0, 'max_active': 0}
+
+    def next_stream(max_tokens):
+        if streams:
+            return random.choice(streams)
+        return synthetic_stream(min(args.tokens, max_tokens or args.tokens), args.ttft, args.token_interval)
+
+    async def completions(request):
+        t0 = monotonic()
+        body = await request.json()
+        stats['requests'] += 1
+        if random.random() < args.error_rate:
+            stats['rate_limited'] += 1
+            return web.json_response({'error': {'message': "Rate limit reached for default-gpt-3.5-turbo (stand-in)",
+                                                 'type': 'requests', 'param': None, 'code': None}},
+                                     status=429, headers={'Retry-After': str(args.retry_after)})
+        model = body.get('model', 'gpt-3.5-turbo')
+        chunks = next_stream(body.get('max_tokens'))
+        if not body.get('stream'):
+            await asyncio.sleep(chunks[-1][0] / args.speed if chunks else 0)
+            content = ''.join(delta for _, delta in chunks)
+            return web.json_response({'id':      'chatcmpl-standin',
+                                      'object':  'chat.completion',
+                                      'created': int(time()),
+                                      'model':   model,
+                                      'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                                      'usage':   {'prompt_tokens': 0, 'completion_tokens': len(chunks), 'total_tokens': len(chunks)}})
+        stats['streams'] += 1
+        stats['active'] += 1
+        stats['max_active'] = max(stats['max_active'], stats['active'])
+        try:
+            response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+            await response.prepare(request)
+            await response.write(chunk(model, {'role': 'assistant'}))
+            for offset, delta in chunks:
+                delay = t0 + offset / args.speed - monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await response.write(chunk(model, {'content': delta}))
+            await response.write(chunk(model, {}, 'stop'))
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            return response
+        finally:
+            stats['active'] -= 1
+
+    async def get_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', completions)
+    app.router.add_get('/stats', get_stats)
+    return app
+
+
+async def record(questions : List[str], out : str, model : str) -> None:
+    """
+    stream completions of the questions from OpenAI and append them with their timing to out
+    """
+    import openai
+    with open(out, 'a') as f:
+        for question in questions:
+            t0 = monotonic()
+            chunks = []
+            async for item in await openai.ChatCompletion.acreate(model=model, stream=True,
+                                                                   messages=[{'role': 'user', 'content': question}]):
+                delta = item.choices[0].delta.get('content', '')
+                if delta:
+                    chunks.append((round(monotonic() - t0, 4), delta))
+            f.write(json.dumps({'model': model, 'chunks': chunks}) + '\n')
+            logger.info(f"recorded {len(chunks)} chunks, first after {chunks[0][0] if chunks else 0:.3f} s")
+
+
+def main(argv) -> None:
+    parser = argparse.ArgumentParser(description="local stand-in for the OpenAI chat completion API")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('serve', help="serve recorded or synthetic completions")
+    p.add_argument('--port', type=int, default=8081)
+    p.add_argument('--streams', default=None, help="jsonl file of recorded streams")
+    p.add_argument('--speed', type=float, default=1.0, help="replay speed multiplier")
+    p.add_argument('--ttft', type=float, default=0.5, help="mean seconds to first token of synthetic streams")
+    p.add_argument('--token-interval', type=float, default=0.03, help="mean seconds between tokens of synthetic streams")
+    p.add_argument('--tokens', type=int, default=200, help="tokens per synthetic stream")
+    p.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with 429")
+    p.add_argument('--retry-after', type=float, default=1.0, help="Retry-After seconds sent with 429s")
+    p = sub.add_parser('record', help="record completion streams of questions read from stdin")
+    p.add_argument('--out', default='streams.jsonl')
+    p.add_argument('--n', type=int, default=20, help="max questions to record")
+    p.add_argument('--model', default='gpt-3.5-turbo')
+    args = parser.parse_args(argv)
+
+    if args.command == 'record':
+        questions = [line.strip() for line in sys.stdin if line.strip()][:args.n]
+        asyncio.run(record(questions, args.out, args.model))
+        return
+    logger.info(f"openai stand-in on port {args.port}")
+    web.run_app(make_app(args), port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,90 @@
+"""
+Retrieval backends for rtr
+Copyright (C) 2023 Jiggy AI
+
+A retrieval backend returns the passages most relevant to a question, best
+first, limited to k passages and max_total_tokens tokens in total.
+
+jiggypedia  remote wikipedia search (jiggypedia.wikipedia_search)
+local       local memory-mapped vector index (see vindex.py)
+
+Configuration:
+JINGBOT_RTR_BACKEND   'jiggypedia' or 'local'
+JINGBOT_VINDEX_PATH   directory of the local index
+"""
+from loguru import logger
+import os
+from functools import lru_cache
+from typing import List, Optional
+from pydantic import BaseModel
+
+
+RTR_BACKEND  = os.environ.get('JINGBOT_RTR_BACKEND', 'jiggypedia')
+VINDEX_PATH  = os.environ.get('JINGBOT_VINDEX_PATH', 'vindex')
+
+
+class SearchResult(BaseModel):
+    text:         str
+    token_count:  int
+    score:        Optional[float] = None
+    source:       Optional[str] = None
+
+
+class RetrievalBackend:
+
+    name = None
+
+    def search(self, question : str, k : int, max_total_tokens : int) -> List[SearchResult]:
+        """
+        return up to k results for the question, best first, with at most max_total_tokens tokens in total
+        """
+        raise NotImplementedError
+
+
+class JiggypediaBackend(RetrievalBackend):
+
+    name = 'jiggypedia'
+
+    def __init__(self) -> None:
+        from jiggypedia import wikipedia_search
+        self._search = wikipedia_search
+
+    def search(self, question : str, k : int, max_total_tokens : int) -> List[SearchResult]:
+        return self._search(question, k=k, max_total_tokens=max_total_tokens)
+
+
+class LocalIndexBackend(RetrievalBackend):
+
+    name = 'local'
+
+    def __init__(self, path : str = VINDEX_PATH) -> None:
+        from vindex import VectorIndex
+        from st import get_model
+        self.index = VectorIndex(path)
+        self.embedder = get_model(self.index.model)
+
+    def search(self, question : str, k : int, max_total_tokens : int) -> List[SearchResult]:
+        vector = self.embedder.embed(question).vector
+        ids, sims = self.index.search(vector, k)
+        results = []
+        total_tokens = 0
+        for i, sim in zip(ids, sims):
+            passage = self.index.passage(i)
+            if total_tokens + passage['token_count'] > max_total_tokens:
+                break
+            total_tokens += passage['token_count']
+            results.append(SearchResult(score=float(sim), **passage))
+        return results
+
+
+backends = {'jiggypedia': JiggypediaBackend,
+            'local':      LocalIndexBackend}
+
+
+@lru_cache(maxsize=None)
+def get_backend(name : str = RTR_BACKEND) -> RetrievalBackend:
+    """
+    return the shared retrieval backend by name
+    """
+    logger.info(f"retrieval backend: {name}")
+    return backends[name]()
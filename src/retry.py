@@ -2,15 +2,128 @@
 retry decorator in a wsk style
 """
 from loguru import logger
-from time import sleep
+from time import sleep, monotonic
 from functools import wraps
+from threading import Lock
+from typing import Optional
+import asyncio
+import inspect
+import random
 
-def retry(ExceptionToCheck=Exception, tries=5, delay=0.5, backoff=2, ExceptionToRaise=AssertionError):
+
+class CircuitOpenException(Exception):
+    """
+    exception to raise instead of calling an upstream whose circuit breaker is open
+    """
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for an upstream service.
+
+    After failure_threshold consecutive failures the circuit opens and calls fail fast
+    with CircuitOpenException for reset_timeout seconds. Then a single trial call is
+    let through (half open); its success closes the circuit, its failure reopens it.
+    """
+
+    def __init__(self, name : str, failure_threshold : int = 5, reset_timeout : float = 30) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self._lock = Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half_open'
+
+    def allow(self) -> None:
+        """
+        raise CircuitOpenException if a call to the upstream should not be made now
+        """
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return
+            if state == 'half_open' and not self.trial:
+                self.trial = True
+                return
+        raise CircuitOpenException(f"{self.name} circuit open after {self.failures} failures")
+
+    def success(self) -> None:
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info(f"{self.name} circuit closed")
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def release(self) -> None:
+        """
+        end a call without an outcome (cancelled, or its stream closed early), freeing the half open trial
+        """
+        with self._lock:
+            self.trial = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.trial or (self.opened_at is None and self.failures >= self.failure_threshold):
+                logger.warning(f"{self.name} circuit open after {self.failures} failures")
+                self.opened_at = monotonic()
+            self.trial = False
+
+
+breakers = {}
+
+def circuit_breaker(name : str) -> CircuitBreaker:
+    """
+    return the shared circuit breaker for the named upstream (e.g. 'openai', 'hf', 'jiggypedia')
+    """
+    if name not in breakers:
+        breakers[name] = CircuitBreaker(name)
+    return breakers[name]
+
+
+def retry_after(e : Exception) -> Optional[float]:
+    """
+    return the Retry-After hint in seconds carried by the exception, if any.
+    understands openai errors, requests HTTPErrors and telegram RetryAfter.
+    """
+    hint = getattr(e, 'retry_after', None)
+    if hint is None:
+        headers = getattr(e, 'headers', None)
+        if headers is None and getattr(e, 'response', None) is not None:
+            headers = getattr(e.response, 'headers', None)
+        if headers:
+            hint = headers.get('Retry-After', headers.get('retry-after'))
+    if hint is None:
+        return None
+    if hasattr(hint, 'total_seconds'):
+        return hint.total_seconds()
+    try:
+        return float(hint)
+    except (TypeError, ValueError):
+        return None   # http-date form is not used by our upstreams
+
+
+def retry(ExceptionToCheck=Exception, tries=5, delay=0.5, backoff=2, ExceptionToRaise=AssertionError, max_delay=30, breaker=None):
     """Retry calling the decorated function using an exponential backoff.
 
     http://www.saltycrane.com/blog/2009/11/trying-out-retry-decorator-python/
     original from: http://wiki.python.org/moin/PythonDecoratorLibrary#Retry
 
+    Works on plain functions, coroutine functions and async generator functions.
+    Coroutines and async generators sleep with asyncio.sleep so the event loop is
+    not blocked. An async generator is only retried if it fails before yielding
+    its first item.
+
     :param ExceptionToCheck: the exception to check. may be a tuple of
         exceptions to check
     :type ExceptionToCheck: Exception or tuple
@@ -22,28 +135,128 @@ def retry(ExceptionToCheck=Exception, tries=5, delay=0.5, backoff=2, ExceptionTo
         each retry
     :type backoff: int
     :param ExceptionToRaise: exceptions that should be raised instead of retried.
-        
+    :param max_delay: maximum delay between retries in seconds, unless the
+        upstream asks for longer with a Retry-After hint
+    :param breaker: name of the upstream whose circuit breaker guards the calls
     """
+    cb = circuit_breaker(breaker) if breaker else None
+
+    def next_delay(e, mdelay):
+        # jittered exponential backoff, or the upstream's Retry-After hint if longer
+        d = mdelay / 2 + random.uniform(0, mdelay / 2)
+        hint = retry_after(e)
+        if hint is not None:
+            d = max(d, hint)
+        return d
+
+    def check(mtries, mdelay, e):
+        # record the failure and return the delay before the next try, or raise e if out of tries
+        if cb:
+            cb.failure()
+        if mtries <= 1:
+            logger.exception(f"Exception: {e}")   # only show full stack trace on last try
+            raise e
+        logger.warning(f"Exception: {e}")
+        d = next_delay(e, mdelay)
+        logger.info(f"retrying in {d:.3f} seconds")
+        return d
+
     def deco_retry(f):
 
-        @wraps(f)
-        def f_retry(*args, **kwargs):
-            mtries, mdelay = tries, delay
-            while mtries > 1:
-                try:
-                    return f(*args, **kwargs)
-                except ExceptionToRaise as e:
-                    raise e
-                except ExceptionToCheck as e:
-                    if mtries == 1: # only show full stack trace on last try
-                        logger.exception(f"Exception: {e}")
-                    logger.warning(f"Exception: {e}")
-                    logger.info(f"retrying in {mdelay} seconds")
-                    sleep(mdelay)
+        if inspect.isasyncgenfunction(f):
+            @wraps(f)
+            async def f_retry(*args, **kwargs):
+                mtries, mdelay = tries, delay
+                while True:
+                    if cb:
+                        cb.allow()
+                    started = False
+                    try:
+                        async for item in f(*args, **kwargs):
+                            started = True
+                            yield item
+                        if cb:
+                            cb.success()
+                        return
+                    except ExceptionToRaise as e:
+                        if cb:
+                            cb.success()   # the upstream answered; the request itself is bad
+                        raise e
+                    except ExceptionToCheck as e:
+                        if started:
+                            if cb:
+                                cb.failure()
+                            raise
+                        await asyncio.sleep(check(mtries, mdelay, e))
+                    except Exception:
+                        if cb:
+                            cb.failure()
+                        raise
+                    except BaseException:
+                        if cb:
+                            cb.release()   # cancelled or closed early; must not hold the half open trial
+                        raise
+                    mtries -= 1
+                    mdelay = min(mdelay * backoff, max_delay)
+
+        elif inspect.iscoroutinefunction(f):
+            @wraps(f)
+            async def f_retry(*args, **kwargs):
+                mtries, mdelay = tries, delay
+                while True:
+                    if cb:
+                        cb.allow()
+                    try:
+                        result = await f(*args, **kwargs)
+                        if cb:
+                            cb.success()
+                        return result
+                    except ExceptionToRaise as e:
+                        if cb:
+                            cb.success()   # the upstream answered; the request itself is bad
+                        raise e
+                    except ExceptionToCheck as e:
+                        await asyncio.sleep(check(mtries, mdelay, e))
+                    except Exception:
+                        if cb:
+                            cb.failure()
+                        raise
+                    except BaseException:
+                        if cb:
+                            cb.release()   # cancelled or closed early; must not hold the half open trial
+                        raise
+                    mtries -= 1
+                    mdelay = min(mdelay * backoff, max_delay)
+
+        else:
+            @wraps(f)
+            def f_retry(*args, **kwargs):
+                mtries, mdelay = tries, delay
+                while True:
+                    if cb:
+                        cb.allow()
+                    try:
+                        result = f(*args, **kwargs)
+                        if cb:
+                            cb.success()
+                        return result
+                    except ExceptionToRaise as e:
+                        if cb:
+                            cb.success()   # the upstream answered; the request itself is bad
+                        raise e
+                    except ExceptionToCheck as e:
+                        sleep(check(mtries, mdelay, e))
+                    except Exception:
+                        if cb:
+                            cb.failure()
+                        raise
+                    except BaseException:
+                        if cb:
+                            cb.release()   # cancelled or closed early; must not hold the half open trial
+                        raise
                     mtries -= 1
-                    mdelay *= backoff
-            return f(*args, **kwargs)
+                    mdelay = min(mdelay * backoff, max_delay)
 
         return f_retry  # true decorator
 
-    return deco_retry
\ No newline at end of file
+    return deco_retry
@@ -1,15 +1,26 @@
-from jiggypedia import wikipedia_search as search
 from langchain.llms import OpenAI
 import openai  # for retry on error
 #from langchain.prompts import PromptTemplate
 #from langchain.chains import LLMChain
 #from langchain.evaluation.qa import QAEvalChain
 from typing import List
+from functools import wraps
 from concurrent.futures import ThreadPoolExecutor
-from time import sleep, strftime
+from collections import deque
+from time import monotonic
 from loguru import logger
+import asyncio
+import os
+import numpy as np
 
 from dynamic_prompt import dynamic_prompt
+from retrieval import get_backend, RTR_BACKEND
+from lazy import Lazy
+from retry import retry
+import metrics
+import tokens
+from semcache import SemanticCache
+from st import get_model
 
 MODEL_NAME="text-davinci-003"
 K = 20
@@ -17,6 +28,14 @@ MAX_TOTAL_TOKENS = 3800
 QA_TEMPERATURE = 0.125
 QA_RESPONSE_TOKENS = 256
 QA_RANDOMIZE = False
+CACHE_MODEL = 'multi-qa-mpnet-base-cos-v1'
+NOT_ENOUGH_INFORMATION = "Not enough information"
+
+# a second, hedged search is fired if the first has not returned after the
+# HEDGE_PERCENTILE latency of recent searches (HEDGE_DELAY until enough have been seen)
+HEDGE_PERCENTILE  = float(os.environ.get('JINGBOT_HEDGE_PERCENTILE', 90))
+HEDGE_DELAY       = float(os.environ.get('JINGBOT_HEDGE_DELAY', 1.0))
+HEDGE_MIN_SAMPLES = 20
 
 
 
@@ -29,18 +48,24 @@ logger.info(f"MODEL_NAME:  {MODEL_NAME}")
 
 # open ai offen returns rate limit error, so we need to retry
 RETRY_COUNT = 10
+@retry(ExceptionToCheck=(openai.error.RateLimitError, openai.error.ServiceUnavailableError), tries=RETRY_COUNT, delay=1, breaker='openai')
 def retry_llm(llm, prompt_text):
-    for i in range(RETRY_COUNT):
-        try:
-            return llm(prompt_text)
-        except (openai.error.RateLimitError, openai.error.ServiceUnavailableError):
-            print("openai error, retrying", i)
-            if i == RETRY_COUNT - 1:
-                raise
-            sleep(i**1.3)
-        except Exception as e:
-            print("failed to run llm", e)
-        
+    return llm(prompt_text)
+
+
+# passages are retrieved from the configured backend (JINGBOT_RTR_BACKEND: jiggypedia or local index)
+backend = Lazy('retrieval', get_backend)
+
+def search(question, k, max_total_tokens):
+    return backend().search(question, k=k, max_total_tokens=max_total_tokens)
+
+
+# search is retried once before giving up
+@retry(tries=2, delay=.1, breaker=RTR_BACKEND)
+def retry_search(question, k, max_total_tokens):
+    return search(question, k=k, max_total_tokens=max_total_tokens)
+
+
 # qa llm used to perform the task of answering the question based on given context
 qa_llm = OpenAI(model_name=MODEL_NAME, temperature=QA_TEMPERATURE, max_tokens=400)
 
@@ -58,41 +83,69 @@ def qa_prompt(context : List[str],  question : str):
     prompt += "Response: "
     return prompt
 
+# semantic caches of answers to near-duplicate questions
+ask_cache = Lazy('ask_cache', lambda: SemanticCache(get_model(CACHE_MODEL), name='ask_cache'))
+askchat_cache = Lazy('askchat_cache', lambda: SemanticCache(get_model(CACHE_MODEL), name='askchat_cache'))
+
+
+def cacheable(max_total_tokens, k) -> bool:
+    """
+    return True if answers searched with these parameters may be cached.  the caches are keyed by
+    the question only, so they hold answers searched with the default parameters only.
+    """
+    return max_total_tokens == MAX_TOTAL_TOKENS and k == K
+
+
+def cached(cache : Lazy):
+    """
+    decorator to answer questions from the semantic cache when a similar question has been answered.
+    questions are answered without the cache until it has loaded, or if asked with non-default search parameters.
+    """
+    def deco_cached(f):
+        @wraps(f)
+        def f_cached(question, max_total_tokens=MAX_TOTAL_TOKENS, k=K):
+            if not cacheable(max_total_tokens, k):
+                return f(question, max_total_tokens, k)
+            if not cache.ready:
+                cache.start()
+                return f(question, max_total_tokens, k)
+            answer, vector = cache().get(question)
+            if answer is not None:
+                return answer
+            answer = f(question, max_total_tokens, k)
+            if answer and NOT_ENOUGH_INFORMATION not in answer:
+                cache().put(question, vector, answer)
+            return answer
+        return f_cached
+    return deco_cached
+
+
+@cached(ask_cache)
 def ask(question, max_total_tokens=MAX_TOTAL_TOKENS, k=K):
     try:
-        results = search(question, k=k, max_total_tokens=max_total_tokens)
+        with metrics.span('search'):
+            results = retry_search(question, k=k, max_total_tokens=max_total_tokens)
     except Exception as ex:
-        logger.exception("search error", ex)
-        try:
-            results = search(question, k=k, max_total_tokens=max_total_tokens)
-        except Exception as ex:
-            logger.exception("search error again", ex)
-            return "Not enough information"
+        logger.warning(f"search error: {ex}")
+        return NOT_ENOUGH_INFORMATION
     total_tokens = sum(r.token_count for r in results)
     logger.info(f'total tokens {total_tokens} {len(results)}')
     context = [r.text for r in results]
     prompt_text = qa_prompt(context=context, question=question)
     logger.debug(prompt_text)
-    ret = retry_llm(qa_llm, prompt_text)
+    with metrics.span('completion'):
+        ret = retry_llm(qa_llm, prompt_text)
+    metrics.completion_tokens(MODEL_NAME, tokens.count(prompt_text), tokens.count(ret))
     logger.debug(ret)
     return ret
 
-from chatstack import SystemMessage, UserMessage, ContextMessage, completion
-
+from chatstack import SystemMessage, UserMessage, ContextMessage, completion, completion_stream
 
-def askchat(question, max_total_tokens=MAX_TOTAL_TOKENS, k=K):
-    try:
-        results = search(question, k=k, max_total_tokens=max_total_tokens)
-    except Exception as ex:
-        logger.exception("search error", ex)
-        try:
-            results = search(question, k=k, max_total_tokens=max_total_tokens)
-        except Exception as ex:
-            logger.exception("search error again", ex)
-            return "Not enough information"
-    total_tokens = sum(r.token_count for r in results)
-    logger.info(f'total tokens {total_tokens} {len(results)}')
 
+def askchat_messages(question, results):
+    """
+    return the chat completion messages answering question from the search results
+    """
     prompt  = "Use the following system context to respond to the User. "
     prompt += "Provide any additional relevant or interesting details from the system context. "
     prompt += "If the system context does not contain the required information for answering the user question "
@@ -103,5 +156,93 @@ def askchat(question, max_total_tokens=MAX_TOTAL_TOKENS, k=K):
     messages  = [SystemMessage(text=prompt)]
     messages += [ContextMessage(text=r.text) for r in results]
     messages += [UserMessage(text=question)]
+    return messages
 
-    return completion(messages, temperature=QA_TEMPERATURE)
\ No newline at end of file
+
+@cached(askchat_cache)
+def askchat(question, max_total_tokens=MAX_TOTAL_TOKENS, k=K):
+    try:
+        with metrics.span('search'):
+            results = retry_search(question, k=k, max_total_tokens=max_total_tokens)
+    except Exception as ex:
+        logger.warning(f"search error: {ex}")
+        return NOT_ENOUGH_INFORMATION
+    total_tokens = sum(r.token_count for r in results)
+    logger.info(f'total tokens {total_tokens} {len(results)}')
+    return completion(askchat_messages(question, results), temperature=QA_TEMPERATURE)
+
+
+# latencies in seconds of recent successful searches
+search_latencies = deque(maxlen=200)
+
+def hedge_delay() -> float:
+    """
+    return the seconds to wait for a search before firing a hedged search
+    """
+    if len(search_latencies) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DELAY
+    return float(np.percentile(search_latencies, HEDGE_PERCENTILE))
+
+
+@retry(tries=1, breaker=RTR_BACKEND)
+async def _search(question, k, max_total_tokens):
+    t0 = monotonic()
+    results = await asyncio.to_thread(search, question, k=k, max_total_tokens=max_total_tokens)
+    search_latencies.append(monotonic() - t0)
+    return results
+
+
+async def hedged_search(question, k=K, max_total_tokens=MAX_TOTAL_TOKENS):
+    """
+    search without blocking the event loop.  if the search has not returned (or has failed)
+    within hedge_delay() a second search is fired and the first successful result is returned.
+    """
+    delay = hedge_delay()
+    first = asyncio.create_task(_search(question, k, max_total_tokens))
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done and not first.exception():
+        return first.result()
+    logger.info(f"hedging search after {delay:.3f} s: '{question}'")
+    pending = {asyncio.create_task(_search(question, k, max_total_tokens))}
+    if not done:
+        pending.add(first)
+    error = first.exception() if done else None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception():
+                error = task.exception()
+                continue
+            for other in pending:
+                other.cancel()
+            return task.result()
+    raise error
+
+
+async def askchat_stream(question, max_total_tokens=MAX_TOTAL_TOKENS, k=K):
+    """
+    async askchat for use from the event loop.
+    yield ("not_finished", partial answer) as the answer streams in, then ("finished", answer)
+    """
+    use_cache = cacheable(max_total_tokens, k)
+    answer, vector = None, None
+    if use_cache and askchat_cache.ready:
+        answer, vector = await asyncio.to_thread(askchat_cache().get, question)
+    elif use_cache:
+        askchat_cache.start()
+    if answer is not None:
+        yield "finished", answer
+        return
+    try:
+        with metrics.span('search'):
+            results = await hedged_search(question, k=k, max_total_tokens=max_total_tokens)
+    except Exception as ex:
+        logger.warning(f"search error: {ex}")
+        yield "finished", NOT_ENOUGH_INFORMATION
+        return
+    total_tokens = sum(r.token_count for r in results)
+    logger.info(f'total tokens {total_tokens} {len(results)}')
+    async for status, answer in completion_stream(askchat_messages(question, results), temperature=QA_TEMPERATURE):
+        yield status, answer
+    if use_cache and askchat_cache.ready and answer and NOT_ENOUGH_INFORMATION not in answer:
+        askchat_cache().put(question, vector, answer)
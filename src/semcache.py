@@ -0,0 +1,142 @@
+"""
+Semantic answer cache
+Copyright (C) 2023 Jiggy AI
+
+Caches answers by the embedding of the question. A lookup embeds the question
+and returns the answer of the most similar cached question if the cosine
+similarity is at or above the threshold, so near-duplicate questions
+("who won the 2020 world series" vs "2020 world series winner") share one
+search + completion.
+
+Entries expire after ttl seconds and the least recently used entry is evicted
+when the cache holds max_entries. Hit rate and the distribution of best-match
+similarities are kept for reporting.
+"""
+from loguru import logger
+import os
+from threading import Lock
+from time import time
+from typing import Optional, Tuple
+import numpy as np
+
+from embedding_model import BaseEmbeddingModel
+import metrics
+
+
+SEMCACHE_THRESHOLD = float(os.environ.get('JINGBOT_SEMCACHE_THRESHOLD', 0.92))
+SEMCACHE_TTL       = float(os.environ.get('JINGBOT_SEMCACHE_TTL', 24*3600))
+SEMCACHE_SIZE      = int(os.environ.get('JINGBOT_SEMCACHE_SIZE', 10000))
+
+REPORT_INTERVAL = 100     # log stats every this many lookups
+HISTOGRAM_BINS  = 20      # similarity histogram bins over [0, 1]
+
+
+class SemanticCache:
+
+    def __init__(self,
+                 embedder    : BaseEmbeddingModel,
+                 name        : str = 'semcache',
+                 threshold   : float = SEMCACHE_THRESHOLD,
+                 ttl         : float = SEMCACHE_TTL,
+                 max_entries : int = SEMCACHE_SIZE) -> None:
+        self.embedder = embedder
+        self.name = name
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.vectors = np.zeros((max_entries, embedder.dim()), dtype=np.float32)   # normalized question embeddings
+        self.created_at = np.zeros(max_entries)
+        self.used_at = np.zeros(max_entries)
+        self.questions = [None] * max_entries
+        self.answers = [None] * max_entries
+        self.n = 0
+        self.hits = 0
+        self.misses = 0
+        self.histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)   # counts of best-match similarity per lookup
+        self._lock = Lock()
+
+    def embed(self, question : str) -> np.ndarray:
+        """
+        return the normalized float32 embedding of the question
+        """
+        v = np.asarray(self.embedder.embed(question).vector, dtype=np.float32)
+        return v / np.linalg.norm(v)
+
+    def _remove(self, i : int) -> None:
+        # move the last entry into slot i
+        last = self.n - 1
+        if i != last:
+            self.vectors[i] = self.vectors[last]
+            self.created_at[i] = self.created_at[last]
+            self.used_at[i] = self.used_at[last]
+            self.questions[i] = self.questions[last]
+            self.answers[i] = self.answers[last]
+        self.questions[last] = self.answers[last] = None
+        self.n -= 1
+
+    def _expire(self, now : float) -> None:
+        for i in reversed(np.flatnonzero(self.created_at[:self.n] < now - self.ttl)):
+            self._remove(int(i))
+
+    def get(self, question : str) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """
+        return (answer, question embedding); answer is None on a miss.
+        the embedding may be passed to put() to avoid embedding the question again;
+        it is None if the question could not be embedded.
+        """
+        try:
+            v = self.embed(question)
+        except Exception as e:
+            logger.warning(f"{self.name}: unable to embed question: {e}")
+            return None, None
+        now = time()
+        with self._lock:
+            self._expire(now)
+            answer = None
+            if self.n:
+                sims = self.vectors[:self.n] @ v
+                i = int(np.argmax(sims))
+                similarity = float(sims[i])
+                self.histogram[min(HISTOGRAM_BINS - 1, max(0, int(similarity * HISTOGRAM_BINS)))] += 1
+                if similarity >= self.threshold:
+                    self.used_at[i] = now
+                    answer = self.answers[i]
+                    logger.info(f"{self.name} hit {similarity:.3f}: '{question}' ~ '{self.questions[i]}'")
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            metrics.cache_lookup(self.name, answer is not None, answer is None)
+            if (self.hits + self.misses) % REPORT_INTERVAL == 0:
+                logger.info(f"{self.name} stats: {self.stats()}")
+        return answer, v
+
+    def put(self, question : str, vector : Optional[np.ndarray], answer : str) -> None:
+        """
+        cache the answer to the question whose embedding (from get()) is vector
+        """
+        if vector is None:
+            return
+        now = time()
+        with self._lock:
+            if self.n == self.max_entries:
+                self._remove(int(np.argmin(self.used_at[:self.n])))
+            i = self.n
+            self.vectors[i] = vector
+            self.created_at[i] = now
+            self.used_at[i] = now
+            self.questions[i] = question
+            self.answers[i] = answer
+            self.n += 1
+
+    def stats(self) -> dict:
+        """
+        return entry count, hit rate and the histogram of best-match similarities
+        """
+        lookups = self.hits + self.misses
+        edges = np.linspace(0, 1, HISTOGRAM_BINS + 1)
+        return {'entries':    self.n,
+                'hits':       self.hits,
+                'misses':     self.misses,
+                'hit_rate':   self.hits / lookups if lookups else 0.0,
+                'similarity': {f'{lo:.2f}-{hi:.2f}': int(c) for lo, hi, c in zip(edges[:-1], edges[1:], self.histogram) if c}}
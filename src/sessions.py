@@ -0,0 +1,203 @@
+"""
+Bounded chat session store
+Copyright (C) 2023 Jiggy AI
+
+Chat contexts are kept in an in-memory LRU tier bounded by session count,
+approximate memory use and idle time (TTL). Contexts evicted from memory are
+spilled to a local sqlite database and rehydrated on the next message from
+the chat, so users keep their history across evictions and restarts.  The
+spilled copy is kept after rehydration until the session is spilled again.
+Idle sessions are also reclaimed by a periodic task started with start(), and
+spilled sessions idle for longer than spill_ttl are deleted.
+
+Configuration:
+JINGBOT_SESSION_MAX        max sessions in memory
+JINGBOT_SESSION_MAX_BYTES  max approximate bytes of chat text in memory
+JINGBOT_SESSION_TTL        seconds a session may be idle before it is spilled to disk
+JINGBOT_SESSION_SPILL_TTL  seconds a spilled session may be idle before it is deleted
+JINGBOT_SESSION_DB         path of the sqlite spill database
+JINGBOT_SESSION_RECLAIM    seconds between reclaims of idle sessions
+"""
+from loguru import logger
+import os
+import json
+import asyncio
+import sqlite3
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import islice
+from time import time
+from typing import Optional
+
+from chatstack import ChatContext
+
+
+SESSION_MAX       = int(os.environ.get('JINGBOT_SESSION_MAX', 2000))
+SESSION_MAX_BYTES = int(os.environ.get('JINGBOT_SESSION_MAX_BYTES', 64*1024*1024))
+SESSION_TTL       = float(os.environ.get('JINGBOT_SESSION_TTL', 3600))
+SESSION_SPILL_TTL = float(os.environ.get('JINGBOT_SESSION_SPILL_TTL', 90*24*3600))
+SESSION_DB        = os.environ.get('JINGBOT_SESSION_DB', 'sessions.db')
+SESSION_RECLAIM   = float(os.environ.get('JINGBOT_SESSION_RECLAIM', 60))
+
+
+class SessionStore:
+    """
+    dict-like chat_id -> ChatContext store with an LRU/TTL memory tier and a sqlite spill tier
+    """
+
+    def __init__(self,
+                 max_sessions = SESSION_MAX,
+                 max_bytes    = SESSION_MAX_BYTES,
+                 ttl          = SESSION_TTL,
+                 spill_ttl    = SESSION_SPILL_TTL,
+                 path         = SESSION_DB) -> None:
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.spill_ttl = spill_ttl
+        self._sessions = OrderedDict()   # chat_id -> (ChatContext, last access time, nbytes at last access); LRU order
+        self._nbytes = 0
+        self._pinned = {}                # chat_id -> number of handlers using the session; pinned sessions are not spilled
+        self.evictions = 0
+        self.expirations = 0
+        self.rehydrations = 0
+        self._task = None
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS session (chat_id INTEGER PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)")
+        self._expire_spilled()
+
+    def _touch(self, chat_id : int, context : ChatContext) -> None:
+        # (re)insert the context as most recently used, refreshing its size
+        _, _, nbytes = self._sessions.pop(chat_id, (None, None, 0))
+        self._nbytes -= nbytes
+        nbytes = context.nbytes()
+        self._sessions[chat_id] = (context, time(), nbytes)
+        self._nbytes += nbytes
+        self._evict()
+
+    def _spill(self, chat_id : int) -> None:
+        context, last_access, nbytes = self._sessions.pop(chat_id)
+        self._nbytes -= nbytes
+        self.db.execute("INSERT OR REPLACE INTO session (chat_id, state, updated_at) VALUES (?, ?, ?)",
+                        (chat_id, json.dumps(context.to_dict()), last_access))
+
+    def _expire_spilled(self) -> None:
+        self.db.execute("DELETE FROM session WHERE updated_at < ?", (time() - self.spill_ttl,))
+
+    def _evict(self, keep_newest : bool = True) -> None:
+        # spill idle sessions, then least recently used sessions until within bounds.
+        # never spill a pinned session, or the newest session while it is being touched;
+        # pinned sessions are reconsidered when released.
+        now = time()
+        n, nbytes = len(self._sessions), self._nbytes
+        victims = []
+        for chat_id, (_, last_access, size) in islice(self._sessions.items(), len(self._sessions) - keep_newest):
+            if chat_id in self._pinned:
+                continue
+            if now - last_access > self.ttl:
+                self.expirations += 1
+            elif n > self.max_sessions or nbytes > self.max_bytes:
+                self.evictions += 1
+            else:
+                break
+            victims.append(chat_id)
+            n -= 1
+            nbytes -= size
+        for chat_id in victims:
+            self._spill(chat_id)
+            logger.info(f"spilled session {chat_id}: {self.stats()}")
+
+    def _load(self, chat_id : int) -> Optional[ChatContext]:
+        row = self.db.execute("SELECT state FROM session WHERE chat_id = ?", (chat_id,)).fetchone()
+        if row is None:
+            return None
+        # the row is kept, so the history survives a crash; it is replaced when the session is spilled again
+        self.rehydrations += 1
+        logger.info(f"rehydrated session {chat_id}")
+        return ChatContext.from_dict(json.loads(row[0]))
+
+    def get(self, chat_id : int, default=None) -> Optional[ChatContext]:
+        """
+        return the context for chat_id, rehydrating it from disk if needed
+        """
+        if chat_id in self._sessions:
+            context = self._sessions[chat_id][0]
+        else:
+            context = self._load(chat_id)
+            if context is None:
+                return default
+        self._touch(chat_id, context)
+        return context
+
+    def __getitem__(self, chat_id : int) -> ChatContext:
+        context = self.get(chat_id)
+        if context is None:
+            raise KeyError(chat_id)
+        return context
+
+    def __setitem__(self, chat_id : int, context : ChatContext) -> None:
+        self.db.execute("DELETE FROM session WHERE chat_id = ?", (chat_id,))
+        self._touch(chat_id, context)
+
+    def __contains__(self, chat_id : int) -> bool:
+        if chat_id in self._sessions:
+            return True
+        return self.db.execute("SELECT 1 FROM session WHERE chat_id = ?", (chat_id,)).fetchone() is not None
+
+    @contextmanager
+    def pinned(self, chat_id : int):
+        """
+        keep the chat's session in memory while a handler is using it, so a reply streamed into the context
+        is not appended to a copy that was already spilled
+        """
+        self._pinned[chat_id] = self._pinned.get(chat_id, 0) + 1
+        try:
+            yield
+        finally:
+            self._pinned[chat_id] -= 1
+            if not self._pinned[chat_id]:
+                del self._pinned[chat_id]
+                if chat_id in self._sessions:
+                    self._touch(chat_id, self._sessions[chat_id][0])    # refresh its size now the reply is in
+
+    def reclaim(self) -> None:
+        """
+        spill sessions that have been idle for longer than ttl and delete expired spilled sessions
+        """
+        self._evict(keep_newest=False)
+        self._expire_spilled()
+
+    def start(self, interval : float = SESSION_RECLAIM) -> None:
+        """
+        start reclaiming idle sessions every interval seconds; must be called inside the running event loop
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._reclaim_loop(interval))
+
+    async def _reclaim_loop(self, interval : float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.reclaim()
+            except Exception as e:
+                logger.exception(e)
+
+    def flush(self) -> None:
+        """
+        spill every session in memory to disk, e.g. at shutdown
+        """
+        for chat_id in list(self._sessions):
+            self._spill(chat_id)
+
+    def stats(self) -> dict:
+        """
+        return session counts, memory use and eviction counters
+        """
+        spilled = self.db.execute("SELECT count(*) FROM session").fetchone()[0]
+        return {'sessions':     len(self._sessions),
+                'spilled':      spilled,
+                'bytes':        self._nbytes,
+                'evictions':    self.evictions,
+                'expirations':  self.expirations,
+                'rehydrations': self.rehydrations}
@@ -2,34 +2,129 @@
 
 from loguru import logger
 from sentence_transformers import SentenceTransformer
+import numpy as np
+import torch
 from embedding_model import BaseEmbeddingModel, ModelEmbedding, MaxTokenExceededException, EmbeddingModelName
-import tiktoken
+import tokens
 from retry import retry
+from embcache import EmbeddingCache
+from lazy import Lazy
+import metrics
 from requests import Session
+from requests.adapters import HTTPAdapter
 import os
+from threading import Lock
+from time import monotonic
 from concurrent.futures import ThreadPoolExecutor
-
-pool = ThreadPoolExecutor(max_workers=20)
+from functools import lru_cache
 
 HF_API_TOKEN=os.environ['HF_API_TOKEN']
 HF_INFERENCE_ENDPOINT=os.environ['HF_INFERENCE_ENDPOINT']
 
+HF_CONCURRENCY     = int(os.environ.get('JINGBOT_HF_CONCURRENCY', 4))             # batches in flight at once
+HF_BATCH_TOKENS    = int(os.environ.get('JINGBOT_HF_BATCH_TOKENS', 4096))         # initial tokens per request
+HF_BATCH_MAX_TOKENS = int(os.environ.get('JINGBOT_HF_BATCH_MAX_TOKENS', 32768))
+HF_BATCH_MAX_INPUTS = int(os.environ.get('JINGBOT_HF_BATCH_MAX_INPUTS', 128))
+HF_TARGET_LATENCY  = float(os.environ.get('JINGBOT_HF_TARGET_LATENCY', 1.0))      # seconds per request
+
+ENCODE_BATCH = 32     # texts per local model forward pass
+
+pool = ThreadPoolExecutor(max_workers=HF_CONCURRENCY)
+
 session = Session()
 session.headers.update({'Authorization': f'Bearer {HF_API_TOKEN}'})
+adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HF_CONCURRENCY)
+session.mount('https://', adapter)
+session.mount('http://', adapter)
+
+@retry(delay=.1, breaker='hf')
+def hf_inference(texts: list[str]) -> tuple[list[list[float]], float]:
+        """
+        return the embeddings of the texts and the seconds taken by the request that returned them,
+        not counting failed tries and retry delays
+        """
+        t0 = monotonic()
+        r = session.post(HF_INFERENCE_ENDPOINT, json={'inputs': texts})
+        r.raise_for_status()
+        return r.json()['embeddings'], monotonic() - t0
+
+
+class BatchSizer:
+    """
+    Token budget per inference endpoint request.  The endpoint's seconds per token
+    is tracked as a moving average and the budget set so a request takes about
+    target_latency: large enough to amortize the per-request overhead, small enough
+    to keep requests well inside the endpoint's timeouts.
+    """
+
+    def __init__(self,
+                 tokens         : int = HF_BATCH_TOKENS,
+                 max_tokens     : int = HF_BATCH_MAX_TOKENS,
+                 max_inputs     : int = HF_BATCH_MAX_INPUTS,
+                 target_latency : float = HF_TARGET_LATENCY) -> None:
+        self.tokens = tokens
+        self.min_tokens = min(tokens, 512)
+        self.max_tokens = max_tokens
+        self.max_inputs = max_inputs
+        self.target_latency = target_latency
+        self.seconds_per_token = None
+        self._lock = Lock()
+
+    def batches(self, num_tokens : list[int]) -> list[list[int]]:
+        """
+        return the indices of the texts with num_tokens tokens grouped into request batches
+        """
+        batches = [[]]
+        total = 0
+        for i, n in enumerate(num_tokens):
+            if batches[-1] and (total + n > self.tokens or len(batches[-1]) == self.max_inputs):
+                batches.append([])
+                total = 0
+            batches[-1].append(i)
+            total += n
+        return batches if batches[0] else []
+
+    def update(self, tokens : int, latency : float) -> None:
+        """
+        record that a request of tokens tokens took latency seconds
+        """
+        with self._lock:
+            rate = latency / max(1, tokens)
+            self.seconds_per_token = rate if self.seconds_per_token is None else 0.8 * self.seconds_per_token + 0.2 * rate
+            self.tokens = int(min(self.max_tokens, max(self.min_tokens, self.target_latency / self.seconds_per_token)))
+
+
+sizer = BatchSizer()
+
+embedding_cache = Lazy('embedding_cache', EmbeddingCache)    # opened on first use, not at import
+
+def hf_embed_batch(texts : list[str], num_tokens : list[int]) -> list[list[float]]:
+    """
+    embed the texts on the inference endpoint, sending adaptively sized batches concurrently
+    """
+    batches = sizer.batches(num_tokens)
+
+    def run(batch):
+        vectors, latency = hf_inference([texts[i] for i in batch])
+        sizer.update(sum(num_tokens[i] for i in batch), latency)
+        return vectors
+
+    vectors = [None] * len(texts)
+    futures = [metrics.track('hf_embed', pool.submit(run, batch)) for batch in batches]
+    for batch, future in zip(batches, futures):
+        for i, v in zip(batch, future.result()):
+            vectors[i] = v
+    logger.debug(f"embedded {len(texts)} texts in {len(batches)} requests; batch tokens now {sizer.tokens}")
+    return vectors
+
 
-@retry(delay=.1)
-def hf_inference(text: str) -> list[float]:
-        r = session.post(HF_INFERENCE_ENDPOINT, json={'inputs': text})
-        return r.json()['embeddings']
-        
 class HFSentenceTransformer(BaseEmbeddingModel):
 
     def __init__(self, modelname : str) -> None:
         super().__init__()
         self.modelname = modelname
         self.st_model = SentenceTransformer(modelname)
-        self._dim = len(self.st_model.encode('foo'))
-        self.gpt2_tokenizer = tiktoken.get_encoding("gpt2")
+        self._dim = self.st_model.get_sentence_embedding_dimension()
         
     def embed(self, text: str) -> ModelEmbedding:
         """
@@ -37,14 +132,20 @@ class HFSentenceTransformer(BaseEmbeddingModel):
         """
         assert(not text.isspace())
         _text =  text.replace("\n", " ")  #  is this still needed?
-        num_tokens = self.num_tokens(_text)
-        if num_tokens > self.max_tokens():
-            logger.warning(f"Max tokens exceeded: {num_tokens} > {self.max_tokens()}")
-            #raise MaxTokenExceededException
-        vector = self.st_model.encode(_text)
+        cached = embedding_cache().get_batch(self.modelname, [_text])[0]
+        if cached:
+            vector, num_tokens = cached
+        else:
+            input_ids = self._tokenize([_text])
+            num_tokens = len(input_ids[0])
+            if num_tokens > self.max_tokens():
+                logger.warning(f"Max tokens exceeded: {num_tokens} > {self.max_tokens()}")
+                #raise MaxTokenExceededException
+            vector = self._encode(input_ids)[0]
+            embedding_cache().put_batch(self.modelname, [_text], [vector], [num_tokens])
         return ModelEmbedding(text        = text,
                               tokens      = num_tokens,  
-                              vector      = list(vector),
+                              vector      = vector,
                               model       = self.modelname,
                               gpt2_tokens = self.num_gpt2_tokens(text))  # count tokens on original text with original newlines
     
@@ -53,33 +154,72 @@ class HFSentenceTransformer(BaseEmbeddingModel):
         """
         Embed a text string using the openai text-embedding-ada-002, returning a ModelEmbedding            
         """
+        if not texts:
+            return []
         _texts = [text.replace("\n", " ") for text in texts]
-        num_tokens = [self.num_tokens(t) for t in _texts]
-        if max(num_tokens) > self.max_tokens():
-            logger.warning(f"Max tokens exceeded: {max(num_tokens)} > {self.max_tokens()}")
-            #raise MaxTokenExceededException
-        if self.st_model.device.type == 'cpu':
-            vectors = list(pool.map(hf_inference, _texts))
-        else:
-            vectors = self.st_model.encode(_texts)
+        cached = embedding_cache().get_batch(self.modelname, _texts)
+        vectors = [c[0] if c else None for c in cached]
+        num_tokens = [c[1] if c else None for c in cached]
+        # only embed the distinct texts that are not cached
+        misses = list(dict.fromkeys(t for t, c in zip(_texts, cached) if c is None))
+        if misses:
+            # tokenized once; the ids are used for the token counts and the local forward pass
+            input_ids = self._tokenize(misses)
+            miss_tokens = [len(ids) for ids in input_ids]
+            if max(miss_tokens) > self.max_tokens():
+                logger.warning(f"Max tokens exceeded: {max(miss_tokens)} > {self.max_tokens()}")
+                #raise MaxTokenExceededException
+            if self.st_model.device.type == 'cpu':
+                miss_vectors = hf_embed_batch(misses, miss_tokens)
+            else:
+                miss_vectors = self._encode(input_ids)
+            embedding_cache().put_batch(self.modelname, misses, miss_vectors, miss_tokens)
+            computed = {t: (v, n) for t, v, n in zip(misses, miss_vectors, miss_tokens)}
+            for i, t in enumerate(_texts):
+                if vectors[i] is None:
+                    vectors[i], num_tokens[i] = computed[t]
+        gpt2_tokens = tokens.count_batch(texts, "gpt2")
             
         return [ModelEmbedding(text        = text,
                                tokens      = tkns,
-                               vector      = list(v),
+                               vector      = v,
                                model       = self.modelname,
-                               gpt2_tokens = self.num_gpt2_tokens(text)) for text, tkns, v in zip(texts, num_tokens, vectors)]
+                               gpt2_tokens = g2t) for text, tkns, v, g2t in zip(texts, num_tokens, vectors, gpt2_tokens)]
         
+    def _tokenize(self, texts: list[str]) -> list[list[int]]:
+        """
+        return the untruncated input ids of each of the texts, tokenized in one call to the fast tokenizer
+        """
+        return self.st_model.tokenizer(texts, truncation=False, verbose=False)['input_ids']
+
+    def _encode(self, input_ids: list[list[int]]) -> np.ndarray:
+        """
+        return the embeddings of pre-tokenized texts, truncated to max_tokens(), from a direct forward
+        pass of the sentence transformer.  texts are batched in length order to minimize padding.
+        """
+        max_tokens = self.max_tokens()
+        input_ids = [ids if len(ids) <= max_tokens else ids[:max_tokens-1] + ids[-1:] for ids in input_ids]  # keep the end token
+        order = np.argsort([-len(ids) for ids in input_ids], kind='stable')
+        vectors = np.zeros((len(input_ids), self.dim()), dtype=np.float32)
+        for i in range(0, len(order), ENCODE_BATCH):
+            batch = order[i:i+ENCODE_BATCH]
+            features = self.st_model.tokenizer.pad({'input_ids': [input_ids[j] for j in batch]}, return_tensors='pt')
+            features = {k: v.to(self.st_model.device) for k, v in features.items()}
+            with torch.no_grad():
+                vectors[batch] = self.st_model.forward(features)['sentence_embedding'].float().cpu().numpy()
+        return vectors
+
     def num_tokens(self, text: str) -> int:
         """
         return the number of tokens in the text when encoded by this embedding model.
         """
-        return len(self.st_model.tokenizer.encode(text.replace('\n', " ")))
+        return len(self._tokenize([text.replace('\n', " ")])[0])
 
     def num_gpt2_tokens(self, text: str) -> int:
         """
         return the number of gpt2 tokens in the text without any transformations to the text
         """
-        return len(self.gpt2_tokenizer.encode(text))
+        return tokens.count(text, "gpt2")
         
     def max_tokens(self) -> int:
         """
@@ -98,3 +238,17 @@ class HFSentenceTransformer(BaseEmbeddingModel):
         return the model type
         """
         return self.modelname
+
+
+models_lock = Lock()
+
+@lru_cache(maxsize=None)
+def _load_model(modelname : str) -> HFSentenceTransformer:
+    return HFSentenceTransformer(modelname)
+
+def get_model(modelname : str) -> HFSentenceTransformer:
+    """
+    return the shared HFSentenceTransformer for modelname, loading it once even if several threads ask at once
+    """
+    with models_lock:
+        return _load_model(modelname)
@@ -0,0 +1,92 @@
+"""
+tests of ChatHistory token budget selection against a brute force reference
+"""
+import random
+import pytest
+
+from chatstack import ChatHistory, ChatRoleMessage
+
+
+def message(role : str, tokens : int, n : int) -> ChatRoleMessage:
+    return ChatRoleMessage.construct(role=role, text=f'{role} {n}', tokens=tokens)
+
+
+def reference_newest(messages, max_tokens, role_limits):
+    # the original ChatContext._compose_completion_msg: walk newest first until a message of any role
+    # does not fit, skipping messages of other roles and messages over their role's limit
+    selected = []
+    counts = dict.fromkeys(role_limits, 0)
+    total = 0
+    for msg in reversed(messages):
+        if total + msg.tokens > max_tokens:
+            break
+        if msg.role not in role_limits or counts[msg.role] >= role_limits[msg.role]:
+            continue
+        selected.append(msg)
+        counts[msg.role] += 1
+        total += msg.tokens
+    return selected[::-1]
+
+
+def random_messages(rng, n):
+    roles = ['user', 'assistant', 'system']
+    return [message(rng.choice(roles), rng.randint(0, 60), i) for i in range(n)]
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_newest_matches_reference(seed):
+    rng = random.Random(seed)
+    messages = random_messages(rng, rng.randint(0, 80))
+    history = ChatHistory()
+    for msg in messages:
+        history.append(msg)
+    for _ in range(20):
+        max_tokens = rng.randint(0, 1500)
+        role_limits = {'user': rng.randint(0, 30), 'assistant': rng.randint(0, 10)}
+        assert history.newest(max_tokens, role_limits) == reference_newest(messages, max_tokens, role_limits)
+
+
+def test_prefix_sums():
+    rng = random.Random(0)
+    messages = random_messages(rng, 100)
+    history = ChatHistory()
+    for msg in messages:
+        history.append(msg)
+    for role, prefix in history._prefix.items():
+        tokens = [msg.tokens for msg in messages if msg.role == role]
+        assert prefix == [sum(tokens[:k]) for k in range(len(tokens) + 1)]
+        assert [history[p] for p in history._positions[role]] == [msg for msg in messages if msg.role == role]
+    assert history.nbytes == sum(len(msg.text) for msg in messages)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_trim_keeps_selection(seed):
+    rng = random.Random(seed)
+    messages = random_messages(rng, rng.randint(0, 120))
+    role_limits = {'user': rng.randint(1, 20), 'assistant': rng.randint(1, 8)}
+    history = ChatHistory()
+    for msg in messages:
+        history.append(msg)
+    history.trim(role_limits)
+    assert list(history) == messages[len(messages) - len(history):]
+    for max_tokens in (0, 50, 300, 10**6):
+        assert history.newest(max_tokens, role_limits) == reference_newest(messages, max_tokens, role_limits)
+
+
+def test_empty_history():
+    history = ChatHistory()
+    assert history.newest(100, {'user': 5, 'assistant': 5}) == []
+    history.trim({'user': 5})
+    assert len(history) == 0
+
+
+def test_history_is_a_contiguous_suffix():
+    # a message that does not fit stops the selection even if older messages would fit
+    history = ChatHistory()
+    for msg in [message('user', 10, 0), message('assistant', 100, 1), message('user', 10, 2)]:
+        history.append(msg)
+    assert [m.text for m in history.newest(50, {'user': 5, 'assistant': 5})] == ['user 2']
+    # also when the message would have been excluded by its role's limit
+    assert [m.text for m in history.newest(50, {'user': 5, 'assistant': 0})] == ['user 2']
+    assert [m.text for m in history.newest(50, {'user': 5})] == ['user 2']
+    assert [m.text for m in history.newest(500, {'user': 5})] == ['user 0', 'user 2']
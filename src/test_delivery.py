@@ -0,0 +1,204 @@
+"""
+tests of the paced, edit-in-place reply delivery against a fake bot
+"""
+import asyncio
+from time import monotonic
+import pytest
+import telegram
+
+import delivery
+from delivery import TokenBucket, ReplyStream, split_pages, stream_reply
+
+
+class Message:
+    def __init__(self, message_id, text='...'):
+        self.chat_id = 1
+        self.message_id = message_id
+        self.text = text
+
+
+class FakeBot:
+    """
+    records the text shown in each message; errors are raised by the next calls, in order
+    """
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.shown = {1: '...'}
+        self.calls = []      # (time, method, parse_mode)
+
+    def _call(self, method, parse_mode):
+        self.calls.append((monotonic(), method, parse_mode))
+        if self.errors:
+            raise self.errors.pop(0)
+
+    async def edit_message_text(self, text, chat_id, message_id, parse_mode=None):
+        self._call('edit', parse_mode)
+        self.shown[message_id] = text
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        self._call('send', parse_mode)
+        message = Message(len(self.shown) + 1, text)
+        self.shown[message.message_id] = text
+        return message
+
+
+@pytest.fixture(autouse=True)
+def buckets(monkeypatch):
+    # fast buckets so the tests do not wait on the production rates
+    monkeypatch.setattr(delivery, 'global_bucket', TokenBucket(1000, 1000))
+    monkeypatch.setattr(delivery, 'chat_buckets', delivery.LRUCache(10))
+    monkeypatch.setattr(delivery, 'recent_floods', {})
+    monkeypatch.setattr(delivery, 'CHAT_EDIT_RATE', 1000)
+    monkeypatch.setattr(delivery, 'CHAT_EDIT_BURST', 1000)
+
+
+def deliver(bot, texts, parse_mode=None):
+    async def gen():
+        for text in texts:
+            yield "not_finished", text
+            await asyncio.sleep(0)
+        yield "finished", texts[-1]
+
+    async def main():
+        return await stream_reply(bot, Message(1), gen(), parse_mode)
+    return asyncio.run(main())
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, capacity=2)
+    assert bucket.delay() == 0
+    bucket.take()
+    bucket.take()
+    assert 0.05 < bucket.delay() <= 0.1
+    bucket.pause(1)
+    assert 0.9 < bucket.delay() <= 1
+
+
+@pytest.mark.parametrize('limit', [10, 50, 100])
+def test_split_pages(limit):
+    text = ' '.join(f'word{i}' + ('\n' if i % 7 == 0 else '') for i in range(300))
+    pages = split_pages(text, limit)
+    assert all(len(page) <= limit for page in pages)
+    assert ''.join(pages).replace(' ', '').replace('\n', '') == text.replace(' ', '').replace('\n', '')
+    # pages of a growing text are stable
+    for n in range(0, len(text), 37):
+        grown = split_pages(text[:n], limit)
+        assert grown[:-1] == pages[:len(grown) - 1]
+
+
+def test_long_reply_rolls_over_into_new_messages(monkeypatch):
+    monkeypatch.setattr(delivery, 'MAX_MESSAGE_LENGTH', 100)
+    monkeypatch.setattr(delivery, 'split_pages', lambda text: split_pages(text, 100))
+    bot = FakeBot()
+    text = ' '.join(f'word{i}' for i in range(100))
+    assert deliver(bot, [text[:50], text[:250], text]) == text
+    assert [bot.shown[m] for m in sorted(bot.shown)] == split_pages(text, 100)
+
+
+def test_updates_are_coalesced(monkeypatch):
+    monkeypatch.setattr(delivery, 'CHAT_EDIT_RATE', 20)
+    monkeypatch.setattr(delivery, 'CHAT_EDIT_BURST', 1)
+    bot = FakeBot()
+    texts = [f'reply {"x" * n}' for n in range(200)]
+    deliver(bot, texts)
+    assert bot.shown[1] == texts[-1]
+    assert len(bot.calls) < 20
+
+
+def test_retry_after_pauses_the_chat():
+    bot = FakeBot(errors=[telegram.error.RetryAfter(1)])
+    t0 = monotonic()
+    deliver(bot, ['hello'])
+    assert bot.shown[1] == 'hello'
+    assert bot.calls[1][0] - t0 >= 0.9
+    assert not delivery.global_bucket.paused_until > monotonic()
+
+
+def test_retry_after_in_several_chats_pauses_all_chats():
+    delivery.flood_control(1, TokenBucket(1, 1), 1)
+    assert delivery.global_bucket.delay() == 0
+    delivery.flood_control(2, TokenBucket(1, 1), 1)
+    assert delivery.global_bucket.delay() > 0.9
+
+
+def test_network_errors_are_retried():
+    bot = FakeBot(errors=[telegram.error.TimedOut()] * (delivery.MAX_FAILURES - 1))
+    deliver(bot, ['hello'])
+    assert bot.shown[1] == 'hello'
+
+
+def test_edit_abandoned_after_max_failures():
+    bot = FakeBot(errors=[telegram.error.NetworkError('down')] * delivery.MAX_FAILURES)
+
+    async def main():
+        reply = ReplyStream(bot, Message(1), None)
+        await reply.finish('hello')
+        return reply
+    reply = asyncio.run(main())
+    assert len(bot.calls) == delivery.MAX_FAILURES
+    assert reply.abandoned == 1
+    assert reply.edits == 0
+    assert reply.sent == ['...']
+
+
+def test_abandoned_page_is_retried_with_the_next_text():
+    bot = FakeBot(errors=[telegram.error.NetworkError('down')] * delivery.MAX_FAILURES)
+
+    async def main():
+        reply = ReplyStream(bot, Message(1), None)
+        reply.update('hello')
+        while not reply.abandoned:
+            await asyncio.sleep(0.001)
+        await reply.finish('hello world')
+        return reply
+    reply = asyncio.run(main())
+    assert bot.shown[1] == 'hello world'
+    assert reply.sent == ['hello world']
+
+
+def test_bad_markdown_falls_back_to_plain_text(monkeypatch):
+    taken = []
+    acquire = delivery.acquire
+
+    async def counting_acquire(bucket):
+        taken.append(1)
+        await acquire(bucket)
+    monkeypatch.setattr(delivery, 'acquire', counting_acquire)
+    bot = FakeBot(errors=[telegram.error.BadRequest("Can't parse entities")])
+    deliver(bot, ['*bold'], parse_mode='Markdown')
+    assert bot.shown[1] == '*bold'
+    assert [c[2] for c in bot.calls] == ['Markdown', None]
+    assert len(taken) == 2      # the fallback is paced too
+
+
+def test_fallback_not_modified_is_delivered():
+    bot = FakeBot(errors=[telegram.error.BadRequest("Can't parse entities"),
+                          telegram.error.BadRequest("Message is not modified")])
+
+    async def main():
+        reply = ReplyStream(bot, Message(1), 'Markdown')
+        await reply.finish('hello')
+        return reply
+    reply = asyncio.run(main())
+    assert reply.sent == ['hello']
+    assert reply.abandoned == 0
+
+
+def test_fallback_bad_request_is_abandoned():
+    bot = FakeBot(errors=[telegram.error.BadRequest("Can't parse entities"),
+                          telegram.error.BadRequest("Message to edit not found")])
+
+    async def main():
+        reply = ReplyStream(bot, Message(1), 'Markdown')
+        await reply.finish('hello')
+        return reply
+    reply = asyncio.run(main())
+    assert reply.abandoned == 1
+    assert reply.sent == ['...']
+
+
+def test_forbidden_stops_the_reply():
+    bot = FakeBot(errors=[telegram.error.Forbidden("bot was blocked by the user")])
+    assert deliver(bot, ['hello', 'hello world']) == 'hello world'
+    assert len(bot.calls) == 1
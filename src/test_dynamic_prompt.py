@@ -0,0 +1,101 @@
+"""
+tests of dynamic_prompt token budget packing against the original implementation that
+dropped list elements one full prompt render at a time
+"""
+import random
+import pytest
+
+import tokens
+from dynamic_prompt import dynamic_prompt
+
+
+class FakeLLM:
+    """
+    the part of a langchain llm used by dynamic_prompt
+    """
+    model_name = "text-davinci-003"
+
+    def __init__(self, context : int) -> None:
+        self.context = context
+
+    def max_tokens_for_prompt(self, prompt : str) -> int:
+        return self.context - tokens.count(prompt, tokens.encoding_for_model(self.model_name))
+
+
+def reference_prompt(llm, response_tokens, f, *args, **kwargs):
+    # the original quadratic dynamic_prompt: drop the last element of every list until the prompt fits
+    def reduce_prompt(listitem):
+        if isinstance(listitem, list):
+            return listitem[:-1]
+        return listitem
+    while llm.max_tokens_for_prompt(f(*args, **kwargs)) < response_tokens:
+        args = tuple([reduce_prompt(a) for a in list(args)])
+        kwargs = {k: reduce_prompt(v) for k, v in kwargs.items()}
+    return f(*args, **kwargs)
+
+
+WORDS = "the of and a to in is you that it he was for on are as with his they at be this have from or one had by".split()
+
+
+def passages(rng, n, name='passage'):
+    return [f'{name} {k}: ' + ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 40))) + '.' for k in range(n)]
+
+
+def qa_prompt(context, question):
+    prompt  = "Use the following Context to answer the specified question.\n"
+    prompt += "Context:\n"
+    prompt += "\n".join(context)
+    prompt += f"\nQuestion: {question}\n"
+    prompt += "Answer: "
+    return prompt
+
+
+def two_list_prompt(context, examples, question):
+    return "Context:\n" + "\n".join(context) + "\nExamples:\n" + "\n".join(examples) + f"\nQuestion: {question}\nAnswer: "
+
+
+def kept(prompt, items):
+    # the items whose lines are in the prompt
+    lines = set(prompt.split('\n'))
+    return [item for item in items if item in lines]
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_single_list_matches_reference(seed):
+    rng = random.Random(seed)
+    llm = FakeLLM(rng.randint(200, 2000))
+    context = passages(rng, rng.randint(0, 60))
+    response_tokens = rng.randint(0, 150)
+    packed = dynamic_prompt(llm, response_tokens)(qa_prompt)(context, "what is it?")
+    expected = reference_prompt(llm, response_tokens, qa_prompt, context, "what is it?")
+    assert llm.max_tokens_for_prompt(packed) >= response_tokens
+    assert packed == expected
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_two_lists_fit_and_keep_at_least_the_reference(seed):
+    rng = random.Random(seed)
+    llm = FakeLLM(rng.randint(200, 2000))
+    context = passages(rng, rng.randint(0, 40))
+    examples = passages(rng, rng.randint(0, 40), 'example')
+    response_tokens = rng.randint(0, 150)
+    packed = dynamic_prompt(llm, response_tokens)(two_list_prompt)(context, examples=examples, question="why?")
+    expected = reference_prompt(llm, response_tokens, two_list_prompt, context, examples=examples, question="why?")
+    assert llm.max_tokens_for_prompt(packed) >= response_tokens
+    for items in (context, examples):
+        new, old = kept(packed, items), kept(expected, items)
+        assert new == items[:len(new)]      # a prefix of each list is kept
+        assert len(new) >= len(old)
+
+
+def test_priority_and_truncate_last():
+    rng = random.Random(0)
+    llm = FakeLLM(300)
+    context = passages(rng, 50)
+    packed = dynamic_prompt(llm, 50, priority=len, truncate_last=True)(qa_prompt)(context, "what?")
+    assert llm.max_tokens_for_prompt(packed) >= 50
+    longest = sorted(context, key=len, reverse=True)
+    included = kept(packed, context)
+    assert included == [c for c in context if c in longest[:len(included)]]
+    # the truncated element fills what is left of the budget
+    assert llm.max_tokens_for_prompt(packed) - 50 <= 2
@@ -0,0 +1,101 @@
+"""
+tests of the sqlite embedding cache
+"""
+import sqlite3
+import numpy as np
+import pytest
+
+import embcache
+from embcache import EmbeddingCache
+
+
+def vectors(n, dim=384, seed=0):
+    return list(np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32))
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return EmbeddingCache(str(tmp_path / 'embeddings.db'))
+
+
+def test_hit_and_miss(cache):
+    texts = ['a', 'b', 'c']
+    vs = vectors(3)
+    cache.put_batch('m1', texts[:2], vs[:2], [1, 2])
+    found = cache.get_batch('m1', ['a', 'c', 'b', 'a'])
+    assert found[1] is None
+    assert np.array_equal(found[0][0], vs[0]) and found[0][1] == 1
+    assert np.array_equal(found[2][0], vs[1]) and found[2][1] == 2
+    assert np.array_equal(found[3][0], vs[0])
+    assert cache.get_batch('m2', ['a']) == [None]     # keyed by model too
+    assert (cache.hits, cache.misses) == (3, 2)
+
+
+def test_many_keys(cache):
+    texts = [f'text {i}' for i in range(1200)]
+    cache.put_batch('m', texts[::2], vectors(600), [1] * 600)
+    found = cache.get_batch('m', texts)
+    assert [f is not None for f in found] == [i % 2 == 0 for i in range(1200)]
+
+
+class FailingConnection:
+    """
+    sqlite connection whose executemany fails after the transaction was begun
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def execute(self, *args):
+        return self.db.execute(*args)
+
+    def executemany(self, *args):
+        raise sqlite3.OperationalError('disk I/O error')
+
+    @property
+    def in_transaction(self):
+        return self.db.in_transaction
+
+
+def test_failed_put_is_rolled_back(cache):
+    db = cache.db
+    cache.db = FailingConnection(db)
+    cache.put_batch('m', ['a'], vectors(1), [1])
+    assert not db.in_transaction
+    cache.db = db
+    assert cache.get_batch('m', ['a']) == [None]
+    cache.put_batch('m', ['a'], vectors(1), [1])
+    assert cache.get_batch('m', ['a'])[0] is not None
+
+
+def test_used_at_is_refreshed_only_when_stale(cache, monkeypatch):
+    cache.put_batch('m', ['a', 'b'], vectors(2), [1, 1])
+    cache.db.execute("UPDATE embedding SET used_at = 0")
+    monkeypatch.setattr(embcache, 'EMBCACHE_TOUCH_SECONDS', 60)
+    cache.get_batch('m', ['a'])
+    used_at = dict(cache.db.execute("SELECT key, used_at FROM embedding"))
+    assert used_at[embcache.cache_key('m', 'a')] > 0
+    assert used_at[embcache.cache_key('m', 'b')] == 0
+    # a fresh entry is not written on lookup
+    cache.db.execute("UPDATE embedding SET used_at = used_at + 1 WHERE used_at > 0")
+    before = dict(cache.db.execute("SELECT key, used_at FROM embedding"))
+    cache.get_batch('m', ['a', 'b'])
+    after = dict(cache.db.execute("SELECT key, used_at FROM embedding"))
+    assert after[embcache.cache_key('m', 'a')] == before[embcache.cache_key('m', 'a')]
+    assert after[embcache.cache_key('m', 'b')] > 0
+
+
+def test_eviction_over_max_bytes(cache, monkeypatch):
+    monkeypatch.setattr(embcache, 'CHECK_INTERVAL', 100)
+    cache.max_bytes = 500 * 384 * 4
+    old = [f'old {i}' for i in range(300)]
+    cache.put_batch('m', old, vectors(300), [1] * 300)
+    cache.db.execute("UPDATE embedding SET used_at = 0")
+    for n in range(5):
+        texts = [f'new {n} {i}' for i in range(200)]
+        cache.put_batch('m', texts, vectors(200, seed=n + 1), [1] * 200)
+    assert cache.evictions > 0
+    assert cache.nbytes() <= cache.max_bytes
+    # the least recently used entries went first
+    assert cache.get_batch('m', old[:10]) == [None] * 10
+    assert cache.get_batch('m', ['new 4 0'])[0] is not None
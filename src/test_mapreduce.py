@@ -0,0 +1,126 @@
+"""
+tests of the token chunking and the concurrent map/reduce summarization with failing sections
+"""
+import asyncio
+import pytest
+
+import tokens
+import mapreduce
+from mapreduce import split_tokens, split_text, summarize_stream, SECTIONS_FAILED
+
+
+TEXT = "\n\n".join(" ".join(f"Sentence {p}.{s} has some words, numbers like {p * s} and naïve unicode." for s in range(12))
+                   + "\nA line without a full stop"
+                   for p in range(40))
+
+
+@pytest.mark.parametrize('chunk_tokens', [50, 200, 1000, 100000])
+def test_split_tokens_round_trip(chunk_tokens):
+    chunks = split_tokens(TEXT, chunk_tokens)
+    assert sum(chunks, []) == tokens.encode(TEXT)
+    assert all(0 < len(chunk) <= chunk_tokens for chunk in chunks)
+    assert tokens.decode(sum(chunks, [])) == TEXT
+
+
+def test_split_prefers_paragraphs():
+    chunks = split_text(TEXT, 1000)
+    assert len(chunks) > 1
+    assert all(chunk.endswith("\n\n") for chunk in chunks[:-1])
+
+
+def test_split_without_boundaries():
+    text = "x" * 5000
+    chunks = split_tokens(text, 64)
+    assert all(len(chunk) <= 64 for chunk in chunks)
+    assert tokens.decode(sum(chunks, [])) == text
+
+
+class FakeCompletions:
+    """
+    section summaries fail for the chunks in fail; records the peak number of concurrent map calls
+    """
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.active = 0
+        self.peak = 0
+        self.reduced = None
+
+    async def complete(self, prompt, text, max_tokens):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+        section = int(text.split()[1])
+        if section in self.fail:
+            raise RuntimeError(f"section {section} failed")
+        return str(section)     # short enough for the summaries to be reduced in one call
+
+    async def complete_stream(self, prompt, text, max_tokens):
+        self.reduced = text
+        yield "final"
+        yield "final summary"
+
+
+@pytest.fixture
+def completions(monkeypatch):
+    fake = FakeCompletions()
+    monkeypatch.setattr(mapreduce, '_complete', fake.complete)
+    monkeypatch.setattr(mapreduce, '_complete_stream', fake.complete_stream)
+    # one section per chunk
+    monkeypatch.setattr(mapreduce, 'split_text', lambda text: split_text(text, SECTION_TOKENS))
+    return fake
+
+
+def section(i):
+    return f"Section {i:02d} has a few words about topic {i:02d}.\n\n"
+
+
+SECTION_TOKENS = len(tokens.encode(section(0)))
+
+
+def sections(n):
+    return "".join(section(i) for i in range(n)).strip()
+
+
+def summarize(text):
+    async def main():
+        return [item async for item in summarize_stream(text, "summarize:")]
+    return asyncio.run(main())
+
+
+def test_map_reduce(completions):
+    items = summarize(sections(6))
+    assert items[-1] == ("finished", "final summary")
+    assert all(status == "not_finished" for status, _ in items[:-1])
+    assert completions.peak > 1
+    assert [int(s) for s in completions.reduced.split()] == list(range(6))
+
+
+def test_failed_sections_are_left_out(completions):
+    completions.fail = {1, 4}
+    status, summary = summarize(sections(6))[-1]
+    assert status == "finished"
+    assert summary.startswith(f"2 of 6 {SECTIONS_FAILED}.\n")
+    assert summary.endswith("final summary")
+    assert [int(s) for s in completions.reduced.split()] == [0, 2, 3, 5]
+
+
+def test_all_sections_failed(completions):
+    completions.fail = set(range(6))
+    with pytest.raises(RuntimeError):
+        summarize(sections(6))
+
+
+def test_truncated_text_is_noted(completions, monkeypatch):
+    monkeypatch.setattr(mapreduce, 'MAX_CHUNKS', 3)
+    status, summary = summarize(sections(6))[-1]
+    assert summary.startswith("Only first ")
+    assert [int(s) for s in completions.reduced.split()] == [0, 1, 2]
+
+
+def test_cut_text_is_noted(completions):
+    async def main():
+        return [item async for item in summarize_stream(sections(2), "summarize:", truncated=True)]
+    status, summary = asyncio.run(main())[-1]
+    assert summary.startswith("Only the beginning of the url content processed")
@@ -0,0 +1,118 @@
+"""
+tests of memo ingestion and the per-user memo indexes against a sqlite database and a fake embedder
+"""
+import sys
+import types
+import threading
+import numpy as np
+import pytest
+from sqlmodel import create_engine
+
+from embedding_model import ModelEmbedding, EmbeddingModelName
+
+
+DIM = 8
+
+
+class FakeEmbedder:
+    """
+    embeds "memo <i> ..." as a random unit vector seeded by i; counts the embed_batch calls
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def dim(self):
+        return DIM
+
+    def embed(self, text):
+        i = int(text.split()[1])
+        vector = np.random.default_rng(i).normal(size=DIM)
+        return ModelEmbedding(text=text, tokens=1, gpt2_tokens=1, vector=vector,
+                              model=EmbeddingModelName.multi_qa_mpnet_base_cos_v1)
+
+    def embed_batch(self, texts):
+        self.batches.append(len(texts))
+        return [self.embed(text) for text in texts]
+
+
+@pytest.fixture
+def embedder():
+    return FakeEmbedder()
+
+
+@pytest.fixture
+def memos(tmp_path, monkeypatch, embedder):
+    st = types.ModuleType('st')
+    st.get_model = lambda name: embedder
+    monkeypatch.setitem(sys.modules, 'st', st)
+    monkeypatch.delitem(sys.modules, 'memos', raising=False)
+    import memos
+    monkeypatch.setattr(memos, 'engine', create_engine(f"sqlite:///{tmp_path / 'memos.db'}", connect_args={'check_same_thread': False}))
+    return memos
+
+
+def texts(start, stop):
+    return [f"memo {i} text" for i in range(start, stop)]
+
+
+def test_chunked_ingest(memos, embedder, monkeypatch):
+    monkeypatch.setattr(memos, 'INGEST_CHUNK', 10)
+    ids = memos.ingest_memos(1, texts(0, 25) + ["", "  "])
+    assert embedder.batches == [10, 10, 5]
+    assert len(set(ids)) == 25
+    for i in (0, 9, 10, 24):
+        match = memos.nearest_memos(1, f"memo {i}", k=1)[0]
+        assert match.text == f"memo {i} text"
+        assert match.score == pytest.approx(1.0)
+
+
+def test_index_is_extended_by_ingest(memos):
+    memos.ingest_memos(1, texts(0, 5))
+    index = memos.user_index(1)
+    assert index.n == 5
+    memos.ingest_memos(1, texts(5, 40))
+    assert memos.user_index(1) is index
+    assert index.n == 40
+    assert memos.nearest_memos(1, "memo 33", k=1)[0].text == "memo 33 text"
+    assert memos._load_index(1).n == 40
+
+
+def test_users_are_separate(memos):
+    memos.ingest_memos(1, texts(0, 5))
+    memos.ingest_memos(2, texts(5, 10))
+    assert {m.text for m in memos.nearest_memos(2, "memo 0", k=10)} == set(texts(5, 10))
+
+
+def test_index_lru(memos, monkeypatch):
+    monkeypatch.setattr(memos, 'indexes', memos.LRUCache(2))
+    for user_id in (1, 2, 3):
+        memos.ingest_memos(user_id, texts(user_id * 10, user_id * 10 + 3))
+    index1 = memos.user_index(1)
+    memos.user_index(2)
+    memos.user_index(1)
+    memos.user_index(3)        # evicts user 2, the least recently searched
+    assert 2 not in memos.indexes
+    assert memos.user_index(1) is index1
+    # an evicted index is reloaded from the table
+    assert memos.nearest_memos(2, "memo 21", k=1)[0].text == "memo 21 text"
+
+
+def test_search_during_add(memos):
+    index = memos.UserIndex(DIM)
+    vectors = np.random.default_rng(0).normal(size=(2000, DIM)).astype(np.float32)
+    stop = threading.Event()
+
+    def add():
+        for i in range(0, 2000, 7):
+            index.add(list(range(i, min(i + 7, 2000))), vectors[i:i + 7])
+        stop.set()
+    thread = threading.Thread(target=add)
+    thread.start()
+    while not stop.is_set():
+        ids, scores = index.search(vectors[0], 3)
+        assert len(ids) == len(scores) <= 3
+        assert all(0 <= i < 2000 for i in ids)
+        assert ids[:1] in ([], [0])
+    thread.join()
+    assert index.search(vectors[1999], 1)[0] == [1999]
@@ -0,0 +1,153 @@
+"""
+tests of the retry decorator and circuit breaker state transitions
+"""
+import asyncio
+from time import sleep
+import pytest
+
+import retry as retry_module
+from retry import retry, CircuitBreaker, CircuitOpenException
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class OtherError(Exception):
+    pass
+
+
+@pytest.fixture
+def cb():
+    # a breaker that opens after 2 failures and goes half open after 50 ms
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.05)
+    retry_module.breakers['test'] = breaker
+    yield breaker
+    del retry_module.breakers['test']
+
+
+def half_open(cb):
+    cb.failure()
+    cb.failure()
+    assert cb.state == 'open'
+    sleep(0.06)
+    assert cb.state == 'half_open'
+
+
+def test_breaker_transitions(cb):
+    assert cb.state == 'closed'
+    cb.failure()
+    assert cb.state == 'closed'
+    cb.failure()
+    assert cb.state == 'open'
+    with pytest.raises(CircuitOpenException):
+        cb.allow()
+    sleep(0.06)
+    assert cb.state == 'half_open'
+    cb.allow()                          # the trial call
+    with pytest.raises(CircuitOpenException):
+        cb.allow()                      # only one trial at a time
+    cb.failure()
+    assert cb.state == 'open'           # failed trial reopens
+    sleep(0.06)
+    cb.allow()
+    cb.success()
+    assert cb.state == 'closed'
+    assert cb.failures == 0
+
+
+def test_retry_counts_failures_and_opens(cb):
+    calls = []
+
+    @retry(ExceptionToCheck=UpstreamError, tries=5, delay=0, breaker='test')
+    def f():
+        calls.append(1)
+        raise UpstreamError()
+
+    with pytest.raises(CircuitOpenException):
+        f()
+    assert len(calls) == 2
+    assert cb.state == 'open'
+
+
+def test_retry_exception_to_raise_is_success(cb):
+    @retry(ExceptionToCheck=UpstreamError, ExceptionToRaise=ValueError, tries=3, delay=0, breaker='test')
+    def f():
+        raise ValueError()
+
+    half_open(cb)
+    with pytest.raises(ValueError):
+        f()
+    assert cb.state == 'closed'
+
+
+def test_unlisted_exception_releases_trial(cb):
+    @retry(ExceptionToCheck=UpstreamError, tries=3, delay=0, breaker='test')
+    def f():
+        raise OtherError()
+
+    half_open(cb)
+    with pytest.raises(OtherError):
+        f()
+    assert not cb.trial
+    assert cb.state == 'open'           # counted as a failed trial
+    sleep(0.06)
+    cb.allow()                          # and a new trial is let through later
+
+
+def test_cancelled_coroutine_releases_trial(cb):
+    @retry(ExceptionToCheck=UpstreamError, tries=3, delay=0, breaker='test')
+    async def f():
+        await asyncio.sleep(10)
+
+    async def main():
+        task = asyncio.create_task(f())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    half_open(cb)
+    asyncio.run(main())
+    assert not cb.trial
+    assert cb.state == 'half_open'      # no outcome; the next call is the trial
+    cb.allow()
+
+
+def test_closed_async_generator_releases_trial(cb):
+    @retry(ExceptionToCheck=UpstreamError, tries=3, delay=0, breaker='test')
+    async def gen():
+        for i in range(10):
+            yield i
+
+    async def main():
+        g = gen()
+        assert await g.__anext__() == 0
+        await g.aclose()                # consumer stops early: GeneratorExit at the yield
+
+    half_open(cb)
+    asyncio.run(main())
+    assert not cb.trial
+    cb.allow()
+
+
+def test_async_generator_retried_only_before_first_item(cb):
+    calls = []
+
+    @retry(ExceptionToCheck=UpstreamError, tries=3, delay=0)
+    async def gen():
+        calls.append(1)
+        if len(calls) == 1:
+            raise UpstreamError()
+        yield 1
+        raise UpstreamError()
+
+    async def main():
+        items = []
+        with pytest.raises(UpstreamError):
+            async for item in gen():
+                items.append(item)
+        return items
+
+    assert asyncio.run(main()) == [1]
+    assert len(calls) == 2
@@ -0,0 +1,175 @@
+"""
+tests of the retrieval qa caching and search hedging, with fake search, completion and embedding
+"""
+import os
+import sys
+import types
+import asyncio
+import pytest
+
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from test_semcache import FakeEmbedder
+
+
+@pytest.fixture
+def rtr(monkeypatch):
+    st = types.ModuleType('st')
+    st.get_model = lambda name: FakeEmbedder()
+    monkeypatch.setitem(sys.modules, 'st', st)
+    monkeypatch.delitem(sys.modules, 'rtr', raising=False)
+    import lazy
+    monkeypatch.setattr(lazy, 'resources', {})
+    import rtr
+    return rtr
+
+
+def test_only_default_parameter_calls_are_cached(rtr):
+    calls = []
+
+    @rtr.cached(rtr.ask_cache)
+    def ask(question, max_total_tokens=rtr.MAX_TOTAL_TOKENS, k=rtr.K):
+        calls.append((question, max_total_tokens, k))
+        return f"answer {len(calls)}"
+
+    rtr.ask_cache()      # load the cache
+    assert ask("q0 0") == "answer 1"
+    assert ask("q0 1") == "answer 1"
+    assert ask("q0 1", k=5) == "answer 2"
+    assert ask("q2 0", max_total_tokens=1000) == "answer 3"
+    # answers searched with other parameters are not cached for default calls
+    assert ask("q2 0") == "answer 4"
+    assert ask("q0 0", rtr.MAX_TOTAL_TOKENS, rtr.K) == "answer 1"
+    assert calls[1:3] == [("q0 1", rtr.MAX_TOTAL_TOKENS, 5), ("q2 0", 1000, rtr.K)]
+    assert rtr.ask_cache().n == 2
+
+
+def test_questions_are_answered_while_the_cache_loads(rtr):
+    @rtr.cached(rtr.ask_cache)
+    def ask(question, max_total_tokens=rtr.MAX_TOTAL_TOKENS, k=rtr.K):
+        return "answer"
+
+    assert not rtr.ask_cache.ready
+    assert ask("q0 0") == "answer"
+    rtr.ask_cache.start().result()
+    assert rtr.ask_cache().n == 0
+
+
+def test_askchat_stream_caches_default_parameter_calls_only(rtr, monkeypatch):
+    searches = []
+
+    async def hedged_search(question, k, max_total_tokens):
+        searches.append((k, max_total_tokens))
+        return []
+
+    async def completion_stream(messages, temperature):
+        yield "not_finished", "an"
+        yield "finished", "answer"
+
+    monkeypatch.setattr(rtr, 'hedged_search', hedged_search)
+    monkeypatch.setattr(rtr, 'completion_stream', completion_stream)
+    rtr.askchat_cache()
+
+    async def ask(question, **kwargs):
+        return [item async for item in rtr.askchat_stream(question, **kwargs)][-1]
+
+    async def main():
+        assert await ask("q0 0", k=5) == ("finished", "answer")
+        assert rtr.askchat_cache().n == 0
+        assert await ask("q0 0") == ("finished", "answer")
+        assert await ask("q0 0") == ("finished", "answer")
+        assert await ask("q0 0", k=5) == ("finished", "answer")
+    asyncio.run(main())
+    assert searches == [(5, rtr.MAX_TOTAL_TOKENS), (rtr.K, rtr.MAX_TOTAL_TOKENS), (5, rtr.MAX_TOTAL_TOKENS)]
+
+
+def test_hedge_delay_percentile(rtr, monkeypatch):
+    monkeypatch.setattr(rtr, 'HEDGE_DELAY', 0.7)
+    monkeypatch.setattr(rtr, 'HEDGE_PERCENTILE', 90)
+    rtr.search_latencies.extend([0.01] * (rtr.HEDGE_MIN_SAMPLES - 1))
+    assert rtr.hedge_delay() == 0.7     # too few samples
+    rtr.search_latencies.clear()
+    rtr.search_latencies.extend(i / 100 for i in range(1, 101))
+    assert rtr.hedge_delay() == pytest.approx(0.901)
+    rtr.search_latencies.extend([2.0] * 100)    # only recent searches count
+    assert rtr.hedge_delay() == 2.0
+
+
+def test_search_latency_is_recorded(rtr, monkeypatch):
+    from time import sleep
+    monkeypatch.setattr(rtr, 'search', lambda question, k, max_total_tokens: sleep(0.05) or ['result'])
+    assert asyncio.run(rtr._search("q", 5, 100)) == ['result']
+    assert 0.05 <= rtr.search_latencies[-1] < 0.5
+
+
+class FakeSearches:
+    """
+    the nth search takes delays[n] seconds and fails if its delay is negative; records how each search ended
+    """
+
+    def __init__(self, *delays):
+        self.delays = list(delays)
+        self.ended = []
+
+    async def search(self, question, k, max_total_tokens):
+        n = len(self.ended)
+        self.ended.append(None)
+        delay = self.delays[n]
+        try:
+            await asyncio.sleep(abs(delay))
+        except asyncio.CancelledError:
+            self.ended[n] = 'cancelled'
+            raise
+        if delay < 0:
+            self.ended[n] = 'failed'
+            raise RuntimeError(f"search {n} failed")
+        self.ended[n] = 'done'
+        return [f"result {n}"]
+
+
+def hedged(rtr, monkeypatch, searches, delay=0.05):
+    monkeypatch.setattr(rtr, 'HEDGE_DELAY', delay)
+    monkeypatch.setattr(rtr, '_search', searches.search)
+
+    async def main():
+        result = await rtr.hedged_search("q")
+        await asyncio.sleep(0.01)    # let cancelled searches finish
+        return result
+    return asyncio.run(main())
+
+
+def test_fast_search_is_not_hedged(rtr, monkeypatch):
+    searches = FakeSearches(0.01)
+    assert hedged(rtr, monkeypatch, searches) == ["result 0"]
+    assert searches.ended == ['done']
+
+
+def test_slow_search_is_hedged_and_cancelled(rtr, monkeypatch):
+    searches = FakeSearches(10, 0.01)
+    assert hedged(rtr, monkeypatch, searches) == ["result 1"]
+    assert searches.ended == ['cancelled', 'done']
+
+
+def test_hedge_is_cancelled_when_the_first_search_wins(rtr, monkeypatch):
+    searches = FakeSearches(0.1, 10)
+    assert hedged(rtr, monkeypatch, searches) == ["result 0"]
+    assert searches.ended == ['done', 'cancelled']
+
+
+def test_failed_search_is_hedged(rtr, monkeypatch):
+    searches = FakeSearches(-0.01, 0.01)
+    assert hedged(rtr, monkeypatch, searches, delay=10) == ["result 1"]
+    assert searches.ended == ['failed', 'done']
+
+
+def test_slow_search_wins_when_the_hedge_fails(rtr, monkeypatch):
+    searches = FakeSearches(0.1, -0.01)
+    assert hedged(rtr, monkeypatch, searches) == ["result 0"]
+    assert searches.ended == ['done', 'failed']
+
+
+def test_both_searches_fail(rtr, monkeypatch):
+    searches = FakeSearches(-0.1, -0.01)
+    with pytest.raises(RuntimeError):
+        hedged(rtr, monkeypatch, searches)
+    assert searches.ended == ['failed', 'failed']
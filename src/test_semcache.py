@@ -0,0 +1,98 @@
+"""
+tests of the semantic answer cache with a fake embedder
+"""
+import numpy as np
+import pytest
+
+import semcache
+from semcache import SemanticCache
+
+
+class Embedding:
+    def __init__(self, vector):
+        self.vector = vector
+
+
+class FakeEmbedder:
+    """
+    embeds "q<i> <angle>" as the unit vector at angle degrees in the plane of axes i and i+1,
+    so the similarity of "q0 0" and "q0 <angle>" is cos(angle)
+    """
+
+    def dim(self):
+        return 16
+
+    def embed(self, text):
+        name, angle = text.split()
+        i = int(name[1:])
+        vector = np.zeros(16)
+        vector[i] = np.cos(np.radians(float(angle)))
+        vector[i + 1] = np.sin(np.radians(float(angle)))
+        return Embedding(vector)
+
+
+def make_cache(**kwargs):
+    return SemanticCache(FakeEmbedder(), **kwargs)
+
+
+def put(cache, question, answer):
+    _, vector = cache.get(question)
+    cache.put(question, vector, answer)
+
+
+def test_similarity_threshold():
+    cache = make_cache(threshold=np.cos(np.radians(20)))
+    put(cache, "q0 0", "zero")
+    assert cache.get("q0 0")[0] == "zero"
+    assert cache.get("q0 19")[0] == "zero"
+    assert cache.get("q0 21")[0] is None
+    assert cache.get("q2 0")[0] is None
+    assert (cache.hits, cache.misses) == (2, 3)
+    assert sum(cache.histogram) == 4     # the first lookup had nothing to compare with
+
+
+def test_best_match_is_returned():
+    cache = make_cache(threshold=0.5)
+    put(cache, "q0 0", "zero")
+    put(cache, "q0 40", "forty")
+    assert cache.get("q0 30")[0] == "forty"
+    assert cache.get("q0 5")[0] == "zero"
+
+
+def test_ttl_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(semcache, 'time', lambda: now[0])
+    cache = make_cache(ttl=60)
+    put(cache, "q0 0", "zero")
+    now[0] += 30
+    put(cache, "q2 0", "two")
+    now[0] += 31
+    assert cache.get("q0 0")[0] is None
+    assert cache.get("q2 0")[0] == "two"
+    assert cache.n == 1
+    now[0] += 30
+    assert cache.get("q2 0")[0] is None
+    assert cache.n == 0
+
+
+def test_least_recently_used_is_evicted(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(semcache, 'time', lambda: now[0])
+    cache = make_cache(max_entries=3)
+    for i in range(3):
+        now[0] += 1
+        put(cache, f"q{2 * i} 0", f"answer {i}")
+    now[0] += 1
+    assert cache.get("q0 0")[0] == "answer 0"    # q2 is now the least recently used
+    now[0] += 1
+    put(cache, "q6 0", "answer 3")
+    assert cache.n == 3
+    assert cache.get("q2 0")[0] is None
+    assert [cache.get(f"q{i} 0")[0] for i in (0, 4, 6)] == ["answer 0", "answer 2", "answer 3"]
+
+
+def test_unembeddable_question_is_not_cached():
+    cache = make_cache()
+    assert cache.get("not a question") == (None, None)
+    cache.put("not a question", None, "answer")
+    assert cache.n == 0
@@ -0,0 +1,99 @@
+"""
+tests of the bounded chat session store
+"""
+import asyncio
+from time import sleep
+from sessions import SessionStore
+from chatstack import ChatContext, AssistantMessage
+
+
+def make_store(tmp_path, **kwargs) -> SessionStore:
+    return SessionStore(path=str(tmp_path / 'sessions.db'), **kwargs)
+
+
+def test_lru_spill_and_rehydrate(tmp_path):
+    store = make_store(tmp_path, max_sessions=2)
+    for chat_id in (1, 2, 3):
+        store[chat_id] = ChatContext()
+    assert store.stats()['sessions'] == 2
+    assert store.stats()['spilled'] == 1
+    assert store.get(1) is not None
+    assert store.stats()['rehydrations'] == 1
+
+
+def test_pinned_session_is_not_spilled(tmp_path):
+    store = make_store(tmp_path, max_sessions=1)
+    with store.pinned(1):
+        context = store[1] = ChatContext()
+        for chat_id in (2, 3, 4):
+            store[chat_id] = ChatContext()
+        # a reply streamed into the pinned context must land in the session that is kept
+        context.messages.append(AssistantMessage(text="reply"))
+        assert store._sessions[1][0] is context
+    # released as the most recently used session; when spilled later it keeps the reply
+    assert list(store._sessions) == [1]
+    store[5] = ChatContext()
+    assert 1 not in store._sessions
+    assert [m.text for m in store.get(1).messages] == ["reply"]
+
+
+def test_pins_are_counted(tmp_path):
+    store = make_store(tmp_path, max_sessions=1)
+    with store.pinned(1):
+        store[1] = ChatContext()
+        with store.pinned(1):
+            pass
+        store[2] = ChatContext()
+        assert 1 in store._sessions
+    assert not store._pinned
+
+
+def test_rehydrated_session_keeps_its_spilled_copy(tmp_path):
+    store = make_store(tmp_path, max_sessions=1)
+    store[1] = ChatContext()
+    store[1].messages.append(AssistantMessage(text="before"))
+    store[2] = ChatContext()
+    context = store.get(1)
+    assert store.stats()['spilled'] == 2
+    # a crash before the session is spilled again loses only the messages since rehydration
+    context.messages.append(AssistantMessage(text="after"))
+    assert [m.text for m in make_store(tmp_path).get(1).messages] == ["before"]
+    store[3] = ChatContext()
+    assert [m.text for m in make_store(tmp_path).get(1).messages] == ["before", "after"]
+
+
+def test_idle_sessions_are_reclaimed(tmp_path):
+    store = make_store(tmp_path, ttl=0.05)
+    store[1] = ChatContext()
+    store[2] = ChatContext()
+    with store.pinned(2):
+        sleep(0.1)
+        store.reclaim()
+        assert list(store._sessions) == [2]
+    sleep(0.1)
+    store.reclaim()
+    assert not store._sessions
+    assert store.stats()['bytes'] == 0
+    assert store.stats()['spilled'] == 2
+
+
+def test_reclaim_task(tmp_path):
+    store = make_store(tmp_path, ttl=0.05)
+
+    async def main():
+        store.start(interval=0.02)
+        store[1] = ChatContext()
+        await asyncio.sleep(0.2)
+    asyncio.run(main())
+    assert not store._sessions
+    assert 1 in store
+
+
+def test_expired_spilled_sessions_are_deleted(tmp_path):
+    store = make_store(tmp_path, spill_ttl=0.05)
+    store[1] = ChatContext()
+    store.flush()
+    assert 1 in store
+    sleep(0.1)
+    store.reclaim()
+    assert 1 not in store
@@ -0,0 +1,82 @@
+"""
+tests of the fused tokenization and encoding of HFSentenceTransformer against the
+sentence transformer's own per-text tokenization and encode().
+JINGBOT_TEST_ST_MODEL selects the model (a hub name or a local directory)
+"""
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('sentence_transformers')
+
+os.environ.setdefault('HF_API_TOKEN', 'test')
+os.environ.setdefault('HF_INFERENCE_ENDPOINT', 'http://localhost:1')
+
+TEST_MODEL = os.environ.get('JINGBOT_TEST_ST_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+
+TEXTS = ["hello",
+         "The quick brown fox jumps over the lazy dog.",
+         "",
+         "naïve café — unicode, punctuation!?",
+         "hello",
+         " ".join(["a long text that is truncated to the model's maximum sequence length"] * 60)]
+
+
+@pytest.fixture(scope='module')
+def model(tmp_path_factory):
+    os.environ['JINGBOT_EMBCACHE_DB'] = str(tmp_path_factory.mktemp('embcache') / 'embeddings.db')
+    from st import HFSentenceTransformer
+    return HFSentenceTransformer(TEST_MODEL)
+
+
+def test_tokenize_matches_per_text_tokenizer(model):
+    tokenizer = model.st_model.tokenizer
+    assert model._tokenize(TEXTS) == [tokenizer(text, truncation=False, verbose=False)['input_ids'] for text in TEXTS]
+
+
+def test_num_tokens(model):
+    tokenizer = model.st_model.tokenizer
+    assert model.num_tokens("one\ntwo") == len(tokenizer("one two")['input_ids'])
+
+
+def test_encode_matches_sentence_transformer_encode(model):
+    assert len(model._tokenize(TEXTS[-1:])[0]) > model.max_tokens()
+    vectors = model._encode(model._tokenize(TEXTS))
+    expected = np.stack([model.st_model.encode(text) for text in TEXTS])
+    assert vectors.shape == (len(TEXTS), model.dim())
+    assert np.allclose(vectors, expected, atol=1e-5)
+
+
+def test_embed_batch_of_nothing(model):
+    import st
+    assert st.sizer.batches([]) == []
+    assert model.embed_batch([]) == []
+
+
+def test_batch_latency_excludes_failed_tries(monkeypatch, model):
+    import st
+    from time import sleep
+    from requests.exceptions import ConnectionError
+
+    class Response:
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {'embeddings': [[0.0]]}
+
+    calls = []
+
+    def post(url, json):
+        calls.append(1)
+        sleep(0.2)
+        if len(calls) == 1:
+            raise ConnectionError()
+        return Response()
+
+    sizer = st.BatchSizer(tokens=100, target_latency=1.0)
+    monkeypatch.setattr(st, 'sizer', sizer)
+    monkeypatch.setattr(st.session, 'post', post)
+    assert st.hf_embed_batch(["text"], [100]) == [[0.0]]
+    assert len(calls) == 2
+    assert 0.2 <= sizer.seconds_per_token * 100 < 0.3
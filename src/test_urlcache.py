@@ -0,0 +1,98 @@
+"""
+tests of url normalization and the content hash keyed url cache against a sqlite database
+"""
+import pytest
+from sqlmodel import create_engine
+
+from urlcache import UrlCache, normalize_url, content_hash
+
+
+@pytest.mark.parametrize('url, normalized', [
+    ('HTTPS://Example.COM/Path', 'https://example.com/Path'),
+    ('http://example.com:80/a', 'http://example.com/a'),
+    ('https://example.com:443/a', 'https://example.com/a'),
+    ('https://example.com:8443/a', 'https://example.com:8443/a'),
+    ('http://example.com:443/a', 'http://example.com:443/a'),
+    ('https://example.com/a#section', 'https://example.com/a'),
+    ('https://example.com/a/?b=2&a=1', 'https://example.com/a?a=1&b=2'),
+    ('https://example.com/a?b=2&a=1&a=0', 'https://example.com/a?a=0&a=1&b=2'),
+    ('https://example.com/a?utm_source=x&id=7&fbclid=y', 'https://example.com/a?id=7'),
+    ('https://example.com/a?flag=', 'https://example.com/a?flag='),
+    ('https://example.com', 'https://example.com/'),
+    ('  https://example.com/  ', 'https://example.com/'),
+])
+def test_normalize_url(url, normalized):
+    assert normalize_url(url) == normalized
+    assert normalize_url(normalized) == normalized
+
+
+@pytest.fixture
+def engine(tmp_path):
+    return create_engine(f"sqlite:///{tmp_path / 'urls.db'}", connect_args={'check_same_thread': False})
+
+
+def fetched(cache, url, content, etag=None):
+    chash = content_hash(content)
+    return cache.update_page(url, normalize_url(url), etag, None, chash), chash
+
+
+def test_page_validators(engine):
+    cache = UrlCache(engine)
+    assert cache.page('https://example.com/') is None
+    page, chash = fetched(cache, 'https://Example.com', b'<p>hello</p>', etag='"v1"')
+    assert page.content_hash == chash
+    assert page.conditional_headers() == {'If-None-Match': '"v1"'}
+    assert page.is_fresh(60) and not page.is_fresh(0)
+    assert UrlCache(engine).page('https://example.com/') == page
+
+
+def test_text_and_summary_are_keyed_by_content(engine):
+    cache = UrlCache(engine)
+    page, chash = fetched(cache, 'https://example.com/a', b'<p>hello</p>')
+    assert cache.text(chash) is None
+    assert cache.summary(chash, 'model', 'prompt') is None
+    cache.store_text(page, chash, 'hello', 'readability')
+    cache.store_summary(chash, 'model', 'prompt', 'a greeting')
+
+    # the same content under another url shares the text and summary
+    other, other_hash = fetched(cache, 'https://mirror.example.com/a', b'<p>hello</p>')
+    assert other_hash == chash and other.url_id != page.url_id
+    assert cache.text(other_hash) == 'hello'
+    assert cache.summary(other_hash, 'model', 'prompt') == 'a greeting'
+
+    # summaries are also keyed by model and prompt
+    assert cache.summary(chash, 'other model', 'prompt') is None
+    assert cache.summary(chash, 'model', 'other prompt') is None
+
+    # changed content misses
+    _, changed = fetched(cache, 'https://example.com/a', b'<p>hello again</p>')
+    assert cache.text(changed) is None
+    assert cache.summary(changed, 'model', 'prompt') is None
+
+
+def test_database_tier(engine):
+    cache = UrlCache(engine)
+    page, chash = fetched(cache, 'https://example.com/a', b'content')
+    cache.store_text(page, chash, 'text', 'readability', 'text/html')
+    cache.store_summary(chash, 'model', 'prompt', 'summary')
+    cold = UrlCache(engine)
+    assert cold.text(chash) == 'text'
+    assert cold.summary(chash, 'model', 'prompt') == 'summary'
+    assert chash in cold.texts
+    assert cold.summaries.get(cold._summary_key(chash, 'model', 'prompt')) == 'summary'
+
+
+def test_summary_without_text_is_not_persisted(engine):
+    cache = UrlCache(engine)
+    cache.store_summary('0' * 64, 'model', 'prompt', 'summary')
+    assert cache.summary('0' * 64, 'model', 'prompt') == 'summary'
+    assert UrlCache(engine).summary('0' * 64, 'model', 'prompt') is None
+
+
+def test_lru_tier_is_bounded(engine):
+    cache = UrlCache(engine, max_texts=2)
+    for i in range(3):
+        page, chash = fetched(cache, f'https://example.com/{i}', f'content {i}'.encode())
+        cache.store_text(page, chash, f'text {i}', 'readability')
+    assert content_hash(b'content 0') not in cache.texts
+    assert cache.text(content_hash(b'content 0')) == 'text 0'
@@ -0,0 +1,138 @@
+"""
+tests of the local memory-mapped vector index and the local retrieval backend
+"""
+import os
+import sys
+import types
+import numpy as np
+import pytest
+
+import vindex
+from vindex import VectorIndex
+
+
+DIM = 16
+
+
+class Embedding:
+    def __init__(self, vector):
+        self.vector = vector
+
+
+class FakeEmbedder:
+    """
+    embeds text "p<i>" as a vector near the center of cluster i % 20
+    """
+
+    def __init__(self):
+        rng = np.random.default_rng(0)
+        self.centers = rng.normal(size=(20, DIM))
+        self.fail_after = None     # raise after embedding this many batches
+        self.batches = 0
+
+    def vector(self, text):
+        i = int(text.split()[0][1:])
+        noise = np.random.default_rng(i).normal(scale=0.3, size=DIM)
+        return (self.centers[i % 20] + noise).astype(np.float32)
+
+    def dim(self):
+        return DIM
+
+    def embed(self, text):
+        return Embedding(self.vector(text))
+
+    def embed_batch(self, texts):
+        if self.fail_after is not None and self.batches >= self.fail_after:
+            raise RuntimeError("embedding failed")
+        self.batches += 1
+        return [self.embed(text) for text in texts]
+
+
+@pytest.fixture
+def embedder(monkeypatch):
+    embedder = FakeEmbedder()
+    st = types.ModuleType('st')
+    st.get_model = lambda name: embedder
+    monkeypatch.setitem(sys.modules, 'st', st)
+    return embedder
+
+
+def passages(start, stop):
+    return ({'text': f'p{i} text of passage {i}', 'source': 'test'} for i in range(start, stop))
+
+
+def test_build_and_search_recall(tmp_path, embedder):
+    index = VectorIndex.build(str(tmp_path / 'index'), passages(0, 2000), model='fake')
+    assert index.count == 2000
+    queries = [embedder.vector(f'p{i}') for i in range(0, 2000, 97)]
+    recall = []
+    for q in queries:
+        exact = set(index.exact(q, 10)[0].tolist())
+        assert set(index.search(q, 10, nprobe=index.nlist)[0].tolist()) == exact    # probing every list is exact
+        recall.append(len(exact & set(index.search(q, 10, nprobe=8)[0].tolist())) / 10)
+    assert np.mean(recall) >= 0.9
+    ids, sims = index.search(embedder.vector('p1234'), 1)
+    assert index.passage(int(ids[0]))['text'] == 'p1234 text of passage 1234'
+    assert list(sims) == sorted(sims, reverse=True)
+
+
+def test_build_rejects_empty_and_existing(tmp_path, embedder):
+    path = str(tmp_path / 'index')
+    with pytest.raises(ValueError):
+        VectorIndex.build(path, passages(0, 0))
+    assert not os.path.exists(path)
+    VectorIndex.build(path, passages(0, 10))
+    with pytest.raises(FileExistsError):
+        VectorIndex.build(path, passages(0, 10))
+    assert VectorIndex(path).count == 10
+
+
+def test_append(tmp_path, embedder):
+    index = VectorIndex.build(str(tmp_path / 'index'), passages(0, 100))
+    index.append(passages(100, 150))
+    assert index.count == 150
+    assert [index.passage(i)['text'].split()[0] for i in (0, 99, 100, 149)] == ['p0', 'p99', 'p100', 'p149']
+    ids, _ = index.search(embedder.vector('p120'), 1, nprobe=index.nlist)
+    assert ids[0] == 120
+
+
+def test_interrupted_append_is_dropped(tmp_path, embedder, monkeypatch):
+    path = str(tmp_path / 'index')
+    index = VectorIndex.build(path, passages(0, 100))
+    sizes = {name: os.path.getsize(os.path.join(path, name)) for name in ['vectors.f32', 'lists.i32', 'offsets.i64', 'texts.jsonl']}
+    monkeypatch.setattr(vindex, 'EMBED_BATCH', 10)
+    embedder.fail_after = embedder.batches + 2
+    with pytest.raises(RuntimeError):
+        index.append(passages(100, 150))
+    # the first two batches were written but not committed
+    assert os.path.getsize(os.path.join(path, 'texts.jsonl')) > sizes['texts.jsonl']
+    assert VectorIndex(path).count == 100
+    embedder.fail_after = None
+    index.append(passages(200, 210))
+    assert index.count == 110
+    assert [index.passage(i)['text'].split()[0] for i in (99, 100, 109)] == ['p99', 'p200', 'p209']
+    assert os.path.getsize(os.path.join(path, 'vectors.f32')) == sizes['vectors.f32'] + 10 * DIM * 4
+    assert os.path.getsize(os.path.join(path, 'offsets.i64')) == sizes['offsets.i64'] + 10 * 8
+
+
+def test_reader_refreshes_after_append(tmp_path, embedder):
+    path = str(tmp_path / 'index')
+    VectorIndex.build(path, passages(0, 50))
+    reader = VectorIndex(path)
+    VectorIndex(path).append(passages(50, 60))
+    assert reader.count == 50
+    ids, _ = reader.search(embedder.vector('p55'), 1, nprobe=reader.nlist)
+    assert reader.count == 60
+    assert ids[0] == 55
+
+
+def test_local_backend_token_limit(tmp_path, embedder):
+    from retrieval import LocalIndexBackend
+    index = VectorIndex.build(str(tmp_path / 'index'), passages(0, 200))
+    backend = LocalIndexBackend(index.path)
+    results = backend.search('p42', k=5, max_total_tokens=10**6)
+    assert len(results) == 5
+    assert results[0].text.startswith('p42 ')
+    assert [r.score for r in results] == sorted([r.score for r in results], reverse=True)
+    limit = results[0].token_count + results[1].token_count
+    assert [r.text for r in backend.search('p42', k=5, max_total_tokens=limit)] == [r.text for r in results[:2]]
@@ -0,0 +1,71 @@
+"""
+tests of the html text extraction
+"""
+import lxml.html
+from readability import Document
+
+from webpage import extract_text, extract_text_from_html, html_to_text
+
+
+ARTICLE = """<html><head><title>t</title><script>var x = 1;</script></head><body>
+<div id="nav"><a href="/">Home</a> <a href="/about">About</a></div>
+<div id="article">
+<h1>A headline</h1>
+%s
+</div>
+<div id="footer">Copyright</div>
+</body></html>"""
+
+PARAGRAPH = "<p>The quick brown fox jumps over the lazy dog, <b>again</b> and again.<!-- c --> Then it rests.</p>\n"
+
+
+def page(paragraphs : int = 20) -> str:
+    return ARTICLE % (PARAGRAPH * paragraphs)
+
+
+def test_summary_leaves_article_tree_in_doc_html():
+    # html_to_text relies on Document.summary() leaving its cleaned article tree in doc.html
+    doc = Document(page())
+    summary = doc.summary()
+    assert extract_text(doc.html)[0].split() == extract_text(lxml.html.document_fromstring(summary))[0].split()
+
+
+def test_html_to_text():
+    text, truncated = html_to_text(page())
+    assert "quick brown fox" in text
+    assert "var x" not in text
+    assert not truncated
+
+
+def test_truncated_text_is_flagged():
+    full, truncated = html_to_text(page(200))
+    assert not truncated
+    text, truncated = html_to_text(page(200), max_chars=1000)
+    assert len(text) == 1000
+    assert full.startswith(text)
+    assert truncated
+    # text that fits exactly is not cut
+    assert html_to_text(page(200), max_chars=len(full))[1] is False
+
+
+def test_extract_text_stops_at_max_chars():
+    # the walk stops once max_chars are collected instead of visiting the rest of the tree
+    visited = []
+
+    class Element(lxml.html.HtmlElement):
+        def __iter__(self):
+            visited.append(self)
+            return super().__iter__()
+
+    parser = lxml.html.HTMLParser()
+    parser.set_element_class_lookup(lxml.html.etree.ElementDefaultClassLookup(element=Element))
+    root = lxml.html.document_fromstring(page(200), parser=parser)
+    text, truncated = extract_text(root, max_chars=100)
+    assert truncated and len(text) == 100
+    assert len(visited) < 20
+
+
+def test_extract_text_from_html():
+    text = extract_text_from_html("<html><body><p>one <i>two</i> three</p><script>x</script></body></html>")
+    assert text.split() == ['one', 'two', 'three']
+    assert extract_text_from_html("  ") == ''
@@ -0,0 +1,86 @@
+"""
+Shared tiktoken tokenization service
+Copyright (C) 2023 Jiggy AI
+
+One place to get tiktoken encodings, encode texts in batches and count tokens.
+Token counts are memoized by (encoding, content hash) so repeated texts such as
+role prompts are only tokenized once.
+"""
+import os
+from functools import lru_cache
+from hashlib import blake2b
+from typing import List
+import tiktoken
+
+from lru import LRUCache
+
+
+DEFAULT_ENCODING = "cl100k_base"
+
+TOKEN_COUNT_CACHE_SIZE = int(os.environ.get('JINGBOT_TOKEN_COUNT_CACHE_SIZE', 65536))
+
+count_cache = LRUCache(TOKEN_COUNT_CACHE_SIZE)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding : str = DEFAULT_ENCODING) -> tiktoken.Encoding:
+    """
+    return the (shared) tiktoken encoding
+    """
+    return tiktoken.get_encoding(encoding)
+
+
+@lru_cache(maxsize=None)
+def encoding_for_model(model : str) -> str:
+    """
+    return the name of the encoding used by the openai model
+    """
+    return tiktoken.encoding_for_model(model).name
+
+
+def _key(text : str, encoding : str) -> tuple:
+    return (encoding, blake2b(text.encode('utf-8', errors='surrogatepass'), digest_size=16).digest())
+
+
+def encode(text : str, encoding : str = DEFAULT_ENCODING) -> List[int]:
+    """
+    return the tokens of text. special tokens are encoded as ordinary text.
+    """
+    return get_encoding(encoding).encode_ordinary(text)
+
+
+def encode_batch(texts : List[str], encoding : str = DEFAULT_ENCODING) -> List[List[int]]:
+    """
+    return the tokens of each of the texts, encoded in parallel by tiktoken
+    """
+    return get_encoding(encoding).encode_ordinary_batch(texts)
+
+
+def decode(tokens : List[int], encoding : str = DEFAULT_ENCODING) -> str:
+    return get_encoding(encoding).decode(tokens)
+
+
+def count(text : str, encoding : str = DEFAULT_ENCODING) -> int:
+    """
+    return the number of tokens in text
+    """
+    key = _key(text, encoding)
+    n = count_cache.get(key)
+    if n is None:
+        n = len(encode(text, encoding))
+        count_cache.put(key, n)
+    return n
+
+
+def count_batch(texts : List[str], encoding : str = DEFAULT_ENCODING) -> List[int]:
+    """
+    return the number of tokens in each of the texts, batch encoding the texts not already counted
+    """
+    keys = [_key(text, encoding) for text in texts]
+    counts = [count_cache.get(key) for key in keys]
+    misses = [i for i, n in enumerate(counts) if n is None]
+    if misses:
+        for i, tokens in zip(misses, encode_batch([texts[i] for i in misses], encoding)):
+            counts[i] = len(tokens)
+            count_cache.put(keys[i], counts[i])
+    return counts
@@ -0,0 +1,213 @@
+"""
+Two tier url content & summary cache
+Copyright (C) 2023 Jiggy AI
+
+Tier 1 is an in-memory LRU, tier 2 is the URL, UrlText and UrlSummary tables
+accessed via db.engine (sqlite locally, postgres in production).
+
+Pages are keyed by normalized url and carry the ETag / Last-Modified validators
+from the last fetch so they can be revalidated with a conditional GET.
+Extracted text and summaries are keyed by the sha256 hash of the page content,
+so an unchanged page (or the same page under a different url) reuses its
+stored summary without another completion.
+"""
+from loguru import logger
+from typing import Optional
+from hashlib import sha256
+from time import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from pydantic import BaseModel
+from sqlmodel import Session, SQLModel, select
+
+from lru import LRUCache
+from models import URL, UrlText, UrlSummary
+
+
+# query parameters that only track the referrer and do not change the content
+TRACKING_PARAMS = ('utm_', 'fbclid', 'gclid', 'mc_cid', 'mc_eid', 'ref_src')
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url : str) -> str:
+    """
+    return a canonical form of url for use as a cache key:
+    lower case scheme & host, no default port, no fragment, no tracking
+    query parameters and sorted query parameters.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{parts.port}'
+    path = parts.path or '/'
+    if len(path) > 1:
+        path = path.rstrip('/')
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+             if not k.lower().startswith(TRACKING_PARAMS)]
+    return urlunsplit((scheme, host, path, urlencode(sorted(query)), ''))
+
+
+def content_hash(content : bytes) -> str:
+    """
+    return the hex sha256 of the page content
+    """
+    return sha256(content).hexdigest()
+
+
+class CachedPage(BaseModel):
+    """
+    the cached state of a url as of the last fetch
+    """
+    url_id:         int
+    normalized_url: str
+    etag:           Optional[str]
+    last_modified:  Optional[str]
+    content_hash:   Optional[str]
+    fetched_at:     float
+
+    def is_fresh(self, max_age : float) -> bool:
+        """
+        return True if the page was fetched or revalidated within max_age seconds
+        """
+        return self.content_hash is not None and time() - self.fetched_at < max_age
+
+    def conditional_headers(self) -> dict:
+        """
+        return the request headers for a conditional GET against this page
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class UrlCache:
+
+    def __init__(self, engine, max_pages=4096, max_texts=256, max_summaries=4096) -> None:
+        self.engine = engine
+        self.pages = LRUCache(max_pages)          # normalized_url -> CachedPage
+        self.texts = LRUCache(max_texts)          # content_hash -> (text_id, text)
+        self.summaries = LRUCache(max_summaries)  # (content_hash, model, prefix hash) -> summary
+        SQLModel.metadata.create_all(engine, tables=[URL.__table__, UrlText.__table__, UrlSummary.__table__])
+
+    def page(self, normalized_url : str) -> Optional[CachedPage]:
+        """
+        return the CachedPage for the normalized url or None if it has never been fetched
+        """
+        page = self.pages.get(normalized_url)
+        if page:
+            return page
+        with Session(self.engine) as session:
+            url = session.exec(select(URL).where(URL.normalized_url == normalized_url).order_by(URL.id.desc())).first()
+            if not url:
+                return None
+            page = CachedPage(url_id         = url.id,
+                              normalized_url = url.normalized_url,
+                              etag           = url.etag,
+                              last_modified  = url.last_modified,
+                              content_hash   = url.content_hash,
+                              fetched_at     = float(url.fetched_at))
+        self.pages.put(normalized_url, page)
+        return page
+
+    def update_page(self,
+                    url            : str,
+                    normalized_url : str,
+                    etag           : Optional[str],
+                    last_modified  : Optional[str],
+                    content_hash   : str,
+                    user_id        : Optional[int] = None) -> CachedPage:
+        """
+        record the validators and content hash from a fetch of the url
+        """
+        with Session(self.engine) as session:
+            row = session.exec(select(URL).where(URL.normalized_url == normalized_url).order_by(URL.id.desc())).first()
+            if row is None:
+                row = URL(url=url, normalized_url=normalized_url, user_id=user_id)
+            row.etag = etag
+            row.last_modified = last_modified
+            row.content_hash = content_hash
+            row.fetched_at = time()
+            session.add(row)
+            session.commit()
+            session.refresh(row)
+            page = CachedPage(url_id         = row.id,
+                              normalized_url = normalized_url,
+                              etag           = etag,
+                              last_modified  = last_modified,
+                              content_hash   = content_hash,
+                              fetched_at     = float(row.fetched_at))
+        self.pages.put(normalized_url, page)
+        return page
+
+    def _text(self, session, chash : str) -> Optional[UrlText]:
+        return session.exec(select(UrlText).where(UrlText.content_hash == chash).order_by(UrlText.id.desc())).first()
+
+    def text(self, chash : str) -> Optional[str]:
+        """
+        return the previously extracted text for the content hash or None
+        """
+        cached = self.texts.get(chash)
+        if cached:
+            return cached[1]
+        with Session(self.engine) as session:
+            row = self._text(session, chash)
+            if row is None:
+                return None
+            self.texts.put(chash, (row.id, row.text))
+            return row.text
+
+    def store_text(self, page : CachedPage, chash : str, text : str, mechanism : str, content_type : Optional[str] = None) -> int:
+        """
+        store the text extracted from the page content, returning the UrlText id
+        """
+        with Session(self.engine) as session:
+            row = UrlText(url_id       = page.url_id,
+                          mechanism    = mechanism,
+                          content_hash = chash,
+                          text         = text,
+                          content_type = content_type)
+            session.add(row)
+            session.commit()
+            session.refresh(row)
+            self.texts.put(chash, (row.id, text))
+            return row.id
+
+    @staticmethod
+    def _summary_key(chash : str, model : str, prefix : str) -> tuple:
+        return (chash, model, sha256(prefix.encode()).hexdigest())
+
+    def summary(self, chash : str, model : str, prefix : str) -> Optional[str]:
+        """
+        return the stored summary of the content produced by model with prompt prefix, or None
+        """
+        key = self._summary_key(chash, model, prefix)
+        summary = self.summaries.get(key)
+        if summary is not None:
+            return summary
+        with Session(self.engine) as session:
+            summary = session.exec(select(UrlSummary.summary)
+                                   .join(UrlText, UrlSummary.text_id == UrlText.id)
+                                   .where(UrlText.content_hash == chash,
+                                          UrlSummary.model == model,
+                                          UrlSummary.prefix == prefix)
+                                   .order_by(UrlSummary.id.desc())).first()
+        if summary is not None:
+            self.summaries.put(key, summary)
+        return summary
+
+    def store_summary(self, chash : str, model : str, prefix : str, summary : str) -> None:
+        """
+        store the summary of the text with content hash chash
+        """
+        self.summaries.put(self._summary_key(chash, model, prefix), summary)
+        with Session(self.engine) as session:
+            text = self._text(session, chash)
+            if text is None:
+                logger.warning(f"no UrlText for content hash {chash}, summary not persisted")
+                return
+            session.add(UrlSummary(text_id=text.id, model=model, prefix=prefix, summary=summary))
+            session.commit()
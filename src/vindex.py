@@ -0,0 +1,357 @@
+"""
+Local memory-mapped vector index
+Copyright (C) 2023 Jiggy AI
+
+An IVF (inverted file) index over HFSentenceTransformer embeddings of text
+passages.  Vectors are normalized and clustered around nlist centroids
+(spherical k-means); a search scores the query against the centroids and then
+only against the vectors in the nprobe closest lists.
+
+The index is a directory of flat files:
+meta.json       model name, dimension, nlist and the number of committed passages
+centroids.f32   nlist x dim float32 centroids
+vectors.f32     count x dim float32 normalized passage embeddings
+lists.i32       list (centroid) number of each passage
+offsets.i64     offset of each passage record in texts.jsonl
+texts.jsonl     passage records {"text", "token_count", "source"}
+
+The vector and list files are opened as read-only memory maps so every bot
+process serving the index shares the same page cache.  Appends write the data
+files first and commit by atomically replacing meta.json, so readers never see
+a partial passage; readers pick up appended passages on their next search.
+Builds and appends hold an exclusive lock on the file "lock" in the index
+directory, and an append first cuts every data file back to the committed
+passages, dropping whatever an interrupted append left behind.  An index is
+never rebuilt in place, since processes serving it have its files mapped:
+build a new index in another directory and point JINGBOT_VINDEX_PATH at it.
+
+usage:
+    python vindex.py build  INDEX_DIR FILE... [--model M] [--nlist N]
+    python vindex.py append INDEX_DIR FILE...
+    python vindex.py bench  INDEX_DIR [--k K] [--nprobe 1,4,16] [--queries FILE]
+
+FILEs are .jsonl with a "text" (and optional "source") field per line, or
+plain text with one passage per blank-line separated paragraph.
+"""
+from loguru import logger
+import os
+import sys
+import json
+import argparse
+import fcntl
+from contextlib import contextmanager
+from itertools import chain
+from time import perf_counter
+from typing import Iterator, List, Tuple
+import numpy as np
+
+import tokens
+
+
+VINDEX_MODEL  = os.environ.get('JINGBOT_VINDEX_MODEL', 'multi-qa-mpnet-base-cos-v1')
+VINDEX_NPROBE = int(os.environ.get('JINGBOT_VINDEX_NPROBE', 8))
+
+EMBED_BATCH = 256          # passages embedded per batch when building or appending
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE = 64         # k-means is trained on at most this many vectors per centroid
+SCAN_CHUNK = 65536         # vectors scored per chunk by exact search and list assignment
+
+
+def _normalize(x : np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return (x / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+def kmeans(x : np.ndarray, nlist : int, iterations : int = KMEANS_ITERATIONS, seed : int = 0) -> np.ndarray:
+    """
+    return nlist normalized centroids of the normalized vectors x (spherical k-means on a sample)
+    """
+    rng = np.random.default_rng(seed)
+    sample = np.asarray(x[np.sort(rng.choice(len(x), min(len(x), nlist * KMEANS_SAMPLE), replace=False))])
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        empty = np.flatnonzero(np.bincount(assignment, minlength=nlist) == 0)
+        sums[empty] = sample[rng.choice(len(sample), len(empty))]   # reseed empty lists
+        centroids = _normalize(sums)
+    return centroids
+
+
+def assign(x : np.ndarray, centroids : np.ndarray) -> np.ndarray:
+    """
+    return the number of the closest centroid of each of the vectors x
+    """
+    return np.concatenate([np.argmax(x[i:i+SCAN_CHUNK] @ centroids.T, axis=1)
+                           for i in range(0, len(x), SCAN_CHUNK)] or [np.zeros(0)]).astype(np.int32)
+
+
+def read_passages(filename : str) -> Iterator[dict]:
+    """
+    yield {"text", "source"} passages from a .jsonl file or a plain text file of paragraphs
+    """
+    with open(filename) as f:
+        if filename.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield {'text': record['text'], 'source': record.get('source', filename)}
+        else:
+            for paragraph in f.read().split('\n\n'):
+                if paragraph.strip():
+                    yield {'text': paragraph.strip(), 'source': filename}
+
+
+class VectorIndex:
+    """
+    memory-mapped IVF index of text passages
+    """
+
+    def __init__(self, path : str) -> None:
+        self.path = path
+        self._mtime = None
+        self._load()
+
+    def _file(self, name : str) -> str:
+        return os.path.join(self.path, name)
+
+    def _load(self) -> None:
+        self._mtime = os.stat(self._file('meta.json')).st_mtime_ns
+        with open(self._file('meta.json')) as f:
+            self.meta = json.load(f)
+        self.model = self.meta['model']
+        self.dim = self.meta['dim']
+        self.nlist = self.meta['nlist']
+        self.count = self.meta['count']
+        self.centroids = np.fromfile(self._file('centroids.f32'), dtype=np.float32).reshape(self.nlist, self.dim)
+        if self.count:
+            self.vectors = np.memmap(self._file('vectors.f32'), dtype=np.float32, mode='r', shape=(self.count, self.dim))
+            self.lists = np.memmap(self._file('lists.i32'), dtype=np.int32, mode='r', shape=(self.count,))
+            self.offsets = np.memmap(self._file('offsets.i64'), dtype=np.int64, mode='r', shape=(self.count,))
+        else:
+            self.vectors = np.zeros((0, self.dim), dtype=np.float32)
+            self.lists = np.zeros(0, dtype=np.int32)
+            self.offsets = np.zeros(0, dtype=np.int64)
+        # posting lists: passages of list l are order[bounds[l]:bounds[l+1]], in passage order
+        self.order = np.argsort(self.lists, kind='stable').astype(np.int32)
+        self.bounds = np.searchsorted(self.lists[self.order], np.arange(self.nlist + 1))
+        logger.info(f"vindex {self.path}: {self.count} passages, {self.nlist} lists, model {self.model}")
+
+    def refresh(self) -> None:
+        """
+        reload the index if passages have been appended by another process
+        """
+        if os.stat(self._file('meta.json')).st_mtime_ns != self._mtime:
+            self._load()
+
+    def search(self, vector : np.ndarray, k : int = 10, nprobe : int = VINDEX_NPROBE) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        return the (passage ids, similarities) of the approximate k nearest passages to vector, best first
+        """
+        self.refresh()
+        q = _normalize(np.asarray(vector, dtype=np.float32))
+        nprobe = min(nprobe, self.nlist)
+        probe = np.argpartition(-(self.centroids @ q), nprobe - 1)[:nprobe]
+        members = np.sort(np.concatenate([self.order[self.bounds[l]:self.bounds[l+1]] for l in probe]))
+        return self._top(members, self.vectors[members] @ q, k)
+
+    def exact(self, vector : np.ndarray, k : int = 10) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        return the (passage ids, similarities) of the exact k nearest passages to vector, best first
+        """
+        q = _normalize(np.asarray(vector, dtype=np.float32))
+        sims = np.concatenate([self.vectors[i:i+SCAN_CHUNK] @ q for i in range(0, self.count, SCAN_CHUNK)] or [np.zeros(0)])
+        return self._top(np.arange(self.count), sims, k)
+
+    @staticmethod
+    def _top(ids : np.ndarray, sims : np.ndarray, k : int) -> Tuple[np.ndarray, np.ndarray]:
+        if len(sims) > k:
+            top = np.argpartition(-sims, k - 1)[:k]
+        else:
+            top = np.arange(len(sims))
+        top = top[np.argsort(-sims[top])]
+        return ids[top], sims[top]
+
+    def passage(self, i : int) -> dict:
+        """
+        return the record {"text", "token_count", "source"} of passage i
+        """
+        with open(self._file('texts.jsonl'), 'rb') as f:
+            f.seek(int(self.offsets[i]))
+            return json.loads(f.readline())
+
+    @classmethod
+    def build(cls, path : str, passages : Iterator[dict], model : str = VINDEX_MODEL, nlist : int = None) -> "VectorIndex":
+        """
+        build a new index at path over the passages.
+        raises ValueError if there are no passages and FileExistsError if there is an index at path
+        """
+        from st import get_model
+        passages = iter(passages)
+        first = next(passages, None)
+        if first is None:
+            raise ValueError(f"no passages to build the index {path} from")
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            raise FileExistsError(f"an index already exists at {path}")
+        embedder = get_model(model)
+        os.makedirs(path, exist_ok=True)
+        with _locked(path):
+            if os.path.exists(os.path.join(path, 'meta.json')):    # built by another process meanwhile
+                raise FileExistsError(f"an index already exists at {path}")
+            for name in ['vectors.f32', 'lists.i32', 'offsets.i64', 'texts.jsonl']:
+                open(os.path.join(path, name), 'wb').close()
+            count = _append_passages(path, embedder, chain([first], passages))
+            vectors = np.memmap(os.path.join(path, 'vectors.f32'), dtype=np.float32, mode='r', shape=(count, embedder.dim()))
+            nlist = min(count, nlist or max(1, int(4 * np.sqrt(count))))
+            logger.info(f"training {nlist} centroids on {count} passages")
+            centroids = kmeans(vectors, nlist)
+            centroids.tofile(os.path.join(path, 'centroids.f32'))
+            assign(vectors, centroids).tofile(os.path.join(path, 'lists.i32'))
+            _commit(path, {'model': model, 'dim': embedder.dim(), 'nlist': nlist, 'count': count})
+        return cls(path)
+
+    def append(self, passages : Iterator[dict]) -> None:
+        """
+        embed and add the passages to the index, assigning them to the existing lists
+        """
+        from st import get_model
+        embedder = get_model(self.model)
+        with _locked(self.path):
+            self.refresh()
+            self._truncate()
+            count = _append_passages(self.path, embedder, passages, self.centroids)
+            _commit(self.path, dict(self.meta, count=self.count + count))
+        self._load()
+
+    def _truncate(self) -> None:
+        # cut every data file back to the committed passages, dropping the uncommitted tail of an interrupted append
+        os.truncate(self._file('vectors.f32'), self.count * 4 * self.dim)
+        os.truncate(self._file('lists.i32'), self.count * 4)
+        os.truncate(self._file('offsets.i64'), self.count * 8)
+        texts_size = 0
+        if self.count:
+            with open(self._file('texts.jsonl'), 'rb') as f:
+                f.seek(int(self.offsets[self.count - 1]))
+                texts_size = f.tell() + len(f.readline())
+        os.truncate(self._file('texts.jsonl'), texts_size)
+
+
+@contextmanager
+def _locked(path : str):
+    # hold an exclusive lock on the index at path, waiting for any other build or append to finish
+    with open(os.path.join(path, 'lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _batches(items : Iterator, n : int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _append_passages(path : str, embedder, passages : Iterator[dict], centroids : np.ndarray = None) -> int:
+    # embed and write passages in batches; assign them to lists if centroids are given.  return the number written
+    count = 0
+    with open(os.path.join(path, 'texts.jsonl'), 'ab') as texts, \
+         open(os.path.join(path, 'offsets.i64'), 'ab') as offsets, \
+         open(os.path.join(path, 'vectors.f32'), 'ab') as vectors, \
+         open(os.path.join(path, 'lists.i32'), 'ab') as lists:
+        for batch in _batches(passages, EMBED_BATCH):
+            texts_ = [p['text'] for p in batch]
+            v = _normalize(np.array([e.vector for e in embedder.embed_batch(texts_)], dtype=np.float32))
+            for p, token_count in zip(batch, tokens.count_batch(texts_)):
+                np.array([texts.tell()], dtype=np.int64).tofile(offsets)
+                texts.write(json.dumps({'text': p['text'], 'token_count': token_count, 'source': p.get('source')}).encode() + b'\n')
+            v.tofile(vectors)
+            if centroids is not None:
+                assign(v, centroids).tofile(lists)
+            count += len(batch)
+            logger.info(f"embedded {count} passages")
+    return count
+
+
+def _commit(path : str, meta : dict) -> None:
+    # atomically publish meta.json, making the passages it counts visible to readers
+    tmp = os.path.join(path, 'meta.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(path, 'meta.json'))
+
+
+def bench(index : VectorIndex, k : int, nprobes : List[int], queries : List[np.ndarray]) -> None:
+    """
+    print the recall@k against exact search and the search latency percentiles for each nprobe
+    """
+    exact = []
+    t = []
+    for q in queries:
+        t0 = perf_counter()
+        exact.append(set(index.exact(q, k)[0].tolist()))
+        t.append(perf_counter() - t0)
+    print(f"{index.count} passages, {index.nlist} lists, {len(queries)} queries, k={k}")
+    print(f"exact        recall 1.000  p50 {np.percentile(t, 50)*1000:7.2f} ms  p95 {np.percentile(t, 95)*1000:7.2f} ms  p99 {np.percentile(t, 99)*1000:7.2f} ms")
+    for nprobe in nprobes:
+        recall = []
+        t = []
+        for q, truth in zip(queries, exact):
+            t0 = perf_counter()
+            ids, _ = index.search(q, k, nprobe)
+            t.append(perf_counter() - t0)
+            recall.append(len(truth & set(ids.tolist())) / max(1, len(truth)))
+        print(f"nprobe {nprobe:<5} recall {np.mean(recall):.3f}  p50 {np.percentile(t, 50)*1000:7.2f} ms  p95 {np.percentile(t, 95)*1000:7.2f} ms  p99 {np.percentile(t, 99)*1000:7.2f} ms")
+
+
+def main(argv : List[str]) -> None:
+    parser = argparse.ArgumentParser(description="build, extend and benchmark a local vector index")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('build', help="build a new index from passage files")
+    p.add_argument('path')
+    p.add_argument('files', nargs='+')
+    p.add_argument('--model', default=VINDEX_MODEL)
+    p.add_argument('--nlist', type=int, default=None)
+    p = sub.add_parser('append', help="add passages to an existing index")
+    p.add_argument('path')
+    p.add_argument('files', nargs='+')
+    p = sub.add_parser('bench', help="report recall and latency against exact search")
+    p.add_argument('path')
+    p.add_argument('--k', type=int, default=10)
+    p.add_argument('--nprobe', default='1,4,8,16,32')
+    p.add_argument('--queries', default=None, help="file of questions, one per line; default is a sample of indexed passages")
+    p.add_argument('--n', type=int, default=200, help="number of sampled queries")
+    args = parser.parse_args(argv)
+
+    def passages():
+        for filename in args.files:
+            yield from read_passages(filename)
+
+    if args.command == 'build':
+        VectorIndex.build(args.path, passages(), model=args.model, nlist=args.nlist)
+    elif args.command == 'append':
+        VectorIndex(args.path).append(passages())
+    elif args.command == 'bench':
+        index = VectorIndex(args.path)
+        if args.queries:
+            from st import get_model
+            with open(args.queries) as f:
+                questions = [line.strip() for line in f if line.strip()]
+            queries = [np.array(e.vector) for e in get_model(index.model).embed_batch(questions)]
+        else:
+            rng = np.random.default_rng(0)
+            queries = [np.array(index.vectors[i]) for i in rng.choice(index.count, min(args.n, index.count), replace=False)]
+        bench(index, args.k, [int(n) for n in args.nprobe.split(',')], queries)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,282 @@
+"""
+Whisper voice transcription & translation
+Copyright (C) 2023 Jiggy AI
+
+Voice messages are submitted as in-memory audio buffers to a bounded job queue
+served by one or more whisper workers. Each worker owns its own model and
+worker thread (whisper decoding installs kv-cache hooks on the model so a model
+can not be shared between concurrent decodes) and batches together the jobs that
+are already waiting when it becomes free.
+
+Within a batch the audio is decoded, converted to log-mel spectrograms,
+encoded and language-detected once. For non-english audio the same encoded
+audio features are reused to decode both the transcription and the english
+translation. Audio longer than one 30 second whisper window falls back to
+whisper's transcribe() on the already decoded audio with the detected language.
+
+Configuration:
+JINGBOT_VOICE_WORKERS      number of whisper workers (and models loaded)
+JINGBOT_VOICE_QUEUE_DEPTH  max number of jobs waiting; submit raises VoiceQueueFull beyond this
+JINGBOT_VOICE_BATCH_SIZE   max number of jobs processed together by a worker
+"""
+from loguru import logger
+import os
+import asyncio
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List
+from functools import partial
+from time import time
+from pydantic import BaseModel
+import numpy as np
+import torch
+import whisper
+
+from lazy import Lazy
+import metrics
+
+
+WHISPER_MODEL    = os.environ.get('JINGBOT_WHISPER_MODEL', "large")
+VOICE_WORKERS    = int(os.environ.get('JINGBOT_VOICE_WORKERS', 1))
+VOICE_QUEUE_DEPTH = int(os.environ.get('JINGBOT_VOICE_QUEUE_DEPTH', 32))
+VOICE_BATCH_SIZE = int(os.environ.get('JINGBOT_VOICE_BATCH_SIZE', 8))
+
+LOAD_RETRY_DELAY     = 5      # seconds before retrying a failed model load, doubling up to LOAD_RETRY_MAX_DELAY
+LOAD_RETRY_MAX_DELAY = 300
+
+
+class VoiceResult(BaseModel):
+    """
+    result of processing a voice message
+    """
+    language:    str             # detected language code
+    text:        str             # transcription in the original language
+    translation: Optional[str]   # english translation if language is not english
+
+    @property
+    def english(self) -> str:
+        """
+        return the english text of the voice message
+        """
+        return self.translation if self.translation is not None else self.text
+
+
+class VoiceQueueFull(Exception):
+    """
+    exception to raise if the voice job queue is full
+    """
+
+
+class VoiceUnavailable(Exception):
+    """
+    exception to raise if no worker could load its whisper model
+    """
+
+
+def decode_audio(data : bytes, sr : int = whisper.audio.SAMPLE_RATE) -> np.ndarray:
+    """
+    decode the audio file contents in data to 16kHz mono float32 samples using ffmpeg,
+    like whisper.load_audio but from memory instead of a file
+    """
+    cmd = ["ffmpeg", "-nostdin", "-threads", "0", "-i", "pipe:0",
+           "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(sr), "-"]
+    try:
+        out = subprocess.run(cmd, input=data, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to load audio: {e.stderr.decode()}") from e
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+@torch.no_grad()
+def process_batch(model, audios : List[np.ndarray]) -> List[VoiceResult]:
+    """
+    transcribe each of the 16kHz mono float32 audios, and translate to english those that are not english
+    """
+    t0 = time()
+    fp16 = model.device.type != 'cpu'
+    n_mels = getattr(model.dims, 'n_mels', 80)
+    dtype = torch.float16 if fp16 else torch.float32
+
+    # features for the first 30 second window of each audio; also used for language detection
+    with metrics.span('detect_language'):
+        mel = torch.stack([whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), n_mels) for audio in audios])
+        features = model.embed_audio(mel.to(model.device).to(dtype))
+        _, probs = model.detect_language(features)
+    languages = [max(p, key=p.get) for p in probs]
+    logger.info(f'detected languages {languages} in {time()-t0:.3f} s')
+
+    texts = [{} for _ in audios]
+    short = [i for i, audio in enumerate(audios) if len(audio) <= whisper.audio.N_SAMPLES]
+    for task in ['transcribe', 'translate']:
+        # decode the short audios from the encoded features, batched by language
+        for language in set(languages):
+            if task == 'translate' and language == 'en':
+                continue
+            idx = [i for i in short if languages[i] == language]
+            if not idx:
+                continue
+            options = whisper.DecodingOptions(task=task, language=language, fp16=fp16, without_timestamps=True)
+            with metrics.span(task) as span:
+                span.attrs['audios'] = len(idx)
+                for i, result in zip(idx, whisper.decode(model, features[idx], options)):
+                    texts[i][task] = result.text.strip()
+    for i, audio in enumerate(audios):
+        if i in short:
+            continue
+        for task in ['transcribe'] if languages[i] == 'en' else ['transcribe', 'translate']:
+            with metrics.span(task) as span:
+                span.attrs['seconds_of_audio'] = round(len(audio) / whisper.audio.SAMPLE_RATE)
+                texts[i][task] = model.transcribe(audio, task=task, language=languages[i], fp16=fp16)['text'].strip()
+    logger.info(f'processed {len(audios)} voice messages in {time()-t0:.3f} s')
+    return [VoiceResult(language    = language,
+                        text        = text['transcribe'],
+                        translation = text.get('translate')) for language, text in zip(languages, texts)]
+
+
+class VoiceJob:
+    """
+    a voice message waiting to be processed
+    """
+
+    def __init__(self, data : bytes) -> None:
+        self.data = data
+        self.future = asyncio.get_running_loop().create_future()
+        self.created_at = time()
+
+
+class VoiceQueue:
+    """
+    bounded queue of voice jobs served by batching whisper workers
+    """
+
+    def __init__(self, workers=VOICE_WORKERS, depth=VOICE_QUEUE_DEPTH, batch_size=VOICE_BATCH_SIZE, model_name=WHISPER_MODEL) -> None:
+        self.workers = workers
+        self.depth = depth
+        self.batch_size = batch_size
+        self.model_name = model_name
+        self.busy = 0
+        self.models = [Lazy(f'whisper{n}', partial(whisper.load_model, model_name)) for n in range(workers)]
+        self._queue = None
+        self._tasks = []
+
+    def start(self) -> None:
+        """
+        create the queue and start the workers loading their models.  called on first use if not
+        called at startup; must be called inside the running event loop.
+        """
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.depth)
+            self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    def is_ready(self) -> bool:
+        """
+        return True if at least one worker has loaded its model
+        """
+        return any(model.ready for model in self.models)
+
+    def is_failed(self) -> bool:
+        """
+        return True if every worker's last attempt to load its model failed
+        """
+        return not self.is_ready() and all(model.error is not None for model in self.models)
+
+    def pending(self) -> int:
+        """
+        return the number of jobs waiting for a worker
+        """
+        return self._queue.qsize() if self._queue else 0
+
+    def is_full(self) -> bool:
+        """
+        return True if a newly submitted job would be rejected
+        """
+        return self.pending() >= self.depth
+
+    def is_busy(self) -> bool:
+        """
+        return True if a newly submitted job would have to wait for a worker
+        """
+        return self.busy + self.pending() >= self.workers
+
+    async def submit(self, data : bytes) -> VoiceResult:
+        """
+        process the audio file contents in data, returning the VoiceResult when done.
+        raises VoiceQueueFull if the queue is full
+        """
+        self.start()
+        if self.is_failed():
+            raise VoiceUnavailable(f"voice recognition unavailable: {self.models[0].error}")
+        job = VoiceJob(data)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise VoiceQueueFull(f"voice queue full ({self.depth} jobs waiting)")
+        return await job.future
+
+    async def _worker(self, n : int) -> None:
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'whisper{n}')
+        delay = LOAD_RETRY_DELAY
+        while True:
+            try:
+                model = await loop.run_in_executor(executor, self.models[n])
+                break
+            except Exception as e:
+                # logged by Lazy; fail the waiting jobs rather than leave them waiting on a model that may never load
+                if self.is_failed():
+                    self._fail_pending(VoiceUnavailable(f"voice recognition unavailable: {e}"))
+                logger.warning(f'whisper worker {n} retrying model load in {delay} s')
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, LOAD_RETRY_MAX_DELAY)
+        logger.info(f'whisper worker {n} ready on {model.device}')
+        while True:
+            jobs = [await self._queue.get()]
+            while len(jobs) < self.batch_size and not self._queue.empty():
+                jobs.append(self._queue.get_nowait())
+            self.busy += 1
+            try:
+                logger.info(f'whisper worker {n} processing {len(jobs)} jobs, {self.pending()} pending')
+                results = await loop.run_in_executor(executor, self._run, model, jobs)
+                for job, result in zip(jobs, results):
+                    if job.future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        job.future.set_exception(result)
+                    else:
+                        job.future.set_result(result)
+            except Exception as e:
+                logger.exception(e)
+                for job in jobs:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+            finally:
+                self.busy -= 1
+
+    def _fail_pending(self, e : Exception) -> None:
+        # fail every job waiting in the queue with e
+        while not self._queue.empty():
+            job = self._queue.get_nowait()
+            if not job.future.done():
+                job.future.set_exception(e)
+
+    @staticmethod
+    def _run(model, jobs : List[VoiceJob]) -> list:
+        # decode each job separately so one bad audio file does not fail the whole batch
+        with metrics.span('whisper_batch') as span:
+            span.attrs['jobs'] = len(jobs)
+            results = []
+            audios = []
+            for job in jobs:
+                try:
+                    with metrics.span('decode_audio'):
+                        audios.append(decode_audio(job.data))
+                    results.append(None)
+                except Exception as e:
+                    logger.warning(e)
+                    results.append(e)
+            processed = iter(process_batch(model, audios)) if audios else iter([])
+            return [next(processed) if r is None else r for r in results]
+
+
+voice_queue = VoiceQueue()
+metrics.queue_depth('voice', voice_queue.pending)
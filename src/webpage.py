@@ -0,0 +1,284 @@
+"""
+Async web page fetch & summarization pipeline
+Copyright (C) 2023 Jiggy AI
+
+Pages are fetched with a pooled aiohttp client (per-host connection limits and
+timeouts) and the cpu heavy readability / html-to-text work is done in a bounded
+process pool so that the telegram event loop keeps serving other chats while a
+large page is downloaded and parsed.  Text is extracted from the article tree
+readability has already parsed, in a single walk that stops once it has as
+much text as the summarizer will use; the summary then notes that only the
+beginning of the page was summarized.
+"""
+from loguru import logger
+import os
+import re
+import asyncio
+from time import monotonic
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, AsyncIterator, Tuple
+from pydantic import BaseModel
+import aiohttp
+import lxml.html
+from readability import Document
+
+from db import engine
+from urlcache import UrlCache, normalize_url, content_hash
+from mapreduce import summarize_stream, SUMMARY_MODEL, SECTIONS_FAILED, CHUNK_TOKENS, MAX_CHUNKS
+import metrics
+
+
+FETCH_TIMEOUT       = float(os.environ.get('JINGBOT_FETCH_TIMEOUT', 20))          # total seconds allowed per fetch
+FETCH_CONNECT_TIMEOUT = float(os.environ.get('JINGBOT_FETCH_CONNECT_TIMEOUT', 5))
+FETCH_LIMIT         = int(os.environ.get('JINGBOT_FETCH_LIMIT', 100))             # max open connections overall
+FETCH_LIMIT_PER_HOST = int(os.environ.get('JINGBOT_FETCH_LIMIT_PER_HOST', 4))     # max open connections per host
+FETCH_MAX_BYTES     = int(os.environ.get('JINGBOT_FETCH_MAX_BYTES', 8*1024*1024)) # refuse to download more than this
+PARSE_WORKERS       = int(os.environ.get('JINGBOT_PARSE_WORKERS', 2))             # size of the html parsing process pool
+URL_FRESH_SECONDS   = float(os.environ.get('JINGBOT_URL_FRESH_SECONDS', 300))     # reuse cached pages without revalidation for this long
+EXTRACT_MAX_CHARS   = int(os.environ.get('JINGBOT_EXTRACT_MAX_CHARS', 6*CHUNK_TOKENS*MAX_CHUNKS))  # keep at most this much page text; 6 chars per token leaves slack over the summary budget
+
+# text in these elements is not extracted; SKIP_TAGS subtrees are not visited at all
+SKIP_TAGS      = frozenset(['noscript', 'header', 'meta', 'head', 'input', 'script', 'style'])
+SKIP_TEXT_TAGS = frozenset(['html'])
+
+PREPROMPT = "Provide a detailed summary of the following web page. If there is anything controversial please highlight the controversy. If there is something surprising, unique or clever, please highlight that as well:\n"
+
+parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+
+url_cache = UrlCache(engine)
+
+_session = None
+
+
+class FetchException(Exception):
+    """
+    exception to raise if the url could not be fetched
+    """
+
+
+class FetchResult(BaseModel):
+    """
+    the result of a (possibly conditional) GET
+    """
+    status:        int             # 200, or 304 if the cached content is still valid
+    content:       bytes = b''
+    text:          str = ''
+    content_type:  Optional[str]
+    etag:          Optional[str]
+    last_modified: Optional[str]
+
+
+def http_session() -> aiohttp.ClientSession:
+    """
+    return the shared aiohttp session, creating it on first use.
+    must be called from within the running event loop.
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=FETCH_LIMIT,
+                                         limit_per_host=FETCH_LIMIT_PER_HOST,
+                                         ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=FETCH_TIMEOUT, sock_connect=FETCH_CONNECT_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector,
+                                         timeout=timeout,
+                                         headers={'User-Agent': 'Mozilla/5.0 (compatible; Jingbot)'})
+    return _session
+
+
+def find_url(msg : str) -> Optional[str]:
+    """
+    return the first url found in msg or None
+    """
+    match = re.search(r"(?P<url>https?://[^\s]+)", msg)
+    if match:
+        return match.group("url")
+    return None
+
+
+def extract_text(root, max_chars : int = EXTRACT_MAX_CHARS) -> Tuple[str, bool]:
+    """
+    return the text nodes of the lxml tree root, each followed by a space, cut to max_chars, and
+    whether text was cut.  the walk stops at max_chars and SKIP_TAGS subtrees are not visited.
+    """
+    parts = []
+    size = 0
+
+    def add(text):
+        # the separator after the last node kept does not count as text that was cut
+        nonlocal size
+        parts.append(text)
+        parts.append(' ')
+        size += len(text) + 1
+
+    if root.tag in SKIP_TAGS:
+        return '', False
+    if root.text and root.tag not in SKIP_TEXT_TAGS:
+        add(root.text)
+    # iterative depth first walk; an element's tail is text of its parent and follows its subtree
+    stack = [(root, iter(root))]
+    while stack and size <= max_chars + 1:
+        el, children = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+            if stack and el.tail and stack[-1][0].tag not in SKIP_TEXT_TAGS:
+                add(el.tail)
+            continue
+        if isinstance(child.tag, str) and child.tag not in SKIP_TAGS:
+            if child.text and child.tag not in SKIP_TEXT_TAGS:
+                add(child.text)
+            stack.append((child, iter(child)))
+        elif child.tail and el.tag not in SKIP_TEXT_TAGS:
+            add(child.tail)    # skipped subtree or comment
+    return ''.join(parts)[:max_chars], size > max_chars + 1
+
+
+def extract_text_from_html(content : str, max_chars : int = EXTRACT_MAX_CHARS) -> str:
+    """
+    extract the text from html content
+    """
+    if not content or content.isspace():
+        return ''
+    return extract_text(lxml.html.document_fromstring(content), max_chars)[0]
+
+
+def html_to_text(content : str, max_chars : int = EXTRACT_MAX_CHARS) -> Tuple[str, bool]:
+    """
+    extract the readable text from html content, returning the text cut to max_chars and whether
+    it was cut.  runs in the parse_pool worker processes.
+    """
+    doc = Document(content)
+    # summary() leaves the cleaned article tree in doc.html (readability-lxml 0.8.1, pinned by
+    # test_webpage.py) so the article is not parsed again from the summary html
+    doc.summary()
+    return extract_text(doc.html, max_chars)
+
+
+async def fetch(url : str, headers : Optional[dict] = None) -> FetchResult:
+    """
+    fetch the url and return the FetchResult.
+    supply conditional request headers to allow a 304 Not Modified response.
+    raises FetchException if the url could not be fetched
+    """
+    session = http_session()
+    try:
+        async with session.get(url, headers=headers) as resp:
+            if resp.status == 304 and headers:
+                return FetchResult(status        = 304,
+                                   etag          = resp.headers.get('ETag'),
+                                   last_modified = resp.headers.get('Last-Modified'))
+            if resp.status != 200:
+                raise FetchException(f"Unable to GET contents of {url}")
+            if resp.content_length and resp.content_length > FETCH_MAX_BYTES:
+                raise FetchException(f"Content of {url} is too large ({resp.content_length} bytes)")
+            body = bytearray()
+            async for chunk in resp.content.iter_chunked(64*1024):
+                body += chunk
+                if len(body) > FETCH_MAX_BYTES:
+                    raise FetchException(f"Content of {url} is too large")
+            charset = resp.charset or 'utf-8'
+            body = bytes(body)
+            return FetchResult(status        = 200,
+                               content       = body,
+                               text          = body.decode(charset, errors='replace'),
+                               content_type  = resp.content_type,
+                               etag          = resp.headers.get('ETag'),
+                               last_modified = resp.headers.get('Last-Modified'))
+    except asyncio.TimeoutError:
+        raise FetchException(f"Timeout fetching {url}")
+    except aiohttp.ClientError as e:
+        raise FetchException(f"Unable to GET contents of {url}: {e}")
+
+
+async def parse(content : str) -> Tuple[str, bool]:
+    """
+    extract readable text from the html content in the parse_pool, returning the text cut to
+    EXTRACT_MAX_CHARS and whether it was cut
+    """
+    loop = asyncio.get_running_loop()
+    return await metrics.track('parse', loop.run_in_executor(parse_pool, html_to_text, content))
+
+
+async def url_summary_stream(url : str, user_id : Optional[int] = None) -> AsyncIterator[Tuple[str, str]]:
+    """
+    query the url and summarize the text content, yielding ("not_finished", partial_summary)
+    as the summary is produced and ("finished", summary) at the end.
+    """
+    normalized_url = normalize_url(url)
+    page = await asyncio.to_thread(url_cache.page, normalized_url)
+    if page and page.is_fresh(URL_FRESH_SECONDS):
+        summary = await asyncio.to_thread(url_cache.summary, page.content_hash, SUMMARY_MODEL, PREPROMPT)
+        if summary is not None:
+            logger.info(f'{normalized_url} fresh summary cache hit')
+            metrics.cache_lookup('url_summary', 1)
+            yield "finished", summary
+            return
+    headers = page.conditional_headers() if page and page.content_hash else None
+    try:
+        with metrics.span('fetch'):
+            result = await fetch(url, headers)
+    except FetchException as e:
+        logger.warning(e)
+        yield "finished", str(e)
+        return
+
+    if result.status == 304:
+        logger.info(f'{normalized_url} not modified')
+        chash = page.content_hash
+    else:
+        chash = content_hash(result.content)
+    page = await asyncio.to_thread(url_cache.update_page,
+                                   url,
+                                   normalized_url,
+                                   result.etag or (page.etag if result.status == 304 else None),
+                                   result.last_modified or (page.last_modified if result.status == 304 else None),
+                                   chash,
+                                   user_id)
+
+    summary = await asyncio.to_thread(url_cache.summary, chash, SUMMARY_MODEL, PREPROMPT)
+    metrics.cache_lookup('url_summary', summary is not None, summary is None)
+    if summary is not None:
+        logger.info(f'{normalized_url} summary cache hit')
+        yield "finished", summary
+        return
+
+    text = await asyncio.to_thread(url_cache.text, chash)
+    metrics.cache_lookup('url_text', text is not None, text is None)
+    truncated = text is not None and len(text) >= EXTRACT_MAX_CHARS    # stored text is cut to EXTRACT_MAX_CHARS
+    if text is None:
+        if result.status == 304:
+            # we have validators but lost the text; fetch the content unconditionally
+            try:
+                with metrics.span('fetch'):
+                    result = await fetch(url)
+            except FetchException as e:
+                logger.warning(e)
+                yield "finished", str(e)
+                return
+            chash = content_hash(result.content)
+            page = await asyncio.to_thread(url_cache.update_page, url, normalized_url, result.etag, result.last_modified, chash, user_id)
+        with metrics.span('parse'):
+            text, truncated = await parse(result.text)
+        if not len(text) or text.isspace():
+            yield "finished", "Unable to extract text data from url"
+            return
+        await asyncio.to_thread(url_cache.store_text, page, chash, text, 'readability', result.content_type)
+
+    t0 = monotonic()
+    async for status, response in summarize_stream(text, PREPROMPT, truncated=truncated):
+        yield status, response
+    metrics.observe('summarize', monotonic() - t0)
+    logger.info(response)
+    if SECTIONS_FAILED in response:
+        return    # not cached, so the page is summarized in full next time
+    await asyncio.to_thread(url_cache.store_summary, chash, SUMMARY_MODEL, PREPROMPT, response)
+
+
+async def url_to_response(url : str, user_id : Optional[int] = None) -> str:
+    """
+    query the url and return a summary of the text content
+    """
+    with metrics.span('url_to_response'):
+        async for status, response in url_summary_stream(url, user_id):
+            pass
+    return response